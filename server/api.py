@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
-import os, json, sys, shutil
-from src import findFlows, makeEvals, sherpa
-from flask import Flask, request, send_file
+import os, json, sys, shutil, threading, time, uuid, queue, zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from src import findFlows, makeEvals, sherpa, sherpa_exp
+from src.utils.resultcache import ResultCache
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
@@ -12,10 +15,81 @@ uploads_dir = 'uploads'
 if not os.path.exists(uploads_dir):
     os.makedirs(uploads_dir)
 ALLOWED_EXTENSIONS = {'json'}
+# bounds on the networks kept built in memory, in number and in bytes of the files they are built from
+NETWORK_CACHE_ENTRIES = 8
+NETWORK_CACHE_BYTES = 256*1024*1024
+# background jobs: threads running them, jobs that may be queued or running at once, finished jobs remembered
+JOB_WORKERS = 2
+JOB_QUEUE_DEPTH = 16
+JOB_HISTORY = 256
+# results and layer profiles kept in each session's cache folder: files unused for longer than the age
+# (seconds) are removed, then the least recently used while the folder holds more than the bytes
+RESULT_CACHE_AGE = 7*24*3600
+RESULT_CACHE_BYTES = 256*1024*1024
 if app.debug:
     print(os.getcwd())
 
 
+class NetworkCache:
+    '''
+    Least recently used cache of the networks sherpa.build_network builds, so that
+    requests on the same session don't rebuild its network from disk.   An entry is
+    keyed by the paths, modification times and sizes of the files the network is built
+    from, so a changed file misses.   Entries are evicted once there are more than
+    max_entries of them or their files add up to more than max_bytes.
+    A network is taken out of the cache by get and handed back by put when the run using
+    it is done, so concurrent requests never route on the same network
+    '''
+    def __init__(self,max_entries,max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self,key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            network, size = self.entries.pop(key)
+            self.bytes -= size
+            return network
+
+    def put(self,key,network,size):
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (network,size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or \
+                    (self.bytes > self.max_bytes and len(self.entries) > 1):
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def invalidate(self,session_dir):
+        '''
+        Drop the networks built from files in session_dir
+        '''
+        prefix = os.path.join(session_dir,'')
+        with self.lock:
+            for key in [key for key in self.entries if any(path.startswith(prefix) for path, _ in key)]:
+                self.bytes -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries':len(self.entries),'bytes':self.bytes,'hits':self.hits,'misses':self.misses,
+                    'evictions':self.evictions,'hit_rate':self.hits/lookups if lookups else 0}
+
+network_cache = NetworkCache(NETWORK_CACHE_ENTRIES,NETWORK_CACHE_BYTES)
+result_cache = ResultCache(RESULT_CACHE_AGE,RESULT_CACHE_BYTES)
+
 def allowed_file(filename):
     '''
     Helper Function to make uploaded filenames secure
@@ -23,7 +97,22 @@ def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.',1)[1].lower() in ALLOWED_EXTENSIONS
 
-def ret_json(success=True,status=200,sess=None,flows=None,links=None,switch=None,msg=None):
+# optional metric parameters passed through from the request to the evaluation:
+#   order:        order in which link combinations are enumerated, 'lexicographic' (default) or 'gray'
+#   method:       engine, 'enumerate' (default), 'cutset' or 'montecarlo'
+#   precision, confidence, seed, max_samples:  settings of the 'montecarlo' estimator
+#   workers:      number of processes the failure scenarios are shared out over, default 1
+OPTIONAL_METRIC_PARAMS = ('order','method','precision','confidence','seed','max_samples','workers')
+
+def add_optional_params(param,form_json):
+    '''
+    Helper Function to copy the optional metric parameters present in the request into param
+    '''
+    for key in OPTIONAL_METRIC_PARAMS:
+        if key in form_json:
+            param[key] = form_json[key]
+
+def ret_json(success=True,status=200,sess=None,flows=None,links=None,switch=None,msg=None,page=None):
     '''
     Helper Function to format json response output
     '''
@@ -39,6 +128,8 @@ def ret_json(success=True,status=200,sess=None,flows=None,links=None,switch=None
         retDict['switches'] = switch
     if msg:
         retDict['message'] = msg
+    if page:
+        retDict['page'] = page
     
     return json.dumps(retDict),status,{'ContentType':'application/json'}
 
@@ -69,6 +160,286 @@ def get_sess_eval_out_path(request):
     return sess_file, eval_file, out_file
 
 
+def run_sherpa_eval(sess_file,eval_file,out_file,form_json,ctx=None):
+    '''
+    Create the evaluation failing the selected links and run sherpa on it.
+    ctx, if given, is the sherpa.SherpaContext to run in
+    '''
+    flows = form_json['flows']
+    links = form_json['links']
+    makeEvals.make_Eval(sess_file,eval_file,flows,links)
+    sherpa.run_exp(eval_file,out_file,cache=network_cache,ctx=ctx,result_cache=result_cache)
+
+def run_switch_eval(sess_file,eval_file,out_file,form_json,ctx=None):
+    '''
+    Create the evaluation failing the links of the selected switches and run sherpa on it
+    '''
+    flows = form_json['flows']
+    switches = form_json['switches']
+    ## map selected switches to list of links
+    links = makeEvals.switch2Link(sess_file,switches)
+    makeEvals.make_Eval(sess_file,eval_file,flows,links)
+    sherpa.run_exp(eval_file,out_file,cache=network_cache,ctx=ctx,result_cache=result_cache)
+
+def run_critf_link(sess_file,eval_file,out_file,form_json,ctx=None):
+    '''
+    Create the evaluation of the link metric and run sherpa on it
+    '''
+    flows = form_json['flows']
+    links = form_json['links']
+    # create parameter dictionary
+    param = {'failure_rate':form_json['failure_rate'],'time':form_json['time'],'tolerance':form_json['tolerance']}
+    add_optional_params(param,form_json)
+    makeEvals.make_Eval(sess_file,eval_file,flows,links,param,type_m="link")
+    sherpa.run_critf(eval_file,out_file,cache=network_cache,ctx=ctx,result_cache=result_cache)
+
+def run_critf_switch(sess_file,eval_file,out_file,form_json,ctx=None):
+    '''
+    Create the evaluation of the switch metric and run sherpa on it
+    '''
+    flows = form_json['flows']
+    switches = form_json['switches']
+    param = {'failure_rate':form_json['failure_rate'],'time':form_json['time'],'tolerance':form_json['tolerance']}
+    add_optional_params(param,form_json)
+    makeEvals.make_Eval(sess_file,eval_file,flows,links=switches,param=param,type_m="switch")
+    sherpa.run_critf(eval_file,out_file,type_m="switch",cache=network_cache,ctx=ctx,result_cache=result_cache)
+
+def run_critf_neigh(sess_file,eval_file,out_file,form_json,ctx=None):
+    '''
+    Create the evaluation of the neighborhood metric and run sherpa on it
+    '''
+    switches = form_json['switches']
+    param = {'failure_rate':form_json['failure_rate'],'time':form_json['time'],'hops':form_json['hops'],
+             'tolerance':form_json['tolerance']}
+    add_optional_params(param,form_json)
+    makeEvals.make_Eval(sess_file,eval_file,flows=None,links=switches,param=param,type_m="neigh")
+    sherpa.run_critf(eval_file,out_file,type_m="neigh",cache=network_cache,ctx=ctx,result_cache=result_cache)
+
+def run_failure_matrix(sess_file,eval_file,out_file,form_json,ctx=None):
+    '''
+    Create the failure matrix evaluation of the selected flows and links, all of the
+    session's if none are selected, and run sherpa on it
+    '''
+    form_json = form_json or {}
+    flows = form_json.get('flows') or list(makeEvals.openSession(sess_file).flowsDict())
+    links = form_json.get('links') or makeEvals.get_links(sess_file)
+    param = {'depth':form_json.get('depth',2)}
+    if 'order' in form_json:
+        param['order'] = form_json['order']
+    makeEvals.make_Eval(sess_file,eval_file,flows,links,param,type_m="matrix")
+    sherpa.run_matrix(eval_file,out_file,cache=network_cache,ctx=ctx,result_cache=result_cache)
+
+# forms the output file of a run can be written in, see src/utils/resultwriter.py
+RESULT_FORMS = ['auto','pretty','compact','ndjson']
+
+def result_form(request):
+    '''
+    Helper Function to pick the form of the output file of a run, from the 'format' request
+    argument or else the Accept header: 'ndjson' (one line per evaluation) given
+    application/x-ndjson, and otherwise 'auto', indented json for small outputs and
+    compact json for large ones
+    '''
+    form = request.args.get('format')
+    if form in RESULT_FORMS:
+        return form
+    if 'application/x-ndjson' in request.headers.get('Accept',''):
+        return 'ndjson'
+    return 'auto'
+
+def accepts_gzip(request):
+    return 'gzip' in request.headers.get('Accept-Encoding','')
+
+def result_context(request):
+    '''
+    Helper Function to make the SherpaContext of a run whose output file is the reply to
+    request, written in the form it asks for, and gzip compressed if it accepts that
+    '''
+    ctx = sherpa.SherpaContext()
+    ctx.outputForm = result_form(request)
+    ctx.outputCompress = accepts_gzip(request)
+    return ctx
+
+def gzip_chunks(path):
+    '''
+    Helper Function to gzip compress a file as it is read
+    '''
+    compressor = zlib.compressobj(wbits=31)
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<16),b''):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    yield compressor.flush()
+
+def send_result(request,out_file,ctx):
+    '''
+    Helper Function to send the output file of a run made with ctx, gzip compressed if
+    the request accepts that
+    '''
+    mimetype = 'application/x-ndjson' if ctx.outputForm == 'ndjson' else 'application/json'
+    if ctx.outputCompress:
+        response = send_file(out_file,mimetype=mimetype,as_attachment=True)
+        response.headers['Content-Encoding'] = 'gzip'
+    elif accepts_gzip(request):
+        response = Response(gzip_chunks(out_file),mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Disposition'] = 'attachment; filename='+os.path.basename(out_file)
+    else:
+        response = send_file(out_file,mimetype=mimetype,as_attachment=True)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+def stream_format(request):
+    '''
+    Helper Function to pick the streaming format of a metric response, 'ndjson' or 'sse', from the
+    'stream' request argument or else the Accept header.  None for the plain json output file
+    '''
+    fmt = request.args.get('stream')
+    if fmt in ('ndjson','sse'):
+        return fmt
+    accept = request.headers.get('Accept','')
+    if 'text/event-stream' in accept:
+        return 'sse'
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    return None
+
+def stream_metric(runner,sess_file,eval_file,out_file,form_json,fmt):
+    '''
+    Run one of the run_critf_* functions in a thread and stream its progress as it goes, as
+    newline delimited json or as Server-Sent Events.   Each time a layer of failure combinations
+    is added to the metric of a flow (of a switch, for critf_neigh) a 'layer' event gives its
+    partial probability and the 'tail', the probability of more failures than the layers so far,
+    which bounds how much the probability can still grow.  The last event is 'result', with the
+    evaluations of the output file, or 'error'.   If the client goes away the run is cancelled
+    '''
+    events = queue.Queue()
+    ctx = sherpa.SherpaContext()
+
+    def onLayer(name,layer,probability,tail,bound):
+        event = {'event':'layer','name':name,'layer':layer,'probability':probability,'tail':tail}
+        if bound != None:
+            event['uppper bound'] = bound
+        events.put(event)
+    ctx.onLayer = onLayer
+
+    def run():
+        try:
+            runner(sess_file,eval_file,out_file,form_json,ctx)
+            with open(out_file,'r') as of:
+                events.put({'event':'result','evaluations':json.load(of)['evaluations']})
+        except sherpa_exp.RunCancelled:
+            pass
+        except:
+            print("Error",sys.exc_info()[0])
+            events.put({'event':'error','message':str(sys.exc_info()[0])})
+        events.put(None)
+
+    def generate():
+        threading.Thread(target=run,daemon=True).start()
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    return
+                if fmt == 'sse':
+                    yield 'event: %s\ndata: %s\n\n' % (event['event'],json.dumps(event))
+                else:
+                    yield json.dumps(event)+'\n'
+        finally:
+            ## stops the run at its next scenario when the client disconnected
+            ctx.cancelled = True
+
+    mimetype = 'text/event-stream' if fmt == 'sse' else 'application/x-ndjson'
+    return Response(generate(),mimetype=mimetype)
+
+# the evaluations a job can run, by the endpoint that runs them inline
+JOB_KINDS = {'sherpa':run_sherpa_eval,'switch':run_switch_eval,'critf_link':run_critf_link,
+             'critf_switch':run_critf_switch,'critf_neigh':run_critf_neigh,'failure_matrix':run_failure_matrix}
+
+class JobQueue:
+    '''
+    Runs evaluations in the background, on a pool of workers threads.   At most
+    depth jobs may be queued or running at once; submit refuses more.   A job is
+    followed through the SherpaContext it runs in, which reports the layer and the
+    number of failure scenarios done, and is cancelled by setting its cancelled flag.
+    The history_size most recent finished jobs are remembered
+    '''
+    def __init__(self,workers,depth,history_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.depth = depth
+        self.history_size = history_size
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self,kind,sess_file,eval_file,out_file,form_json,form='auto'):
+        ctx = sherpa.SherpaContext()
+        ctx.outputForm = form
+        with self.lock:
+            active = sum(1 for job in self.jobs.values() if job['state'] in ('queued','running'))
+            if active >= self.depth:
+                return None
+            job = {'id':uuid.uuid4().hex,'kind':kind,'state':'queued','error':None,
+                   'eval_file':eval_file,'out_file':out_file,'ctx':ctx,
+                   'submitted':time.time(),'started':None,'finished':None}
+            self.jobs[job['id']] = job
+            self.prune()
+        job['future'] = self.executor.submit(self.run,job,sess_file,form_json)
+        return job['id']
+
+    def run(self,job,sess_file,form_json):
+        with self.lock:
+            if job['state'] != 'queued':
+                return
+            job['state'] = 'running'
+            job['started'] = time.time()
+        try:
+            JOB_KINDS[job['kind']](sess_file,job['eval_file'],job['out_file'],form_json,job['ctx'])
+            state = 'done'
+        except sherpa_exp.RunCancelled:
+            state = 'cancelled'
+        except:
+            print("Error",sys.exc_info()[0])
+            state = 'failed'
+            job['error'] = str(sys.exc_info()[0])
+        with self.lock:
+            job['state'] = state
+            job['finished'] = time.time()
+
+    def cancel(self,job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job['state'] == 'queued':
+                job['state'] = 'cancelled'
+                job['finished'] = time.time()
+            if job['state'] == 'running':
+                job['ctx'].cancelled = True
+            return job['state']
+
+    def status(self,job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            ctx = job['ctx']
+            return {'id':job['id'],'kind':job['kind'],'state':job['state'],'error':job['error'],
+                    'progress':{'layer':ctx.layer,'scenarios':ctx.scenarios},
+                    'submitted':job['submitted'],'started':job['started'],'finished':job['finished']}
+
+    def result(self,job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return (job['state'],job['out_file'],job['ctx']) if job else (None,None,None)
+
+    def prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['state'] in ('done','failed','cancelled')]
+        for job_id in finished[:max(0,len(finished)-self.history_size)]:
+            del self.jobs[job_id]
+
+job_queue = JobQueue(JOB_WORKERS,JOB_QUEUE_DEPTH,JOB_HISTORY)
+
 @app.route('/upload',methods=["POST"])
 def upload_config():
     '''
@@ -79,6 +450,9 @@ def upload_config():
     Requst Arguments:
         name:       name of the session
         mh:         the minimum number of hops
+        workers:    (optional) number of processes to share flow discovery out over,
+                      by source switch, default 1.  The time each took is recorded
+                      under 'discovery' in the session file
     File Arguments:
         topology:   user json input of network topology
         rules:      user json input of network rules
@@ -102,6 +476,9 @@ def upload_config():
         mh = request.args['mh']
     if not (str.isdigit(mh) and int(mh) > -1):
         return ret_json(False,404,msg='minimum hop should be an positive integer')
+    workers = request.args.get('workers','1')
+    if not (str.isdigit(workers) and int(workers) > 0):
+        return ret_json(False,404,msg='workers should be a positive integer')
     folder_n = exp_name+'_mh_'+str(mh)
     session_n = os.path.join(uploads_dir,folder_n)
     if os.path.exists(session_n):
@@ -135,7 +512,9 @@ def upload_config():
         sess_file = os.path.join(session_n,'session.json') 
         flows_file = os.path.join(session_n,'flows.json')
         switch_file = os.path.join(session_n,'switch.json')
-        findFlows.findFlows(top_path,rule_path,IP_path,mh,flows_file,sess_file,switch_file)
+        # a session of this name may have been removed and uploaded again
+        network_cache.invalidate(session_n)
+        findFlows.findFlows(top_path,rule_path,IP_path,mh,flows_file,sess_file,switch_file,int(workers))
         # create response json returning flows and rules of session
         return ret_json(sess=folder_n) 
     except:
@@ -145,6 +524,17 @@ def upload_config():
         return ret_json(False,status=500,msg=sys.exc_info()[0])
 
 
+# arguments of /load that select, page or project the flows, see load_config
+LOAD_LIST_ARGS = ['src','dst','switch','link']
+LOAD_ARGS = LOAD_LIST_ARGS + ['min_hops','ip_dscp','cursor','limit','fields','exclude','include']
+LOAD_PARTS = ['flows','links','switches']
+
+def arg_list(request,key):
+    '''
+    Helper Function to split a comma separated request argument into a list
+    '''
+    return [v for v in request.args[key].split(',') if v]
+
 @app.route('/load',methods=["GET"])
 def load_config():
     '''
@@ -153,10 +543,25 @@ def load_config():
     
     Request Arguments:
         sess:       the session folder to be used
+      optional, to select flows (a comma separated list matches any of its values):
+        src, dst:   source, destination switch of the flow
+        switch:     a switch the flow traverses
+        link:       a link the flow traverses, either way, e.g. n1-n4
+        min_hops:   the fewest links the flow traverses
+        ip_dscp:    the ip_dscp of the flow
+      optional, to page and project them:
+        limit:      the most flows to return
+        cursor:     where to start, the next_cursor of the previous page
+        fields:     comma separated flow attributes to return, all if not given
+        exclude:    comma separated flow attributes to leave out, e.g. visited
+        include:    comma separated parts of the output to return, of flows, links, switches
     output:
         session:    the session name
         flows:      the list of flows in this session with given mh
         links:      the list of links in this session with given mh
+        switches:   the links of each switch
+        page:       given any optional argument, the number of flows selected (total) and
+                    the cursor of the next page (next_cursor), absent on the last page
 
     '''
     if 'session_name' not in request.args:
@@ -167,10 +572,48 @@ def load_config():
     if not os.path.exists(session_n):
         return ret_json(False,404,msg='Session does not exist')
     sess_file = os.path.join(session_n,'session.json')
-    ## return flows and rules with the given configurations
-    linksList, flowsDict, switchNodes = makeEvals.get_flows_rules(sess_file)
-    # get session file and run makeEvals, and return the links and flows
-    return ret_json(sess=sess,flows=flowsDict,links=linksList,switch=switchNodes)
+    if not any(key in request.args for key in LOAD_ARGS):
+        ## return flows and rules with the given configurations
+        linksList, flowsDict, switchNodes = makeEvals.get_flows_rules(sess_file)
+        # get session file and run makeEvals, and return the links and flows
+        return ret_json(sess=sess,flows=flowsDict,links=linksList,switch=switchNodes)
+
+    # select flows through the indexes of the session, and return a page of them
+    filters = {}
+    for key in LOAD_LIST_ARGS:
+        if key in request.args:
+            filters[key] = arg_list(request,key)
+    for key in ['min_hops','cursor','limit']:
+        if key in request.args and not str.isdigit(request.args[key]):
+            return ret_json(False,404,msg=key+' should be a positive integer')
+    if 'min_hops' in request.args:
+        filters['min_hops'] = int(request.args['min_hops'])
+    if 'ip_dscp' in request.args:
+        dscp = arg_list(request,'ip_dscp')
+        if not all(str.isdigit(v) for v in dscp):
+            return ret_json(False,404,msg='ip_dscp should be a list of positive integers')
+        filters['ip_dscp'] = [int(v) for v in dscp]
+    limit = int(request.args['limit']) if 'limit' in request.args else None
+    if limit == 0:
+        return ret_json(False,404,msg='limit should be a positive integer')
+    cursor = int(request.args.get('cursor','0'))
+    fields = set(arg_list(request,'fields')) if 'fields' in request.args else None
+    exclude = set(arg_list(request,'exclude')) if 'exclude' in request.args else set()
+    include = arg_list(request,'include') if 'include' in request.args else LOAD_PARTS
+    if not set(include) <= set(LOAD_PARTS):
+        return ret_json(False,404,msg='include should name parts of '+','.join(LOAD_PARTS))
+
+    flowsDict, linksList, switchNodes, page = None, None, None, None
+    if 'flows' in include:
+        flowsDict, total, next_cursor = makeEvals.select_flows(sess_file,filters,cursor,limit,fields,exclude)
+        page = {'total':total}
+        if next_cursor is not None:
+            page['next_cursor'] = next_cursor
+    if 'links' in include:
+        linksList = makeEvals.get_links(sess_file)
+    if 'switches' in include:
+        switchNodes = makeEvals.openSession(sess_file).switchNodes()
+    return ret_json(sess=sess,flows=flowsDict,links=linksList,switch=switchNodes,page=page)
 
 @app.route('/sessions',methods=["GET"])
 def get_sessions():
@@ -207,16 +650,13 @@ def run_sherpa():
 
     # get selected flows and links array
     form_json = request.get_json()
-    flows = form_json['flows']
-    links = form_json['links']
 
     try:
         # run evalution on chosen flows and links
-        makeEvals.make_Eval(sess_file,eval_file,flows,links)
-        # run experiment from created evaluation
-        sherpa.run_exp(eval_file,out_file)
+        ctx = result_context(request)
+        run_sherpa_eval(sess_file,eval_file,out_file,form_json,ctx)
         # fetch experiment file and return it
-        return send_file(out_file,as_attachment=True)
+        return send_result(request,out_file,ctx)
     except:
         print("Error",sys.exc_info()[0])
         if os.path.exists(eval_file):
@@ -246,18 +686,13 @@ def run_switch():
 
     # get selected flows and switch array
     form_json = request.get_json()
-    flows = form_json['flows']
-    switches = form_json['switches']
 
     try:
-        ## map selected switches to list of links
-        links = makeEvals.switch2Link(sess_file,switches)
-        # run evalution on chosen flows and links
-        makeEvals.make_Eval(sess_file,eval_file,flows,links)
-        # run experiment from created evaluation
-        sherpa.run_exp(eval_file,out_file)
+        # run evalution on chosen flows and the links of the chosen switches
+        ctx = result_context(request)
+        run_switch_eval(sess_file,eval_file,out_file,form_json,ctx)
         # fetch experiment file and return it
-        return send_file(out_file,as_attachment=True)
+        return send_result(request,out_file,ctx)
     except:
         print("Error",sys.exc_info()[0])
         if os.path.exists(eval_file):
@@ -289,28 +724,54 @@ def critf_link():
                         calculation, if the tolerance percent is exceeded,
                         the metric will stop and return the probability
                         with {tolerance}% as an upperbound.
+        order:        (optional) 'gray' to enumerate link combinations so that
+                        consecutive ones differ by a single link, default 'lexicographic'
+        method:       (optional) 'perflow' to run the flows one at a time,
+                        'cutset' to compute the metric exactly from the
+                        flow's minimal cut sets instead of simulating every
+                        combination of links (exact as long as failing more
+                        links never lets a flow route again; flows found not
+                        to behave so are enumerated), 'montecarlo' to estimate it by
+                        stratified sampling, default 'enumerate'
+        precision:    (optional, montecarlo) relative half-width of the confidence
+                        interval at which sampling stops, default 0.05
+        confidence:   (optional, montecarlo) confidence level of the interval, default 0.95
+        seed:         (optional, montecarlo) seed of the sampler, default 0
+        max_samples:  (optional, montecarlo) limit on the number of samples, default 100000
+        workers:      (optional) number of processes to share the failure scenarios
+                        out over, default 1
+    Request Arguments (optional):
+        stream:       'ndjson' or 'sse' to stream the metric as it converges rather than
+                        wait for the output file, see stream_metric.  An Accept header of
+                        application/x-ndjson or text/event-stream does the same.
+                        Also accepted by critf_switch and critf_neigh
+        format:       'pretty', 'compact' or 'ndjson' (one line per evaluation) to write the
+                        output file in, default 'auto', pretty for small outputs and compact
+                        for large ones.  At /sherpa, /switch and /jobs an Accept header of
+                        application/x-ndjson asks for 'ndjson'.  Given Accept-Encoding: gzip
+                        the output file is sent gzip compressed.  Also accepted by every
+                        endpoint that sends an output file
     output:
-        output file:  json output of experiment ran on evaluation
+        output file:  json output of experiment ran on evaluation.  Its result_cache
+                        entry holds the key it is cached under in the session, and
+                        whether it was taken from there (hit) rather than run.  When only
+                        failure_rate, time or tolerance change, the p_m of the layers
+                        computed before are reused and only missing layers are simulated
     '''
     sess_file, eval_file, out_file = get_sess_eval_out_path(request)
 
     form_json = request.get_json()
-    flows = form_json['flows']
-    links = form_json['links']
-    f_rate = form_json['failure_rate']
-    time = form_json['time']
-    tolerate = form_json['tolerance']
 
-    # create parameter dictionary
-    param = {'failure_rate':f_rate,'time':time,'tolerance':tolerate}
+    fmt = stream_format(request)
+    if fmt:
+        return stream_metric(run_critf_link,sess_file,eval_file,out_file,form_json,fmt)
 
     try:
-        ## create evaluation file to be stored in 
-        makeEvals.make_Eval(sess_file,eval_file,flows,links,param,type_m="link")
-        ## from evaluation file run sherpa to generate the metric
-        sherpa.run_critf(eval_file,out_file)
+        ## create the evaluation file and run sherpa on it to generate the metric
+        ctx = result_context(request)
+        run_critf_link(sess_file,eval_file,out_file,form_json,ctx)
         ## return the output from the experiment
-        return send_file(out_file,as_attachment=True)
+        return send_result(request,out_file,ctx)
     except:
         print("Error",sys.exc_info()[0])
         if os.path.exists(eval_file):
@@ -325,21 +786,16 @@ def critf_switch():
     sess_file, eval_file, out_file = get_sess_eval_out_path(request)
 
     form_json = request.get_json()
-    flows = form_json['flows']
-    switches = form_json['switches']
-    f_rate = form_json['failure_rate']
-    time = form_json['time']
-    tolerate = form_json['tolerance']
 
-    # create parameter dictionary
-    param = {'failure_rate':f_rate,'time':time,'tolerance':tolerate}
+    fmt = stream_format(request)
+    if fmt:
+        return stream_metric(run_critf_switch,sess_file,eval_file,out_file,form_json,fmt)
 
     try:
-        ## create evaluation file to be stored in 
-        makeEvals.make_Eval(sess_file,eval_file,flows,links=switches,param=param,type_m="switch")
-
-        sherpa.run_critf(eval_file,out_file,type_m="switch")
-        return send_file(out_file,as_attachment=True)
+        ## create the evaluation file and run sherpa on it to generate the metric
+        ctx = result_context(request)
+        run_critf_switch(sess_file,eval_file,out_file,form_json,ctx)
+        return send_result(request,out_file,ctx)
     except:
         print("Error",sys.exc_info()[0])
         if os.path.exists(eval_file):
@@ -354,22 +810,16 @@ def critf_neigh():
     sess_file, eval_file, out_file = get_sess_eval_out_path(request)
 
     form_json = request.get_json()
-    #flows = form_json['flows']
-    switches = form_json['switches']
-    f_rate = form_json['failure_rate']
-    time = form_json['time']
-    hops = form_json['hops']
-    tolerate = form_json['tolerance']
 
-    # create parameter dictionary
-    param = {'failure_rate':f_rate,'time':time,'hops':hops,'tolerance':tolerate}
+    fmt = stream_format(request)
+    if fmt:
+        return stream_metric(run_critf_neigh,sess_file,eval_file,out_file,form_json,fmt)
 
     try:
-        ## create evaluation file to be stored in 
-        makeEvals.make_Eval(sess_file,eval_file,flows=None,links=switches,param=param,type_m="neigh")
-        ## from evaluation file, run sherpa neighborhood
-        sherpa.run_critf(eval_file,out_file,type_m="neigh")
-        return send_file(out_file,as_attachment=True)
+        ## create the evaluation file and run sherpa neighborhood on it
+        ctx = result_context(request)
+        run_critf_neigh(sess_file,eval_file,out_file,form_json,ctx)
+        return send_result(request,out_file,ctx)
     except:
         print("Error",sys.exc_info()[0])
         if os.path.exists(eval_file):
@@ -378,6 +828,129 @@ def critf_neigh():
             shutil.rmtree(out_file)
         return ret_json(False,status=500,msg=sys.exc_info()[0])
 
+@app.route('/failure_matrix',methods=["POST"])
+def failure_matrix():
+    '''
+    run every flow through every single and double link failure in one call, and
+    return the flows failing under each
+
+    Request Arguments:
+        session_name: the session to pull previously uploaded data from
+        eval_name:    name of user specified evaluation
+    JSON Arguments (optional):
+        flows:        array of flows to evaluate, all the flows of the session if not given
+        links:        array of links to fail, all the links of the session if not given
+        depth:        the most links failed together, default 2: every link on its own
+                        and every pair of links
+        order:        'gray' to enumerate link combinations so that consecutive ones
+                        differ by a single link, default 'lexicographic'
+    output:
+        output file:  json output with one evaluation per combination of links, named by
+                        its links joined with ',', giving the links and the flows that
+                        fail (failed).  Its failure_matrix entry gives the number of flows,
+                        scenarios and header classes, how many classes were routed in
+                        lockstep (compiled) and the states of their routing table
+    '''
+    sess_file, eval_file, out_file = get_sess_eval_out_path(request)
+
+    form_json = request.get_json(silent=True) or {}
+    depth = form_json.get('depth',2)
+    if type(depth) is not int or depth < 1:
+        return ret_json(False,404,msg='depth should be a positive integer')
+
+    try:
+        ## create the evaluation file and route all the flows through its failures together
+        ctx = result_context(request)
+        run_failure_matrix(sess_file,eval_file,out_file,form_json,ctx)
+        return send_result(request,out_file,ctx)
+    except:
+        print("Error",sys.exc_info()[0])
+        if os.path.exists(eval_file):
+            shutil.rmtree(eval_file)
+        if os.path.exists(out_file):
+            shutil.rmtree(out_file)
+        return ret_json(False,status=500,msg=sys.exc_info()[0])
+
+@app.route('/jobs',methods=["POST"])
+def submit_job():
+    '''
+    run an evaluation in the background rather than while the request waits
+
+    Request Arguments:
+        session_name: the session to pull previously uploaded data from
+        eval_name:    name of user specified evaluation
+    JSON Arguments:
+        kind:         the evaluation to run, named after the endpoint that runs it
+                        inline: 'sherpa', 'switch', 'critf_link', 'critf_switch', 'critf_neigh'
+                        or 'failure_matrix'
+        ...:          the JSON arguments of that endpoint
+    output:
+        job:          identifier of the job, for /jobs/<job>
+    '''
+    sess_file, eval_file, out_file = get_sess_eval_out_path(request)
+
+    form_json = request.get_json()
+    if form_json.get('kind') not in JOB_KINDS:
+        return ret_json(False,400,msg='kind should be one of '+', '.join(JOB_KINDS))
+
+    job_id = job_queue.submit(form_json['kind'],sess_file,eval_file,out_file,form_json,result_form(request))
+    if job_id is None:
+        return ret_json(False,429,msg='too many jobs queued, try again later')
+    return json.dumps({'success':True,'job':job_id}),202,{'ContentType':'application/json'}
+
+@app.route('/jobs/<job_id>',methods=["GET"])
+def job_status(job_id):
+    '''
+    report on a job
+
+    output:
+        job:          the job's kind and state, 'queued', 'running', 'done', 'failed' or
+                        'cancelled', and its progress: the layer of failure combinations
+                        being evaluated and the number of failure scenarios evaluated
+    '''
+    status = job_queue.status(job_id)
+    if status is None:
+        return ret_json(False,404,msg='Job does not exist')
+    return json.dumps({'success':True,'job':status}),200,{'ContentType':'application/json'}
+
+@app.route('/jobs/<job_id>',methods=["DELETE"])
+def cancel_job(job_id):
+    '''
+    cancel a job.  A running job stops at its next failure scenario
+    '''
+    state = job_queue.cancel(job_id)
+    if state is None:
+        return ret_json(False,404,msg='Job does not exist')
+    return ret_json(True,status=200)
+
+@app.route('/jobs/<job_id>/result',methods=["GET"])
+def job_result(job_id):
+    '''
+    fetch the output of a finished job from the session's results folder
+
+    output:
+        output file:  json output of experiment ran on evaluation
+    '''
+    state, out_file, ctx = job_queue.result(job_id)
+    if state is None:
+        return ret_json(False,404,msg='Job does not exist')
+    if state != 'done':
+        return ret_json(False,409,msg='Job is '+state)
+    return send_result(request,out_file,ctx)
+
+@app.route('/cache_stats',methods=["GET"])
+def cache_stats():
+    '''
+    report on the cache of built networks, and on the cache of results
+
+    output:
+        network_cache: number of networks held and the bytes of their files, with the
+                       hits, misses and evictions since the server started
+        result_cache:  hits, misses and evictions of evaluation outputs since the server started
+    '''
+    return json.dumps({'success':True,'network_cache':network_cache.stats(),
+                       'result_cache':result_cache.stats()}),200,{'ContentType':'application/json'}
+
 @app.route('/evals',methods=["GET"])
 def get_evals():
     '''
@@ -423,8 +996,9 @@ def rm_sess():
         session_n = os.path.join(uploads_dir,sess)
         if not os.path.exists(session_n):
             return ret_json(False,400,msg='Session does not exist')
-        ## delete the folder
+        ## delete the folder, and drop the session's network from memory
         shutil.rmtree(session_n)
+        network_cache.invalidate(session_n)
         # 
         return ret_json(True,status=200)
     except:
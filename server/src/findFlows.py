@@ -19,49 +19,24 @@ import io
 import shutil
 import json
 import copy
+import time
+import multiprocessing
 
+from .              import sherpa
 from .makeEvals      import mineLinkDefs
 from collections    import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from .utils.network  import buildNetwork
 from .utils.flow     import Flow, cleanUp
 from .utils.ipn      import IPValues, inIPFormat
-from .utils.rule     import RuleNewlySeen, MatchNewlySeen, ActionNewlySeen 
-from .utils.linkstate  import buildLinkState, saveLinkState
-
-### global variables
-topo_file  = ''
-rules_file = ''
-flows_file = ''
-output_file = ''
-session_file = ''
-switch_file = ''
-
-flowsDict  = {}
-linkState = {}
-failedToRoute = []
-minimum_hops = 0
-cmd_str      = ''
-
-def resetGlobalVariables():
-    global topo_file, rules_file, flows_file, output_file, session_file, switch_file
-    global flowsDict, linkState, failedToRoute, minimum_hops, cmd_str
-
-    topo_file  = ''
-    rules_file = ''
-    flows_file = ''
-    output_file = ''
-    session_file = ''
-    switch_file = ''
-
-    flowsDict  = {}
-    linkState = {}
-    failedToRoute = []
-    minimum_hops = 0
-    cmd_str      = ''
+from .utils.rule     import NewlySeen
+from .utils.linkstate  import buildLinkState, saveLinkState, LinkState
+from .utils.switch   import DiscoveryMemo
+from .utils.flowstore import writeFlowStore, storePath
 
-    MatchNewlySeen = set()
-    RuleNewlySeen = set()
-    ActionNewlySeen = set()
+### everything a run of findFlows uses is local to it, as sessions may be uploaded concurrently;
+### the only module-level state is discoveryNetwork, set once in each worker process
+###
 
 def readTopoFile( topo_file ):
     try:
@@ -157,52 +132,122 @@ def makeNeighborMap(switches):
 ### As the packet goes forward it doesn't matter which in_port on the source switch was involved, if any.
 ###   The heavy lifting (including routing etc.) is done at the switch level, calling switch method
 ### discoverFlows.
+###
+###   Discovery from one source doesn't depend on any other, and flows are named after their source, so with
+### workers greater than 1 the sources are shared out over a pool of processes, one task per source.  Each worker
+### has the network, inherited through fork where the platform has it, pickled otherwise, and its own DiscoveryMemo.
+### The flows found from each source are named in the order of the sources, exactly as one process names them.
+###   If timing is a dictionary it is filled with the time discovery took, in total and per worker process.
+###
 
-def findViableFlows( switches, neighborMap, mh = 0):
+def findViableFlows( switches, neighborMap, mh = 0, workers = 1, timing = None):
     results = {}
 
     flowCount = defaultdict(int)
     flow_hdrs = mineRules( switches )
 
+    start = time.time()
+    if workers > 1:
+        discovered, perWorker = discoverParallel( switches, neighborMap, flow_hdrs, mh, workers )
+    else:
+        ### outcomes of the search from each (switch, in_port, header), shared by all launches
+        memo = DiscoveryMemo( switches )
+        discovered = {}
+        for switchId in flow_hdrs:
+            discovered[ switchId ] = discoverFrom( switches, neighborMap, memo, switchId, flow_hdrs[ switchId ], mh )
+        perWorker = { os.getpid(): {'sources':len(flow_hdrs),
+            'flows':sum( len(found) for found in discovered.values() ),'seconds':time.time()-start} }
+
     ### visit every switch
     for switchId in flow_hdrs:
-        switch = switches[ switchId ]
+        for fvars in discovered[ switchId ]:
 
-        ### visit every
-        for (in_port, ip_dscp, nw_dst) in flow_hdrs[ switchId ]:
+            ### the sdn simulator uses a specific form for 
+            ### naming flows.  Create the name, and add the vars structure
+            ### of the flow to the results dictionary indexed by flow name.
+            ###
+            base_name = switchId+'-'+fvars['ndst']
+            pnumber = flowCount[ base_name ]
+            flowCount[ base_name ] += 1
+            dname   = base_name+'-'+str(pnumber)
 
-            ### make the in_port a wildcard for the purposes of matching the flow's entrace
-            flowState = {'nsrc':switchId,'ndst':None,'ip_dscp':ip_dscp,'nw_dst':nw_dst,'dl_type':2048,\
-                'nw_ttl':24, 'in_port':in_port, 'ingress_port':in_port }
+            results[ dname ] = fvars
 
-            flow = Flow( None, flowState )
-            ### ask the switch to launch a search with the identified flow, convey the minimum hop count and
-            ### whether to exclude complex rules or not
-            ###
-            discovered = switch.discoverFlows( flow, in_port, switches, neighborMap)
-           
-            for dflow in discovered:
-                
-                ### if path not long enough for interest, ignore it
-                ###
-                if len(dflow.visited) < mh:
-                    continue
-
-                ### the sdn simulator uses a specific form for 
-                ### naming flows.  Create the name, and add the vars structure
-                ### of the flow to the results dictionary indexed by flow name.
-                ###
-                base_name = switchId+'-'+dflow.vars['ndst']
-                pnumber = flowCount[ base_name ]
-                flowCount[ base_name ] += 1
-                dname   = base_name+'-'+str(pnumber)
-
-                ### add visited list to vars
-                dflow.vars['visited'] = dflow.visited
-                results[ dname ] = dflow.vars
+    if timing is not None:
+        timing['workers'] = max( 1, workers )
+        timing['seconds'] = time.time()-start
+        timing['per_worker'] = list( perWorker.values() )
 
     return results  
 
+### the flows discovered from switchId, launched with each of its templates, as their vars with the visited list added
+###
+def discoverFrom( switches, neighborMap, memo, switchId, templates, mh ):
+    found = []
+    switch = switches[ switchId ]
+
+    ### visit every
+    for (in_port, ip_dscp, nw_dst) in templates:
+
+        ### make the in_port a wildcard for the purposes of matching the flow's entrace
+        flowState = {'nsrc':switchId,'ndst':None,'ip_dscp':ip_dscp,'nw_dst':nw_dst,'dl_type':2048,\
+            'nw_ttl':24, 'in_port':in_port, 'ingress_port':in_port }
+
+        flow = Flow( None, flowState )
+        ### ask the switch to launch a search with the identified flow, convey the minimum hop count and
+        ### whether to exclude complex rules or not
+        ###
+        discovered = switch.discoverFlows( flow, in_port, switches, neighborMap, memo )
+
+        for dflow in discovered:
+
+            ### if path not long enough for interest, ignore it
+            ###
+            if len(dflow.visited) < mh:
+                continue
+
+            ### add visited list to vars
+            dflow.vars['visited'] = dflow.visited
+            found.append( dflow.vars )
+
+    return found
+
+discoveryNetwork = None
+
+def initDiscovery( switches, neighborMap ):
+    global discoveryNetwork
+    discoveryNetwork = ( switches, neighborMap, DiscoveryMemo( switches ) )
+
+def discoverSource( switchId, templates, mh ):
+    switches, neighborMap, memo = discoveryNetwork
+    start = time.time()
+    found = discoverFrom( switches, neighborMap, memo, switchId, templates, mh )
+    return switchId, found, os.getpid(), time.time()-start
+
+### run discoverFrom for every source over a pool of workers processes.  Returns the flows found from each
+### source, and for each worker the number of sources it took, the flows it found and the time it spent on them
+###
+def discoverParallel( switches, neighborMap, flow_hdrs, mh, workers ):
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+
+    discovered = {}
+    perWorker = {}
+    with ProcessPoolExecutor( max_workers=workers, mp_context=context, initializer=initDiscovery,
+                              initargs=(switches, neighborMap) ) as pool:
+        futures = [ pool.submit( discoverSource, switchId, templates, mh ) for switchId, templates in flow_hdrs.items() ]
+        for future in futures:
+            switchId, found, pid, seconds = future.result()
+            discovered[ switchId ] = found
+            worker = perWorker.setdefault( pid, {'sources':0,'flows':0,'seconds':0.0} )
+            worker['sources'] += 1
+            worker['flows'] += len( found )
+            worker['seconds'] += seconds
+
+    return discovered, perWorker
+
 def make_switchDict( switches, linkDefs):
     switchDict = defaultdict(list)
 
@@ -219,16 +264,17 @@ def make_switchDict( switches, linkDefs):
     print(switchDict)
     return switchDict
 
-def findFlows(top_file,rule_file,ipn_file,mh,out_file,sess_file,sw_file):
-    global MatchNewlySeen, RuleNewlySeen, ActionNewlySeen
-   
-    resetGlobalVariables()
- 
+def findFlows(top_file,rule_file,ipn_file,mh,out_file,sess_file,sw_file,workers=1):
+
     #parseArgs(cmd_array)
     output_file = out_file
     session_file = sess_file
     switch_file = sw_file
 
+    ### as always, flows of every length are kept, and no command line is recorded
+    minimum_hops = 0
+    cmd_str      = ''
+
     ### topology dictionary is index by node id (e.g. 'n17') with value equal to a list of other 
     ### node ids of neighbors, where we assume that the order in the list corresponds to port numbers
     ### 1, 2, and so on
@@ -248,7 +294,8 @@ def findFlows(top_file,rule_file,ipn_file,mh,out_file,sess_file,sw_file):
     ### whose integer keys are port numbers and whose value for a port number is the node identity
     ### of a neighbor
     ###
-    switches    = buildNetwork(topoDict, rulesDict, nodeIPs )
+    newlySeen   = NewlySeen()
+    switches    = buildNetwork(topoDict, rulesDict, nodeIPs, newlySeen )
 
     ### Here I take the functions mineLinkDefs to create a switch dictionary that uses the switches node
     ### name as keys, and stores all links in array associated with it
@@ -257,28 +304,12 @@ def findFlows(top_file,rule_file,ipn_file,mh,out_file,sess_file,sw_file):
 
     ### the parsing of the topo and rules files may encounter attributes in the rules that we have not seen
     ### before.   These should be flagged for the developer to include in the code
-    ###   sets RuleNewlySeen, MatchNewlySeen and ActionNewlySeen are modified in utils/rule.py when
-    ### these new attributes are discovered
+    ###   newlySeen collects them, in utils/rule.py, when these new attributes are discovered
     ###
-    newAttributes = False
-    if RuleNewlySeen:
-        print('unknown rule attributes seen in configuration, report to developer', repr(RuleNewlySeen),\
-                file = sys.stderr)
-        newAttributes = True
-
-    if MatchNewlySeen:
-        print('unknown match attributes seen in configuration, report to developer', repr(MatchNewlySeen),\
-                file=sys.stderr)
-        newAttributes = True
-
-    if ActionNewlySeen:
-        print('unknown action attributes seen in configuration, report to developer', repr(ActionNewlySeen),\
-                file=sys.stderr)
-        newAttributes = True
-
-    if newAttributes:
+    if newlySeen.report():
         raise Exception
 
+    linkState = LinkState()
     buildLinkState( switches, linkState )
 
     ### save a pointer to the linkState structure in all the switches
@@ -287,9 +318,11 @@ def findFlows(top_file,rule_file,ipn_file,mh,out_file,sess_file,sw_file):
     ### create a data structure that aids in routing 
     neighborMap = makeNeighborMap( switches )
 
-    ### find all flows with at least 'minimum_hops' hops between switches
+    ### find all flows with at least 'minimum_hops' hops between switches, from the sources shared out
+    ### over 'workers' processes
     ###
-    resultsDict = findViableFlows( switches, neighborMap, mh = minimum_hops )
+    timing = {}
+    resultsDict = findViableFlows( switches, neighborMap, mh = minimum_hops, workers = workers, timing = timing )
   
     ### clean up the flows in resultsDict to remove extraneous attributes
     ###
@@ -299,7 +332,8 @@ def findFlows(top_file,rule_file,ipn_file,mh,out_file,sess_file,sw_file):
     ### record the results to file 
     if output_file:     
         sessionDict = {'command_string':cmd_str,'topo_file':top_file,'rules_file':rule_file,\
-             'ip_file':ipn_file,'flows_file':output_file,'switch_file':switch_file}
+             'ip_file':ipn_file,'flows_file':output_file,'switch_file':switch_file,\
+             'compiled_file':sherpa.compiledPath(session_file),'discovery':timing}
 
         with open(session_file,'w') as sf:
             sstr = json.dumps( sessionDict, indent=4 )
@@ -312,3 +346,10 @@ def findFlows(top_file,rule_file,ipn_file,mh,out_file,sess_file,sw_file):
         with open(switch_file,'w') as swf:
             wstr = json.dumps( switchDict, indent=4 )
             swf.write(wstr)
+
+        ### the flows again, in columns, for readers that look up flows without parsing the flows file,
+        ### see utils/flowstore.py
+        writeFlowStore( storePath( output_file ), resultsDict, switchDict, output_file )
+
+        ### build the network the way sherpa.py does, once, and save it for the evaluations of this session
+        sherpa.compileSession( session_file, sessionDict['compiled_file'] )
@@ -17,21 +17,17 @@ import os
 import io
 import shutil
 import json
+import threading
 #from sets import Set
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from .utils.network import buildNetwork
+from .utils.flowstore import FlowStore, openFlowStore, storePath
+from .utils.flowindex import FlowIndex
 
-topo_file  = ''
-flows_file = ''
-rules_file = ''
-switch_file = ''
-evals_file = ''
-
-n2n = defaultdict(int)
-evalsDict = {}
-outputDict = {}
-
-def wrapUp(outputDict, evalsDict):
+### the evaluations file is named by the caller of each function writing one, never kept at module level,
+### since evaluations of different sessions are made concurrently
+###
+def wrapUp(evals_file, outputDict, evalsDict):
     
     if len(evalsDict):
         outputDict['evaluations'] = evalsDict
@@ -49,6 +45,15 @@ def readFile( fileName, errMessage ):
         os._exit(1)
     return fdict
 
+### the flows of fileName, taken from the flow store written next to it at upload if that is
+### there and up to date, see utils/flowstore.py
+###
+def readFlows( fileName, errMessage ):
+    store = openFlowStore( storePath( fileName ), fileName )
+    if store is not None:
+        return store
+    return readFile( fileName, errMessage )
+
 def make_flowsTable( flowDict ):
     fips = sorted( flowDict )
     flowsTable = []
@@ -103,6 +108,98 @@ def make_linksTable( linkDefs ):
 
     return linkNames, linkTable
 
+### ------- lazy session access -----------
+###
+###   A Session reads each file of a session (topology, rules, flows, switches) only when it is first asked for,
+### and keeps what it read, so every API call touches only the files it needs.   openSession keeps the last
+### SessionCacheSize sessions, by the path of their session file, for the calls that follow; a file is read again
+### if its size or modification time has changed since.   The dictionaries handed out are shared, and must not be
+### modified.
+###
+
+SessionCacheSize = 4
+sessionCache = OrderedDict()
+sessionLock = threading.Lock()
+
+def fileStamp( fileName ):
+    try:
+        st = os.stat( fileName )
+    except OSError:
+        return None
+    return ( st.st_mtime_ns, st.st_size )
+
+class Session:
+    def __init__(self, session_file):
+        self.session_file = session_file
+        self.stamp = fileStamp( session_file )
+        self.session_dict = readFile( session_file, 'Problem reading sessions file '+session_file )
+        self.artifacts = {}
+        self.index = None
+        self.lock = threading.Lock()
+
+    ### the parsed contents of the session's file for name ('topo', 'rules', 'flows' or 'switch')
+    def artifact(self, name, errMessage, read=readFile):
+        fileName = self.session_dict[ name+'_file' ]
+        stamp = fileStamp( fileName )
+        with self.lock:
+            cached = self.artifacts.get( name )
+        if cached is not None and stamp is not None and cached[0] == stamp:
+            return cached[1]
+
+        value = read( fileName, errMessage+' '+fileName )
+        with self.lock:
+            self.artifacts[ name ] = ( stamp, value )
+        return value
+
+    def topoDict(self):
+        return self.artifact( 'topo', 'Problem reading topology file' )['one_hop_neighbor_nodes']
+
+    def rulesDict(self):
+        return self.artifact( 'rules', 'Problem reading rules file' )
+
+    ### a FlowStore, if the session has one, rather than a dictionary
+    def flowsDict(self):
+        return self.artifact( 'flows', 'Problem reading flows file', readFlows )
+
+    def switchNodes(self):
+        return self.artifact( 'switch', 'Problem reading switch file' )
+
+    ### the indexes over the flows, see utils/flowindex.py, built again only if the flows are read again
+    def flowIndex(self):
+        flowsDict = self.flowsDict()
+        with self.lock:
+            index = self.index
+        if index is not None and index.flows is flowsDict:
+            return index
+
+        index = FlowIndex( flowsDict )
+        with self.lock:
+            self.index = index
+        return index
+
+    ### the start of an evaluation file: the session block
+    def output(self):
+        output = {}
+        output['session'] = {}
+        output['session'].update( self.session_dict )
+        output['session']['session_file'] = self.session_file
+        return output
+
+def openSession( session_path ):
+    if not os.path.isfile(session_path):
+        print('Session file',session_path,'does not exist', file=sys.stderr )
+        raise ValueError("Session file does not exist")
+
+    stamp = fileStamp( session_path )
+    with sessionLock:
+        session = sessionCache.pop( session_path, None )
+        if session is None or session.stamp != stamp:
+            session = Session( session_path )
+        sessionCache[ session_path ] = session
+        while len(sessionCache) > SessionCacheSize:
+            sessionCache.popitem( last=False )
+    return session
+
 ### functions to run with Sherpa API
 
 def get_flows_rules(session_path):
@@ -110,50 +207,46 @@ def get_flows_rules(session_path):
     This corresponds to api "upload"
     Return the flows and links for the evalution user selection
     '''
-    # parse session path to get session file to get topoDict and flowDict
-    topoDict, flowsDict, switchNodes,_ = parseSession(session_path)
-    # then create linkDefs, then create links and flows
-    linkDefs = mineLinkDefs(topoDict)
+    # only the topology, flows and switch files of the session are needed
+    session = openSession(session_path)
+    linkNames = get_links(session_path)
 
-    linkNames, _ = make_linksTable(linkDefs)
+    flowsDict = session.flowsDict()
+    if isinstance(flowsDict, FlowStore):
+        flowsDict = flowsDict.asDict()
     
-    return linkNames, flowsDict, switchNodes
+    return linkNames, flowsDict, session.switchNodes()
 
-def parseSession(session_path,eval_path=''):
+def get_links(session_path):
     '''
-    Modification of parseArgs function to parse session_path file to
-    get topoDict and flowsDict
+    Return the names of the links of the session's topology
     '''
-    global evals_file
-    session_file = session_path
-    if not os.path.isfile(session_file):
-        print('Session file',session_file,'does not exist', file=sys.stderr )
-        raise ValueError("Session file does not exist")
-
-    session_dict = readFile( session_file, 'Problem reading sessions file '+session_file )
-
-    topo_file = session_dict['topo_file']
-    fullTopoDict = readFile( topo_file, 'Problem reading topology file '+topo_file )
-    topoDict = fullTopoDict['one_hop_neighbor_nodes']
-
-    rules_file = session_dict['rules_file']
-    rulesDict = readFile( rules_file, 'Problem reading rules file '+rules_file)
+    # create linkDefs, then create links
+    linkDefs = mineLinkDefs(openSession(session_path).topoDict())
 
-    flows_file = session_dict['flows_file']
-    flowsDict = readFile( flows_file, 'Problem reading flows file '+flows_file)
+    linkNames, _ = make_linksTable(linkDefs)
+    return linkNames
 
-    switch_file = session_dict['switch_file']
-    switchNodes = readFile( switch_file, 'Problem reading switch file'+switch_file)
-    
-    evals_file = eval_path
+def select_flows(session_path,filters,cursor=0,limit=None,fields=None,exclude=()):
+    '''
+    This corresponds to api "load" given filters or a page size.
+    Return a page of the flows meeting filters (see FlowIndex.select), from the
+    flow with id cursor on, projected to fields less exclude, along with the
+    number of flows meeting filters and the cursor of the next page
+    '''
+    index = openSession(session_path).flowIndex()
+    selected = index.select(**filters)
+    flows, next_cursor = index.page(selected,cursor,limit,fields,exclude)
+    return flows, len(selected), next_cursor
 
-    output = {}
+def parseSession(session_path,eval_path=''):
+    '''
+    Modification of parseArgs function to parse session_path file to
+    get topoDict and flowsDict.  eval_path is no longer used
+    '''
+    session = openSession(session_path)
 
-    output['session'] = {}
-    output['session'].update( session_dict )
-    output['session']['session_file'] = session_file
-    
-    return topoDict, flowsDict, switchNodes, output
+    return session.topoDict(), session.flowsDict(), session.switchNodes(), session.output()
 
 def switch2Link(session_path,switch):
     '''
@@ -161,22 +254,31 @@ def switch2Link(session_path,switch):
     selected switches
     '''
     links_set = set()
-    # parse session path to get session file to get topoDict and flowDict
-    _,_, switchNodes,_ = parseSession(session_path)
+    # only the switch file of the session is needed
+    switchNodes = openSession(session_path).switchNodes()
     for sn in switch:
         links_set.update(switchNodes[sn])
     return list(links_set)
 
 def findPath(flow, links, flowsDict, switchNodes):
+    # a flow store has the links between the nodes of the flow's path, named as in switchNodes
+    if isinstance(flowsDict, FlowStore):
+        links = set(links)
+        idx = flowsDict.index(flow)
+        visited = flowsDict.visitedAt(idx)
+        return [hop for cur_n, nxt_n, hop in zip(visited, visited[1:], flowsDict.hopsAt(idx)) \
+            if cur_n+'-'+nxt_n in links or nxt_n+'-'+cur_n in links]
+
     visited_links = []
     flow_desc = flowsDict[flow]
     visited = flow_desc["visited"]
     visit_d = len(visited)
     cur_n = visited[0]
+    links = set(links)
     for i in range(1,visit_d):
         nxt_n = visited[i]
         # add flow to list
-        sw_link = switchNodes[cur_n]
+        sw_link = set(switchNodes[cur_n])
         # its either in the form cn-nn or nn-cn, make sure the visited link is in the 
         # user selected links
         if str(cur_n+'-'+nxt_n) in links or str(nxt_n+'-'+cur_n) in links:
@@ -194,21 +296,30 @@ def make_Eval(session_path,eval_path,flows,links,param=None,type_m=None):
     This corresponds to 
     Take in user selected flows and rules
     '''
-    topoDict, flowsDict,switchNodes ,outputDict = parseSession(session_path,eval_path) 
+    # the session files are only read as the type of evaluation needs them
+    session = openSession(session_path)
+    outputDict = session.output()
     evalDic = {}
     if type_m == "link":
         outputDict['parameters'] = param
+        flowsDict = session.flowsDict()
+        switchNodes = None if isinstance(flowsDict, FlowStore) else session.switchNodes()
         for f in flows:
             visited_links = findPath(f, links,flowsDict,switchNodes)
             evalDic[f] = {'links':links,"visited":visited_links}
     elif type_m == "switch":
         outputDict['parameters'] = param
+        flowsDict = session.flowsDict()
         for f in flows:
             evalDic[f] = {'switches':links,"visited":flowsDict[f]["visited"]}
     elif type_m == "neigh":
         # make sure "hops" is included in the parameters
         outputDict['parameters'] = param
         evalDic['switches'] = links
+    elif type_m == "matrix":
+        # "depth" in the parameters is the most links failed together
+        outputDict['parameters'] = param
+        evalDic['matrix'] = {'flows':flows,'links':links}
     else:
         evalDic[1] = {'flows':flows,'links':links}
-    wrapUp(outputDict,evalDic)
+    wrapUp(eval_path,outputDict,evalDic)
@@ -24,42 +24,69 @@ import shutil
 import json
 import copy
 import math
+import pickle
 
 from .                import sherpa_exp
 from collections      import defaultdict
 from itertools        import combinations
 from .utils.network   import buildNetwork
 from .utils.ipn       import IPValues, inIPFormat
-from .utils.rule      import RuleNewlySeen, MatchNewlySeen, ActionNewlySeen 
-from .utils.linkstate import buildLinkState, saveLinkState
-
-### global variables
-topo_file  = ''
-rules_file = ''
-flows_file = ''
-ip_file = ''
-evals_file  = ''
-output_file = ''
-switch_file = ''
-switchDict = {}
-flowsDict = {}
-failedToRoute = []
-
-
-def resetGlobalVariables():
-    global topo_file, rules_file, flows_file, ip_file, evals_file, output_file, switch_file
-    global switchDict, flowsDict,failedToRoute
-
-    topo_file  = ''
-    rules_file = ''
-    flows_file = ''
-    ip_file = ''
-    evals_file  = ''
-    output_file = ''
-    switch_file = ''
-    switchDict = {}
-    flowsDict = {}
-    failedToRoute = []
+from .utils.rule      import NewlySeen
+from .utils.linkstate import buildLinkState, saveLinkState, LinkState
+from .utils.flowstore import openFlowStore, storePath
+from .utils.resultwriter import ResultWriter, chooseForm
+from .utils.headerclass import headerClasses
+
+### the state of one run: the paths of the files it reads and writes, the flows and switches they describe,
+### the flow headers and verdicts of sherpa_exp's verdict cache, and the flows that don't route at all.
+### Every entry point makes its own SherpaContext and hands it down as ctx, so runs in different threads,
+### or processes, share nothing
+###
+class SherpaContext:
+    def __init__(self):
+        self.topo_file  = ''
+        self.rules_file = ''
+        self.flows_file = ''
+        self.ip_file = ''
+        self.evals_file  = ''
+        self.output_file = ''
+        self.switch_file = ''
+        self.switchDict = {}
+        self.flowsDict = {}
+        self.flowHeaders = {}
+        self.flowVerdicts = {}
+        ### representative of the header class of each flow, see utils/headerclass.py
+        self.flowClasses = {}
+        self.verdictLookups = 0
+        self.verdictHits = 0
+        self.failedToRoute = []
+        self.newlySeen = NewlySeen()
+
+        ### key of the network in the caller's cache, see build_network
+        self.networkKey = None
+
+        ### progress of the run, for callers watching it from another thread: the layer of combinations
+        ### being evaluated (the number of elements failed together) and the failure scenarios evaluated so
+        ### far.  Setting cancelled stops the run at its next scenario, with sherpa_exp.RunCancelled
+        self.layer = 0
+        self.scenarios = 0
+        self.cancelled = False
+
+        ### if set, called as onLayer(name, layer, probability, tail, bound) each time a layer is added to the
+        ### metric of a flow (of a switch, for the neighborhood metric): the partial probability, the Poisson
+        ### probability of more failures than the layers so far, which bounds what is still to come, and the
+        ### 'uppper bound' layer once the tolerance is reached
+        self.onLayer = None
+
+        ### how the output file is written, see utils/resultwriter.py: 'auto', 'pretty', 'compact' or 'ndjson',
+        ### gzip compressed if outputCompress
+        self.outputForm = 'auto'
+        self.outputCompress = False
+
+        ### with a result cache (see utils/resultcache.py), the key of the run's output, and the layer
+        ### profiles the metric engines take known p_m from, see sherpa_exp.profileKey
+        self.resultKey = None
+        self.pmProfiles = None
 
 def readTopoFile( topo_file ):
     try:
@@ -106,6 +133,15 @@ def readFlowsFile( flows_file ):
 
     return fdict
 
+### the flows of flows_file, taken from the flow store written next to it at upload if that is
+### there and up to date, see utils/flowstore.py
+###
+def readFlows( flows_file ):
+    store = openFlowStore( storePath( flows_file ), flows_file )
+    if store is not None:
+        return store
+    return readFlowsFile( flows_file )
+
 def readEvalsFile( evals_file ):
     edict = {}
     try:
@@ -130,11 +166,10 @@ def readSwitchFile( switch_file):
 
     return sdict
 
-def validateFlows( switches, flowIds, linkState, neighborMap ):
-    global failedToRoute
+def validateFlows( ctx, switches, flowIds, linkState, neighborMap ):
  
     for fId in flowIds:
-        flow_desc = flowsDict[ fId ]
+        flow_desc = ctx.flowsDict[ fId ]
 
         nsrc = flow_desc['nsrc']
         ndst = flow_desc['ndst']
@@ -158,15 +193,16 @@ def validateFlows( switches, flowIds, linkState, neighborMap ):
             raise Exception
 
 
-    ### try to route each flow
+    ### try to route each flow.  This baseline run also records, for each flow, the links its routing
+    ### depends on, see sherpa_exp.runSingleEvaluation
     ###
     valExpDict = {'links':[],'flows': flowIds }
 
-    failedToRoute = sherpa_exp.runSingleEvaluation( valExpDict, switches, linkState, neighborMap )
+    ctx.failedToRoute = sherpa_exp.runSingleEvaluation( ctx, valExpDict, switches, linkState, neighborMap )
 
 
-    if failedToRoute:
-        print('the following flows do not route at all', repr(failedToRoute), file=sys.stderr )
+    if ctx.failedToRoute:
+        print('the following flows do not route at all', repr(ctx.failedToRoute), file=sys.stderr )
 
 ### a link between switches is seen by one switch as a particular port id, and by the other switch
 ### by a potentially different port id.  This function creates a nested dictionary structure which,
@@ -188,23 +224,23 @@ def makeNeighborMap(switches):
             
     return neighborMap
 
-def findFlowsToTest( evalDict, type_m = None ):
+def findFlowsToTest( ctx, evalDict, type_m = None ):
     ff2test = set()
     if type_m == "link" or type_m == "switch":
         for fName, fDict in evalDict['evaluations'].items():
-            if fName not in flowsDict:
+            if fName not in ctx.flowsDict:
                 print('evaluation names flow',fName,'which is not found in the flows file', file=sys.stderr )
 
             ff2test.add( fName )
     elif type_m == "neigh":
-        flows = flowsDict.keys()
+        flows = ctx.flowsDict.keys()
         for fId in flows:
             ff2test.add(fId)
         '''
         ### in the case where we want to specify select flows impacted by a neigborhood of switch failures
         for sName, sDict in evalDict['evaluations'].items():
             for fId in sDict['flows']:
-                if fId not in flowsDict:
+                if fId not in ctx.flowsDict:
                     print('evaluation ',sName,' names flow',fId,'which is not found in the flows file', file=sys.stderr )
 
                 ff2test.add( sName )
@@ -212,152 +248,443 @@ def findFlowsToTest( evalDict, type_m = None ):
     else:
         for evalNum, eDict in evalDict['evaluations'].items():
             for fId in eDict['flows']:
-                if fId not in flowsDict:
+                if fId not in ctx.flowsDict:
                     print('evaluation',evalNum,'names flow',fId,'which is not found in the flows file', file=sys.stderr )
 
                 ff2test.add( fId )
 
     return sorted(list(ff2test))
 
-def sherpa(eval_path,out_path):
-    ## set up the network
-    evalsDict, switches, linkState, neighborMap = build_network(eval_path,out_path)
+### ------- output -----------
+###
+###   The output file is the evaluations file with the results of the evaluations in place of their
+### descriptions and the statistics of the run after them.   It is written by a ResultWriter as the
+### evaluations finish, in the form ctx.outputForm asks for, see utils/resultwriter.py
+###
 
-    ### the resultsDict just adds to each entry in the evalsDict a new attribute 'failed' which maps to a list
-    ### of flow identifiers from the original list that do not survive the link failures
-    ###
-    resultsDict = sherpa_exp.runEvaluations( evalsDict, switches, linkState, neighborMap )
+### a writer for the output file of ctx, started with the entries of evalsDict before its evaluations,
+### of which there are to be count (by default, as many as evalsDict describes)
+###
+def openResults( ctx, evalsDict, count=None ):
+    if count is None:
+        count = len( evalsDict.get('evaluations', {}) )
+    writer = ResultWriter( ctx.output_file, chooseForm( ctx.outputForm, count ), ctx.outputCompress )
 
-    ### overwrite the 'evaluations' part of evalsDict with the results
-    ###
-    evalsDict['evaluations'] = resultsDict
-    
-    ### write back the modified evaluations file
-    ###
-    with open(output_file,'w') as of:
-        estr = json.dumps( evalsDict, indent=4 )
-        of.write(estr)
+    keys = list( evalsDict )
+    cut = keys.index('evaluations') if 'evaluations' in keys else len( keys )
+    writer.begin( { key:evalsDict[key] for key in keys[:cut] } )
+    return writer
+
+### finish the output file of writer with the entries of evalsDict after its evaluations
+###
+def closeResults( writer, evalsDict ):
+    keys = list( evalsDict )
+    cut = keys.index('evaluations') + 1
+    writer.end( { key:evalsDict[key] for key in keys[cut:] } )
+
+### ------- result cache -----------
+###
+###   Given a ResultCache (utils/resultcache.py) a run first looks its output up, under a key hashing the session's
+### files and the normalized evaluations, and if it is there writes it out again, with the session and parameters
+### of this run, instead of running.   Otherwise the metric engines take the p_m of the layers already computed for
+### the session from the cache, and the run stores its output and any new layers when done.
+###
+
+SessionFiles = ('topo_file','rules_file','ip_file','flows_file','switch_file')
+
+### the output of the evaluations of eval_path from result_cache, written to out_path, or None if it has to be run
+###
+def cachedResults( ctx, result_cache, eval_path, out_path, type_m ):
+    evalsDict = readEvalsFile( eval_path )
+    sessionDict = evalsDict['session']
+    digest = result_cache.sessionDigest( [ sessionDict[key] for key in SessionFiles ] )
+    ctx.resultKey = result_cache.resultKey( digest, evalsDict, type_m )
+
+    cached = result_cache.loadResult( sessionDict, ctx.resultKey )
+    if cached is None:
+        ctx.pmProfiles = result_cache.profiles( sessionDict, digest, type_m )
+        return None
+
+    ### the evaluations, and the statistics of the run that computed them, under the header of this one
+    keys = list( cached )
+    cut = keys.index('evaluations')
+    output = { key:value for key, value in evalsDict.items() if key != 'evaluations' }
+    output['evaluations'] = cached['evaluations']
+    for key in keys[cut+1:]:
+        output[ key ] = cached[ key ]
+    output['result_cache'] = {'key':ctx.resultKey, 'hit':True}
+
+    ctx.output_file = out_path
+    with openResults( ctx, output ) as writer:
+        for evalName, result in output['evaluations'].items():
+            writer.add( evalName, result )
+        closeResults( writer, output )
+    return output
+
+### store the output of a run, and the layers its metrics computed, in result_cache
+###
+def storeResults( ctx, result_cache, evalsDict ):
+    result_cache.saveResult( evalsDict['session'], ctx.resultKey, evalsDict )
+    if ctx.pmProfiles is not None:
+        ctx.pmProfiles.save()
+
+def sherpa(eval_path,out_path,cache=None,ctx=None,result_cache=None):
+    ## set up the network
+    ctx = ctx or SherpaContext()
+    if result_cache is not None:
+        cached = cachedResults( ctx, result_cache, eval_path, out_path, None )
+        if cached is not None:
+            return cached
+    evalsDict, switches, linkState, neighborMap = build_network(ctx,eval_path,out_path,cache=cache)
+
+    ### the network goes back to the cache however the run ends
+    try:
+        ### the resultsDict just adds to each entry in the evalsDict a new attribute 'failed' which maps to a list
+        ### of flow identifiers from the original list that do not survive the link failures
+        ###
+        resultsDict = sherpa_exp.runEvaluations( ctx, evalsDict, switches, linkState, neighborMap )
+
+        ### overwrite the 'evaluations' part of evalsDict with the results
+        ###
+        evalsDict['evaluations'] = resultsDict
+
+        ### report how often routing was answered from the switches' next-hop caches
+        evalsDict['next_hop_cache'] = sherpa_exp.nextHopStats( switches )
+        evalsDict['verdict_cache'] = sherpa_exp.verdictStats(ctx)
+        evalsDict['link_state'] = sherpa_exp.linkStateStats( linkState )
+        if result_cache is not None:
+            evalsDict['result_cache'] = {'key':ctx.resultKey, 'hit':False}
+
+        ### write back the modified evaluations file
+        ###
+        with openResults( ctx, evalsDict ) as writer:
+            for evalName, result in resultsDict.items():
+                writer.add( evalName, result )
+            closeResults( writer, evalsDict )
+    finally:
+        releaseNetwork( ctx, cache, switches, linkState, neighborMap )
+
+    if result_cache is not None:
+        storeResults( ctx, result_cache, evalsDict )
 
     return evalsDict 
 
-def critical_flow(eval_path,out_path,type_m):
+def critical_flow(eval_path,out_path,type_m,cache=None,ctx=None,result_cache=None):
     ## set up the network
-    evalsDict, switches, linkState, neighborMap = build_network(eval_path,out_path,type_m)
+    ctx = ctx or SherpaContext()
+    if result_cache is not None:
+        cached = cachedResults( ctx, result_cache, eval_path, out_path, type_m )
+        if cached is not None:
+            return cached
+    evalsDict, switches, linkState, neighborMap = build_network(ctx,eval_path,out_path,type_m,cache)
 
     results = {}
-    ## generate evals from evalDict to run on sherpa
-    evaluations = sherpa_exp.make_eval_link(evalsDict,type_m)
-    #print(evaluations)
-    ## generate probabilities and run experiment
-    for flowName, combinations in evaluations.items():
-        probability, bound = sherpa_exp.calculate_metric([flowName],combinations,evalsDict,switches,linkState,neighborMap)
-        #print(probability,bound)
-        ## compile it all together
-        if bound != None:
-            result = {'probability':probability,"uppper bound":bound}
+    writer = None
+    pool = None
+    ## the network goes back to the cache however the run ends
+    try:
+        ## the output file is written as the evaluations finish
+        writer = openResults( ctx, evalsDict )
+        ## 'enumerate' routes the flows through every combination of failures, all flows together,
+        ## 'perflow' does the same one flow at a time, 'cutset' computes the same metric from the
+        ## flow's minimal cut sets (falling back to 'enumerate' for a flow that failing more links can
+        ## route again), 'montecarlo' estimates it by sampling
+        method = evalsDict['parameters'].get('method','enumerate')
+        ## the enumerating engines can share scenarios out over 'workers' processes
+        if method in ('enumerate','perflow'):
+            pool = sherpa_exp.makePool(ctx,sherpa_exp.parallel_workers(evalsDict),switches,linkState,neighborMap)
+        if method in ('cutset','montecarlo'):
+            evaluations = {flowName: None for flowName in evalsDict['evaluations']}
+        elif method == 'perflow':
+            ## generate evals from evalDict to run on sherpa
+            evaluations = sherpa_exp.make_eval_link(ctx,evalsDict,linkState,type_m)
         else:
-            result = {'probability':probability}
-        results[flowName] = {}
-        results[flowName].update( evalsDict['evaluations'][flowName])
-        results[flowName]['result'] = result
-
-    ### overwrite the 'evaluations' part of evalsDict with the results
-    ###
-    evalsDict['evaluations'] = results
+            ## all flows are run through each combination of failures together
+            evaluations = sherpa_exp.batch_metric(ctx,evalsDict,switches,linkState,neighborMap,type_m,pool)
+        #print(evaluations)
+        ## generate probabilities and run experiment
+        for flowName, combinations in evaluations.items():
+            if method == 'montecarlo':
+                result = sherpa_exp.montecarlo_metric(ctx,flowName,evalsDict,switches,linkState,neighborMap,type_m)
+            else:
+                if method == 'cutset':
+                    probability, bound = sherpa_exp.cutset_metric(ctx,flowName,evalsDict,switches,linkState,neighborMap,type_m)
+                elif method == 'perflow':
+                    elements = evalsDict['evaluations'][flowName]['switches' if type_m == "switch" else 'links']
+                    profile = sherpa_exp.profileKey(type_m,flowName,elements)
+                    probability, bound = sherpa_exp.calculate_metric(ctx,[flowName],combinations,evalsDict,switches,linkState,neighborMap,pool,flowName,profile)
+                else:
+                    probability, bound = combinations
+                #print(probability,bound)
+                ## compile it all together
+                if bound != None:
+                    result = {'probability':probability,"uppper bound":bound}
+                else:
+                    result = {'probability':probability}
+            results[flowName] = {}
+            results[flowName].update( evalsDict['evaluations'][flowName])
+            results[flowName]['result'] = result
+            writer.add( flowName, results[flowName] )
+
+        ### overwrite the 'evaluations' part of evalsDict with the results
+        ###
+        evalsDict['evaluations'] = results
+        evalsDict['next_hop_cache'] = sherpa_exp.nextHopStats( switches )
+        evalsDict['verdict_cache'] = sherpa_exp.verdictStats(ctx)
+        evalsDict['link_state'] = sherpa_exp.linkStateStats( linkState )
+        if result_cache is not None:
+            evalsDict['result_cache'] = {'key':ctx.resultKey, 'hit':False}
+
+        ### finish the output file
+        ###
+        closeResults( writer, evalsDict )
+    except:
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        releaseNetwork( ctx, cache, switches, linkState, neighborMap )
 
-    ### write back the modified evaluations file
-    ###
-    with open(output_file,'w') as of:
-        estr = json.dumps( evalsDict, indent=4 )
-        of.write(estr)
+    if result_cache is not None:
+        storeResults( ctx, result_cache, evalsDict )
 
     return evalsDict
 
-def critical_flow_neigh(eval_path,out_path):
+def critical_flow_neigh(eval_path,out_path,cache=None,ctx=None,result_cache=None):
     ## set up the network
-    evalsDict, switches, linkState, neighborMap = build_network(eval_path,out_path,"neigh")
+    ctx = ctx or SherpaContext()
+    if result_cache is not None:
+        cached = cachedResults( ctx, result_cache, eval_path, out_path, "neigh" )
+        if cached is not None:
+            return cached
+    evalsDict, switches, linkState, neighborMap = build_network(ctx,eval_path,out_path,"neigh",cache)
 
     results = {}
-    # generate evals from evalDict to run on sherpa
-    evaluations = sherpa_exp.make_eval_neigh(evalsDict)
-    #print(evaluations)
-    ## generate probabilities and run experiment
-    for switch, dict_fl in evaluations.items():
-        probability, bound = sherpa_exp.calculate_metric(dict_fl['flows'],[dict_fl['links']],evalsDict,switches,linkState,neighborMap)
-
-        if bound != None:
-            result = {'probability':probability,"uppper bound":bound}
-        else:
-            result = {'probability':probability}
-        results[switch] = {'result': result}
-
-    ### overwrite the 'evaluations' part of evalsDict with the results
-    ###
-    evalsDict['evaluations'] = results
+    writer = None
+    pool = None
+    ## the network goes back to the cache however the run ends
+    try:
+        # generate evals from evalDict to run on sherpa
+        evaluations = sherpa_exp.make_eval_neigh(ctx,evalsDict,linkState)
+        ## the output file is written as the evaluations finish
+        writer = openResults( ctx, evalsDict, len(evaluations) )
+        #print(evaluations)
+        ## generate probabilities and run experiment
+        method = evalsDict['parameters'].get('method','enumerate')
+        if method != 'montecarlo':
+            pool = sherpa_exp.makePool(ctx,sherpa_exp.parallel_workers(evalsDict),switches,linkState,neighborMap)
+        for switch, dict_fl in evaluations.items():
+            if method == 'montecarlo':
+                result = sherpa_exp.montecarlo_neigh(ctx,dict_fl['flows'],dict_fl['links'],evalsDict,switches,linkState,neighborMap)
+                results[switch] = {'result': result}
+                writer.add( switch, results[switch] )
+                continue
+
+            profile = sherpa_exp.profileKey("neigh",switch,[evalsDict['parameters']['hops']])
+            probability, bound = sherpa_exp.calculate_metric(ctx,dict_fl['flows'],[dict_fl['links']],evalsDict,switches,linkState,neighborMap,pool,switch,profile)
+
+            if bound != None:
+                result = {'probability':probability,"uppper bound":bound}
+            else:
+                result = {'probability':probability}
+            results[switch] = {'result': result}
+            writer.add( switch, results[switch] )
+
+        ### overwrite the 'evaluations' part of evalsDict with the results
+        ###
+        evalsDict['evaluations'] = results
+        evalsDict['next_hop_cache'] = sherpa_exp.nextHopStats( switches )
+        evalsDict['verdict_cache'] = sherpa_exp.verdictStats(ctx)
+        evalsDict['link_state'] = sherpa_exp.linkStateStats( linkState )
+        if result_cache is not None:
+            evalsDict['result_cache'] = {'key':ctx.resultKey, 'hit':False}
+
+        ### finish the output file
+        ###
+        closeResults( writer, evalsDict )
+    except:
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        releaseNetwork( ctx, cache, switches, linkState, neighborMap )
 
-    ### write back the modified evaluations file
-    ###
-    with open(output_file,'w') as of:
-        estr = json.dumps( evalsDict, indent=4 )
-        of.write(estr)
+    if result_cache is not None:
+        storeResults( ctx, result_cache, evalsDict )
 
     return evalsDict
 
+def failure_matrix(eval_path,out_path,cache=None,ctx=None,result_cache=None):
+    ## set up the network
+    ctx = ctx or SherpaContext()
+    if result_cache is not None:
+        cached = cachedResults( ctx, result_cache, eval_path, out_path, "matrix" )
+        if cached is not None:
+            return cached
+    evalsDict, switches, linkState, neighborMap = build_network(ctx,eval_path,out_path,cache=cache)
 
-### functions to initialize the Sherpa api
-def build_network(eval_path,out_path,type_m=None):
-    global topo_file, rules_file, flows_file, ip_file, evals_file, switch_file
-    global flowsDict, switchDict
+    results = {}
+    writer = None
+    ## the network goes back to the cache however the run ends
+    try:
+        ## every combination of 1 to 'depth' of the links is a failure scenario, and all the flows are
+        ## routed through all of them together, see sherpa_exp.failure_matrix
+        parameters = evalsDict.get('parameters') or {}
+        matrixDict = evalsDict['evaluations']['matrix']
+        flows = sorted( matrixDict['flows'] )
+        scenarios, masks = sherpa_exp.failureScenarios( matrixDict['links'], parameters.get('depth',2), linkState,
+            parameters.get('order',"lexicographic") )
+        stats = {'flows':len(flows), 'scenarios':len(scenarios)}
+        failed = sherpa_exp.failure_matrix( ctx, flows, masks, switches, linkState, neighborMap, stats )
+
+        ### each scenario, named by its links, gets the list of flows that do not survive it
+        ###
+        writer = openResults( ctx, evalsDict, len(scenarios) )
+        for column, links in enumerate( scenarios ):
+            scenarioName = ','.join( links )
+            results[ scenarioName ] = {'links':links, 'failed':[ flows[row] for row in failed[:,column].nonzero()[0].tolist() ]}
+            writer.add( scenarioName, results[ scenarioName ] )
+
+        evalsDict['evaluations'] = results
+        evalsDict['failure_matrix'] = stats
+        evalsDict['next_hop_cache'] = sherpa_exp.nextHopStats( switches )
+        evalsDict['verdict_cache'] = sherpa_exp.verdictStats(ctx)
+        evalsDict['link_state'] = sherpa_exp.linkStateStats( linkState )
+        if result_cache is not None:
+            evalsDict['result_cache'] = {'key':ctx.resultKey, 'hit':False}
+
+        ### finish the output file
+        ###
+        closeResults( writer, evalsDict )
+    except:
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        releaseNetwork( ctx, cache, switches, linkState, neighborMap )
 
-    resetGlobalVariables()
-    
-    parseArgs_exp(eval_path,out_path)
+    if result_cache is not None:
+        storeResults( ctx, result_cache, evalsDict )
 
-    ### if the evaluation file has a 'session' block, that block contains file path descriptors
-    ### for the topology, rules, ip addresses, and flows. Use these if present, but report
-    ### variation from those placed on the command line
-    ###
-    evalsDict  = readEvalsFile( evals_file )
-    if 'session' in evalsDict:
-        sessionDict = evalsDict['session']
-        if topo_file != sessionDict['topo_file']:
-            print('topology file in evaluation\'s session block', sessionDict['topo_file'],'varies from command line', \
-                topo_file, file=sys.stderr )
-            print('\t Using path-name from session block', file=sys.stderr )
-            topo_file = sessionDict['topo_file']
+    return evalsDict
 
-        if rules_file != sessionDict['rules_file']:
-            print('rules file in evaluation\'s session block', sessionDict['rules_file'],'varies from command line', \
-                rules_file, file=sys.stderr )
-            print('\t Using path-name from session block', file=sys.stderr )
-            rules_file = sessionDict['rules_file']
 
-        if ip_file != sessionDict['ip_file']:
-            print('ip mapping file in evaluation\'s session block', sessionDict['ip_file'],'varies from command line', \
-                ip_file, file=sys.stderr )
-            print('\t Using path-name from session block', file=sys.stderr )
-            ip_file = sessionDict['ips_file']
+### functions to initialize the Sherpa api
+### ------- compiled session -----------
+###
+###   At upload the network of a session is built once and written, pickled, to a compiled session file next to
+### session.json: the switches with their sorted rule tables and classifiers, the link state with its link ids, the
+### neighbor map, the flows and switch tables, the header classes of the flows, and the baseline verdict of every
+### flow from validateFlows.
+### build_network loads it instead of parsing the json files and rebuilding the network.   The file records the
+### size and modification time of the files it was built from, and is ignored, and the network rebuilt from the
+### files, if any of them has changed since.
+###
 
-        if flows_file != sessionDict['flows_file']:
-            print('flows file in evaluation\'s session block', sessionDict['flows_file'],'varies from command line', \
-                flows_file, file=sys.stderr )
-            print('\t Using path-name from session block', file=sys.stderr )
-            flows_file = sessionDict['flows_file']
+CompiledFormat = 2
+
+def sourceStamps( ctx ):
+    stamps = {}
+    for path in (ctx.topo_file, ctx.rules_file, ctx.ip_file, ctx.flows_file, ctx.switch_file):
+        st = os.stat( path )
+        stamps[ path ] = ( st.st_mtime_ns, st.st_size )
+
+    ### a compiled session holds its flow store by path
+    store_file = storePath( ctx.flows_file )
+    if os.path.isfile( store_file ):
+        st = os.stat( store_file )
+        stamps[ store_file ] = ( st.st_mtime_ns, st.st_size )
+    return stamps
+
+def compiledPath( session_file ):
+    return os.path.join( os.path.dirname( session_file ), 'session.pkl' )
+
+def compileSession( session_file, compiled_file ):
+    ctx = SherpaContext()
+    sessionDict = readEvalsFile( session_file )
+    ctx.topo_file = sessionDict['topo_file']
+    ctx.rules_file = sessionDict['rules_file']
+    ctx.flows_file = sessionDict['flows_file']
+    ctx.ip_file = sessionDict['ip_file']
+    ctx.switch_file = sessionDict['switch_file']
+
+    switches, linkState, neighborMap = buildFromFiles( ctx )
+    validateFlows( ctx, switches, sorted( ctx.flowsDict ), linkState, neighborMap )
+
+    compiled = networkState( ctx, switches, linkState, neighborMap )
+    compiled['format'] = CompiledFormat
+    compiled['sources'] = sourceStamps( ctx )
+
+    ### write to a temporary file first so a reader never sees a partial file
+    tmp_file = compiled_file + '.tmp'
+    with open(tmp_file,'wb') as cf:
+        pickle.dump( compiled, cf, protocol=pickle.HIGHEST_PROTOCOL )
+    os.replace( tmp_file, compiled_file )
+
+def loadCompiledSession( ctx, compiled_file ):
+    if not os.path.isfile( compiled_file ):
+        return None
+    try:
+        with open(compiled_file,'rb') as cf:
+            compiled = pickle.load( cf )
+        if compiled['format'] != CompiledFormat or compiled['sources'] != sourceStamps( ctx ):
+            return None
+    except Exception:
+        print('compiled session', compiled_file, 'not usable, building the network from its files', file=sys.stderr )
+        return None
+
+    return adoptNetwork( ctx, compiled )
+
+### the built network as a dictionary: the switches, linkState and neighborMap, with the parts
+### of the context that go with them
+###
+def networkState( ctx, switches, linkState, neighborMap ):
+    return {'switches':switches, 'linkState':linkState, 'neighborMap':neighborMap,
+            'flowsDict':ctx.flowsDict, 'switchDict':ctx.switchDict,
+            'flowHeaders':ctx.flowHeaders, 'flowVerdicts':ctx.flowVerdicts, 'flowClasses':ctx.flowClasses}
+
+### make a network given by networkState the one of ctx
+###
+def adoptNetwork( ctx, state ):
+    ctx.flowsDict = state['flowsDict']
+    ctx.switchDict = state['switchDict']
+    ctx.flowHeaders = state['flowHeaders']
+    ctx.flowVerdicts = state['flowVerdicts']
+    ctx.flowClasses = state['flowClasses']
+
+    ### the statistics reported with the results count this run only
+    linkState = state['linkState']
+    linkState.scenarios = 0
+    linkState.flips = 0
+    for switch in state['switches'].values():
+        switch.cacheHits = 0
+        switch.cacheMisses = 0
+
+    return state['switches'], linkState, state['neighborMap']
+
+### read the topology, rules, ip, flows and switch files named by ctx and build the network
+### from them.  Sets ctx.flowsDict and ctx.switchDict
+###
+def buildFromFiles( ctx ):
 
     ### topology dictionary is index by node id (e.g. 'n17') with value equal to a list of other 
     ### node ids of neighbors, where we assume that the order in the list corresponds to port numbers
     ### 1, 2, and so on
-    topoDict  = readTopoFile( topo_file )
+    topoDict  = readTopoFile( ctx.topo_file )
 
     ### rules file has one key 'nodes', which leads to a dictionary indexed by node id (e.g. 'n17')
     ### which leads to a dictionary with a mysterious single key which is a numerical code of some kind,
     ### which leads to a list of dictionaries, each of which describes a rule
-    rulesDict = readRulesFile( rules_file )
+    rulesDict = readRulesFile( ctx.rules_file )
 
     ### the ip file describes IP addresses associated with the switches.  The dictionary is
     ### indexed by the node id, maps to a list of CIDR addresses
     ###
-    nodeIPs   = readIPFile( ip_file )
+    nodeIPs   = readIPFile( ctx.ip_file )
 
     ### the format of a flows file is a dictionary indexed by a code for a flow 
     ### comprised of srcId-dstId-number, where srcId is the id of the node which is the source,
@@ -376,43 +703,29 @@ def build_network(eval_path,out_path,type_m=None):
     ### nw_dst   = IP address at destination
     ### ttl      = time-to-live counter, decremented on passage through switch if so directed. Flow stops when
     ###              counter expires to zero
-    flowsDict = readFlowsFile( flows_file )
+    ###
+    ### the flows come from the flow store written at upload when there is one, a read-only mapping
+    ### with the same flow dictionaries
+    ctx.flowsDict = readFlows( ctx.flows_file )
 
-    ### this sets the _global_ variable switchDict to hold a dicitonary of switches in the network
+    ### this sets ctx.switchDict to hold a dicitonary of switches in the network
     ### that maps the switch node as the keys to the list of links connected to that switch as the value
-    switchDict = readSwitchFile( switch_file)
+    ctx.switchDict = readSwitchFile( ctx.switch_file)
 
     ### switches is a dictionary indexed by switch (node) id, each mapped to a dictionary
     ### whose integer keys are port numbers and whose value for a port number is the node identity
     ### of a neighbor
     ###
-    switches = buildNetwork(topoDict, rulesDict, nodeIPs )
+    switches = buildNetwork(topoDict, rulesDict, nodeIPs, ctx.newlySeen )
 
     ### the parsing of the topo and rules files may encounter attributes in the rules that we have not seen
     ### before.   These should be flagged for the developer to include in the code
-    ###   sets RuleNewlySeen, MatchNewlySeen and ActionNewlySeen are modified in utils/rule.py when
-    ### these new attributes are discovered
+    ###   ctx.newlySeen collects them, in utils/rule.py, when these new attributes are discovered
     ###
-    newAttributes = False
-    if RuleNewlySeen:
-        print('unknown rule attributes seen in configuration, report to developer', repr(RuleNewlySeen),\
-            file = sys.stderr)
-        newAttributes = True
-
-    if MatchNewlySeen:
-        print('unknown match attributes seen in configuration, report to developer', repr(MatchNewlySeen),\
-            file = sys.stderr)
-        newAttributes = True
-
-    if ActionNewlySeen:
-        print('unknown action attributes seen in configuration, report to developer', repr(ActionNewlySeen),\
-            file = sys.stderr )
-        newAttributes = True
-
-    if newAttributes:
+    if ctx.newlySeen.report():
         raise Exception
 
-    linkState = {}
+    linkState = LinkState()
     buildLinkState( switches, linkState )
 
     ### save a pointer to the linkState structure in all the switches
@@ -421,42 +734,124 @@ def build_network(eval_path,out_path,type_m=None):
     ### create a data structure that aids in routing 
     neighborMap = makeNeighborMap( switches )
 
-    flowsToTest = findFlowsToTest( evalsDict,type_m=type_m)
+    ### flows no rule tells apart are routed once for all of them
+    ctx.flowClasses = headerClasses( switches, ctx.flowsDict )
+
+    return switches, linkState, neighborMap
+
+def build_network(ctx,eval_path,out_path,type_m=None,cache=None):
+    parseArgs_exp(ctx,eval_path,out_path)
+
+    ### if the evaluation file has a 'session' block, that block contains file path descriptors
+    ### for the topology, rules, ip addresses, and flows. Use these if present, but report
+    ### variation from those placed on the command line
+    ###
+    evalsDict  = readEvalsFile( ctx.evals_file )
+    if 'session' in evalsDict:
+        sessionDict = evalsDict['session']
+        if ctx.topo_file != sessionDict['topo_file']:
+            print('topology file in evaluation\'s session block', sessionDict['topo_file'],'varies from command line', \
+                ctx.topo_file, file=sys.stderr )
+            print('\t Using path-name from session block', file=sys.stderr )
+            ctx.topo_file = sessionDict['topo_file']
+
+        if ctx.rules_file != sessionDict['rules_file']:
+            print('rules file in evaluation\'s session block', sessionDict['rules_file'],'varies from command line', \
+                ctx.rules_file, file=sys.stderr )
+            print('\t Using path-name from session block', file=sys.stderr )
+            ctx.rules_file = sessionDict['rules_file']
+
+        if ctx.ip_file != sessionDict['ip_file']:
+            print('ip mapping file in evaluation\'s session block', sessionDict['ip_file'],'varies from command line', \
+                ctx.ip_file, file=sys.stderr )
+            print('\t Using path-name from session block', file=sys.stderr )
+            ctx.ip_file = sessionDict['ips_file']
+
+        if ctx.flows_file != sessionDict['flows_file']:
+            print('flows file in evaluation\'s session block', sessionDict['flows_file'],'varies from command line', \
+                ctx.flows_file, file=sys.stderr )
+            print('\t Using path-name from session block', file=sys.stderr )
+            ctx.flows_file = sessionDict['flows_file']
+
+    ### the network may be held, built, by the caller's cache (keyed by the files it is built from), or
+    ### a session compiled at upload may hold it, see compileSession.   A network taken from the cache
+    ### is this run's alone until releaseNetwork hands it back
+    ###
+    network = None
+    if cache is not None:
+        ctx.networkKey = tuple( sorted( sourceStamps( ctx ).items() ) )
+        network = cache.get( ctx.networkKey )
+        if network is not None:
+            network = adoptNetwork( ctx, network )
+
+    if network is None:
+        if 'session' in evalsDict and evalsDict['session'].get('compiled_file'):
+            network = loadCompiledSession( ctx, evalsDict['session']['compiled_file'] )
+        if network is None:
+            network = buildFromFiles( ctx )
+    switches, linkState, neighborMap = network
+
+    flowsToTest = findFlowsToTest( ctx, evalsDict,type_m=type_m)
 
     ### make sure the flows to be tested have what they need to have in their description, and
-    ### that without link loss the flows can route
+    ### that without link loss the flows can route.  An evaluation failing this still hands the
+    ### network back
     ###
-    validateFlows( switches, flowsToTest, linkState, neighborMap )
+    try:
+        validateFlows( ctx, switches, flowsToTest, linkState, neighborMap )
+    except:
+        releaseNetwork( ctx, cache, switches, linkState, neighborMap )
+        raise
 
     return evalsDict, switches, linkState, neighborMap
 
-def parseArgs_exp(eval_path,out_path):
-    global output_file, evals_file, topo_file, rules_file, flows_file, ip_file, switch_file
-    output_file = out_path
-    evals_file = eval_path
+### hand the network of a run to the cache it may be taken from by the next, whether the run finished
+### or not: the caches of the network only hold outcomes fully computed, and a run stopped part way
+### may only have left the switches tracing the links they consult
+###
+def releaseNetwork( ctx, cache, switches, linkState, neighborMap ):
+    if cache is None:
+        return
+    linkState.tracing = False
+    cache.put( ctx.networkKey, networkState( ctx, switches, linkState, neighborMap ),
+        sum( size for path, (mtime, size) in ctx.networkKey ) )
+
+def parseArgs_exp(ctx,eval_path,out_path):
+    ctx.output_file = out_path
+    ctx.evals_file = eval_path
     with open(eval_path,'r') as ep:
         eval_args = json.load(ep)
         sessionDict = eval_args['session']
-        topo_file = sessionDict['topo_file']
-        rules_file = sessionDict['rules_file']
-        flows_file = sessionDict['flows_file']
-        ip_file = sessionDict['ip_file']
-        switch_file = sessionDict['switch_file']
+        ctx.topo_file = sessionDict['topo_file']
+        ctx.rules_file = sessionDict['rules_file']
+        ctx.flows_file = sessionDict['flows_file']
+        ctx.ip_file = sessionDict['ip_file']
+        ctx.switch_file = sessionDict['switch_file']
 
 ### backend calls these functions to run experiments
-def run_exp(eval_path,out_path):
+def run_exp(eval_path,out_path,cache=None,ctx=None,result_cache=None):
     '''
-    Run SDN flow evaluation given eval json
+    Run SDN flow evaluation given eval json.  cache, if given, holds networks
+    already built, see build_network.  ctx, if given, is the SherpaContext
+    to run in, through which the caller can follow and cancel the run.
+    result_cache, if given, is the ResultCache to look the output up in and keep it in
     '''
     # run a modified parseArgs
     # then run sherpa function
-    sherpa(eval_path,out_path)
+    sherpa(eval_path,out_path,cache,ctx,result_cache)
 
-def run_critf(eval_path,out_path,type_m="link"):
+def run_critf(eval_path,out_path,type_m="link",cache=None,ctx=None,result_cache=None):
     '''
     Run evaluation for case 1, modified case 1, and modified case 3
     '''
     if type_m == "neigh":
-        critical_flow_neigh(eval_path,out_path) 
+        critical_flow_neigh(eval_path,out_path,cache,ctx,result_cache) 
     else:
-        critical_flow(eval_path,out_path,type_m)
+        critical_flow(eval_path,out_path,type_m,cache,ctx,result_cache)
+
+def run_matrix(eval_path,out_path,cache=None,ctx=None,result_cache=None):
+    '''
+    Run the failure matrix evaluation: the flows failing under every combination of
+    1 to 'depth' of the selected links
+    '''
+    failure_matrix(eval_path,out_path,cache,ctx,result_cache)
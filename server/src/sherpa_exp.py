@@ -7,7 +7,8 @@
 ###
 ### Python based SDN flow Evaluation.   Helper functions to run evaluation metrics on SDN based on formats provided
 ###   by Boeing and evals (created by user). All functions that run evaluations or calculate probabilitist metrics 
-### are stored here. This subfile uses the global variables flowsDict and switchDict provided from sherpa.py.
+### are stored here. The flowsDict, switchDict and verdict cache of a run are reached through the SherpaContext
+### (see sherpa.py) every function is handed as ctx.
 ###
 
 import pdb
@@ -19,103 +20,201 @@ import shutil
 import json
 import copy
 import math
+import numpy
+import multiprocessing
 
-from .                import sherpa
 from collections      import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from itertools        import combinations
+from statistics       import NormalDist
 from .utils.network   import buildNetwork
 from .utils.flow      import Flow
 from .utils.ipn       import IPValues, inIPFormat
-from .utils.rule      import RuleNewlySeen, MatchNewlySeen, ActionNewlySeen 
 from .utils.linkstate import buildLinkState, saveLinkState
 
 ### given a description of the flows to test, the links to fail, the network topology (with rules)
 ### run an evaluation to see which flows do not complete
 ###
-def runSingleEvaluation( evalDict, switches, linkState, neighborMap ):
+###   evalDict['links'] names the links to fail, or is the bit-set of them (see utils/linkstate.py).
+###
+###   A flow's fate depends only on the links whose state the switches consulted while routing it.  Those
+### links, and which of them were failed, are remembered with the flow's verdict in ctx.flowVerdicts, starting
+### with the baseline run of validateFlows.   A flow is only simulated when the evaluation's failed links
+### differ on those links from every remembered case, and the outcome is added to the flow's cases.
+###
+###   Flows whose headers no rule tells apart (see utils/headerclass.py) share their verdicts: each evaluation
+### routes, or looks up, the representative of a class once, and the outcome holds for every member.
+###
+def runSingleEvaluation( ctx, evalDict, switches, linkState, neighborMap ):
 
-    ### reset the linkState structure to have only the links to fail in the failed state
+    ### a run is stopped from outside by setting ctx.cancelled, see sherpa.SherpaContext
+    if ctx.cancelled:
+        raise RunCancelled()
+    ctx.scenarios += 1
 
-    for linkName in linkState:
+    failedLinks = linkState.mask( evalDict['links'] )
 
-        ### a link name being in evalDict['links'] means it is one being failed
-        if linkName in evalDict['links']:
-            linkState[ linkName ] = False
-        else:
-            ### otherwise it is up
-            linkState[ linkName ] = True
+    ### the linkState structure is only set up if some flow actually has to be routed
+    linkStateReady = False
 
-    ### push a pointer to the linkState structure down to each switch for reference during routing
-    for switchName, switch in switches.items():
-        switch.saveLinkState( linkState )
-
-    ### initialize the set of flows that route despite the failures
+    ### initialize the set of flows that route despite the failures, and the verdicts of the
+    ### header classes met so far
     routed = set()
+    verdicts = {}
     
     ### see impact of failed links on the specified flows
     ###
     for flowName in evalDict['flows']:
 
-        fdict = sherpa.flowsDict[ flowName ] 
+        representative = ctx.flowClasses.get( flowName, flowName )
+        if representative not in verdicts:
+            case = lookupVerdict( ctx, representative, failedLinks )
+            if case is None:
 
-        fdict['ttl'] = 24
+                if not linkStateReady:
+                    resetLinkState( failedLinks, switches, linkState )
+                    linkStateReady = True
 
-        ### the Flow structure copies all the attributes of a flow in the flowsDict
-        ### into a 'vars' dictionary in the flow, so references to attributes in the
-        ### actual flow being pushed around is through .vars
-        ###
-        flow     = Flow(flowName, fdict)
-        flow.vars['nw_ttl'] = 24
-
-        ### build the first entry point in the path exploration
-        src      = fdict['nsrc']
-        in_port  = fdict['ingress_port']
-
-        ### to_route will be a stack describing the routing attempts still to be made
-        switch = switches[ src ]
-        to_route = [ (src, in_port, flow) ]
-
-        while len(to_route) > 0:
-            (to_switch, to_port, route_flow) = to_route.pop()
-
-            switch = switches[ to_switch ]
-            
-            ### see if the flow arrives at destination
-            if switch.atDestination( route_flow ):
-                failed = False
-                break
-
-            ### try to route flow through to_switch using ingress port to_port
-            nxt_hop = switch.route( to_port, route_flow )
-
-            ### if nxt_hop is empty the routing failed    
-            if not nxt_hop:
-                failed = True
-                break
+                linkState.trace = 0
+                verdict = routeFlow( ctx, representative, switches, neighborMap )
+                case = recordVerdict( ctx, representative, failedLinks, linkState.trace, verdict )
 
-            ### nxt_hop is list where each element has form (nxt_flow, portId )
-            for (nxt_flow, nxt_port ) in nxt_hop:
+            verdicts[ representative ] = case[2]
 
-                ### nxt_port may not lead to a switch within the network. We can route only those that do
-                if nxt_port in switch.nbrs:
-                    (nbrSwitchId, nbrPortId) = neighborMap[ to_switch ][nxt_port]
-                    to_route.append( (nbrSwitchId, nbrPortId, nxt_flow) )             
+        verdict = verdicts[ representative ]
 
         ### save the identities of flows that _did_ get routed.  This because there is multi-cast, perhaps
         ### for redundency, and if any of them gets through it is a save
         ###
-        if not failed:
+        if verdict:
             routed.add( flowName )
 
+    linkState.tracing = False
+
     ### return list of flows impacted by the set of link failures
 
     allFlows = set( evalDict['flows'] )
     return sorted( list( allFlows.difference( routed ) ))
 
+class RunCancelled(Exception):
+    pass
+
+### set the linkState structure to have only the links to fail in the failed state, and have
+### the switches record the links they consult
+###
+def resetLinkState( failedLinks, switches, linkState ):
+
+    linkState.apply( failedLinks )
+    linkState.tracing = True
+
+    ### make sure the switches refer to this linkState structure during routing
+    for switchName, switch in switches.items():
+        if switch.linkState is not linkState:
+            saveLinkState( switches, linkState )
+        break
+
+### route a single flow through the network under the current linkState, returning True
+### if some copy of it reaches the destination
+###
+def routeFlow( ctx, flowName, switches, neighborMap ):
+
+    fdict = ctx.flowsDict[ flowName ]
+    flow  = flowHeader( ctx, flowName )
+
+    ### build the first entry point in the path exploration
+    src      = fdict['nsrc']
+    in_port  = fdict['ingress_port']
+
+    ### to_route will be a stack describing the routing attempts still to be made
+    switch = switches[ src ]
+    to_route = [ (src, in_port, flow) ]
+    failed = True
+
+    while len(to_route) > 0:
+        (to_switch, to_port, route_flow) = to_route.pop()
+
+        switch = switches[ to_switch ]
+        
+        ### see if the flow arrives at destination
+        if switch.atDestination( route_flow ):
+            failed = False
+            break
+
+        ### try to route flow through to_switch using ingress port to_port
+        nxt_hop = switch.route( to_port, route_flow )
+
+        ### if nxt_hop is empty the routing failed    
+        if not nxt_hop:
+            failed = True
+            break
+
+        ### nxt_hop is list where each element has form (nxt_flow, portId )
+        for (nxt_flow, nxt_port ) in nxt_hop:
+
+            ### nxt_port may not lead to a switch within the network. We can route only those that do
+            if nxt_port in switch.nbrs:
+                (nbrSwitchId, nbrPortId) = neighborMap[ to_switch ][nxt_port]
+                to_route.append( (nbrSwitchId, nbrPortId, nxt_flow) )             
+
+    return not failed
+
+### the Flow structure copies all the attributes of a flow in the flowsDict
+### into a 'vars' dictionary in the flow, so references to attributes in the
+### actual flow being pushed around is through .vars.  The header is compiled
+### once per flow, and a copy of it handed out for each routing attempt
+###
+def flowHeader( ctx, flowName ):
+    flow = ctx.flowHeaders.get( flowName )
+    if flow is None:
+        fdict = ctx.flowsDict[ flowName ]
+        fdict['ttl'] = 24
+        flow = Flow(flowName, fdict)
+        flow.vars['nw_ttl'] = 24
+        ctx.flowHeaders[ flowName ] = flow
+
+    return flow.copy()
+
+### ctx.flowVerdicts[ flowName ], for the representative of a header class, is a list of cases ( consulted, failed, routed ), where consulted is the
+### bit-set of links looked at while routing the flow, failed the subset of those that were down and routed the
+### outcome.  Any evaluation failing exactly the same links out of consulted gets the same outcome.
+###
+def lookupVerdict( ctx, flowName, failedLinks ):
+    ctx.verdictLookups += 1
+    for case in ctx.flowVerdicts.get( flowName, [] ):
+        consulted, failed, routed = case
+        if failedLinks & consulted == failed:
+            ctx.verdictHits += 1
+            return case
+
+    return None
+
+def recordVerdict( ctx, flowName, failedLinks, consulted, routed ):
+    case  = (consulted, failedLinks & consulted, routed)
+    cases = ctx.flowVerdicts.setdefault( flowName, [] )
+    if len(cases) < VerdictCases:
+        cases.append( case )
+    return case
+
+### the case of a single flow under the failed links failedLinks, from the verdict cache or by routing it
+###
+def flowCase( ctx, flowName, failedLinks, switches, linkState, neighborMap ):
+    representative = ctx.flowClasses.get( flowName, flowName )
+    case = lookupVerdict( ctx, representative, failedLinks )
+    if case is None:
+        resetLinkState( failedLinks, switches, linkState )
+        linkState.trace = 0
+        routed = routeFlow( ctx, representative, switches, neighborMap )
+        linkState.tracing = False
+        case = recordVerdict( ctx, representative, failedLinks, linkState.trace, routed )
+    return case
+
+### most cases remembered for one flow; beyond this a flow is simply simulated
+VerdictCases = 64
+
 ### run each evaluation.  Simple enough, pull off the evaluation description from
 ### evalsDict and call runSingleEvaluation on it
 ###
-def runEvaluations( evalsDict, switches, linkState, neighborMap ):
+def runEvaluations( ctx, evalsDict, switches, linkState, neighborMap ):
 
     ### results array will be a copy of the incoming evalsDict, with an attribute added that
     ### describes the links which failed, for each evaluation
@@ -123,7 +222,7 @@ def runEvaluations( evalsDict, switches, linkState, neighborMap ):
     results = {}
     for evalId, evalDict in evalsDict['evaluations'].items():
         ### get list of flows that do not survive the link failures
-        failed = runSingleEvaluation( evalDict, switches, linkState, neighborMap )
+        failed = runSingleEvaluation( ctx, evalDict, switches, linkState, neighborMap )
 
         ### create the results entry for this evaluation 
         results[ evalId ] = {}
@@ -133,10 +232,149 @@ def runEvaluations( evalsDict, switches, linkState, neighborMap ):
     ### we're done
     return results
 
+### summarize the next-hop caches of all switches, for reporting alongside evaluation results
+###
+def nextHopStats( switches ):
+    hits   = sum( switch.cacheHits for switch in switches.values() )
+    misses = sum( switch.cacheMisses for switch in switches.values() )
+    lookups = hits + misses
+    return {'hits':hits,'misses':misses,'hit_rate': hits/lookups if lookups else 0 }
+
+### summarize how many failure scenarios were applied to the linkState, and how many link state changes it took
+###
+def linkStateStats( linkState ):
+    return {'scenarios':linkState.scenarios,'link_flips':linkState.flips }
+
+### summarize how many flow evaluations were answered from ctx.flowVerdicts without routing
+###
+def verdictStats(ctx):
+    hits = ctx.verdictHits
+    lookups = ctx.verdictLookups
+    return {'hits':hits,'simulated':lookups-hits,'hit_rate': hits/lookups if lookups else 0 }
+
+### combinations of k items, in one of two orders.  'lexicographic' is the order of itertools.combinations.
+### 'gray' is the revolving door order, in which each combination differs from the one before it by exchanging
+### a single item, so consecutive failure scenarios differ in as few links as possible
+###
+def orderedCombinations(items, k, order="lexicographic"):
+    if order != "gray":
+        return combinations(items, k)
+
+    items = list(items)
+    return ( tuple( items[idx] for idx in comb ) for comb in revolvingDoor(len(items), k) )
+
+def revolvingDoor(n, k, reverse=False):
+    '''
+    Revolving door sequence of the k-subsets of range(n), as index tuples.  The sequence for (n,k) is
+    the one for (n-1,k) followed by the reversed one for (n-1,k-1) with n-1 added to each
+    '''
+    if k > n:
+        return
+    if k == 0:
+        yield ()
+        return
+    if k == n:
+        yield tuple(range(n))
+        return
+    if not reverse:
+        yield from revolvingDoor(n-1, k)
+        for comb in revolvingDoor(n-1, k-1, True):
+            yield comb + (n-1,)
+    else:
+        for comb in revolvingDoor(n-1, k-1):
+            yield comb + (n-1,)
+        yield from revolvingDoor(n-1, k, True)
+
 # lambda function to calculate combination
 nCr = lambda n,r: math.factorial(n)/(math.factorial(n-r)*math.factorial(r))
 
-def calculate_metric(flows,evals, evalsDict, switches, linkState, neighborMap):
+### ------- lazy combination layers -----------
+###
+###   The combinations of each size (layer) are generated only when calculate_metric asks for them, one at a
+### time, so the layers past the point where poisson_metric stops on the tolerance are never built.  Neither are
+### the layers past maxLayer: there the Poisson probability that more elements fail is too small to change the
+### metric in double precision, whatever the flow's conditional failure probabilities are.
+###
+
+def maxLayer(L, evalsDict):
+    '''
+    Number of layers, out of L, that can make a difference to the metric
+    '''
+    params = evalsDict["parameters"]
+    lambda_x = L * float(params["failure_rate"]) * int(params["time"])
+    p_any = 1 - math.exp(-1*lambda_x)
+
+    tail = p_any
+    for m in range(1, L+1):
+        tail -= (lambda_x)**m * math.exp(-1*lambda_x)/math.factorial(m)
+        if tail < sys.float_info.epsilon * p_any:
+            return m
+    return L
+
+class CombinationLayers:
+    '''
+    The layers of combinations of L elements that make_eval_link hands to calculate_metric.  len() is L,
+    and iterating gives, for each size m = 1..maxLayer, a generator of the bit-sets of the m-combinations
+    with at least one element on the flow's path
+    '''
+    def __init__(self, elements, visited, toMask, order, layers):
+        self.elements = elements
+        self.visited  = visited
+        self.toMask   = toMask
+        self.order    = order
+        self.layers   = layers
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __iter__(self):
+        for m in range(1, self.layers+1):
+            yield self.layer(m)
+
+    def layer(self, m):
+        remaining = set(self.elements)
+        # find all combinations of unique link pairs with at least one visited link
+        for v in self.visited:
+            # take out the node from visited
+            remaining.remove(v)
+            # out of L-h Choose m - 1, for h in V, m-1, since v will be added in
+            for rest in orderedCombinations(remaining, m-1, self.order):
+                combin = list(rest)
+                # add in the visited link back into the unique combination
+                combin.append(v)
+                yield self.toMask(combin)
+
+### ------- layer profiles -----------
+###
+###   The p_m of the layers of a metric depend on the flow (or switch), the elements failed and the network, but
+### not on failure_rate, time or tolerance, which only decide how many layers poisson_metric takes.   When the run
+### has a profile cache (ctx.pmProfiles, see utils/resultcache.py) the engines take the layers it knows from it,
+### under profileKey, compute only the ones past those, and hand the lengthened profile back.
+###
+
+def profileKey(type_m, name, elements):
+    '''
+    Key of the layer profile of the metric of name (a flow, or a switch for the neighborhood
+    metric), of evaluation type type_m, failing elements (in any order)
+    '''
+    return json.dumps([type_m, name, sorted(str(element) for element in elements)])
+
+def knownLayers(ctx, profile):
+    '''
+    The p_m of the layers of profile known to the profile cache of ctx, in order
+    '''
+    if ctx.pmProfiles is None or profile is None:
+        return []
+    return ctx.pmProfiles.get(profile)
+
+def recordLayers(ctx, profile, p_ms, known):
+    '''
+    Hand p_ms back to the profile cache of ctx, if it has more than the known layers
+    '''
+    if ctx.pmProfiles is not None and profile is not None and len(p_ms) > known:
+        ctx.pmProfiles.put(profile, p_ms)
+
+def calculate_metric(ctx, flows,evals, evalsDict, switches, linkState, neighborMap, pool=None, name=None, profile=None):
     '''
     Here we are calculating the probability the flow Fj fails due to link failure.
     We need to calculate the probability m links fail (p_x) which can be modeled by
@@ -144,51 +382,862 @@ def calculate_metric(flows,evals, evalsDict, switches, linkState, neighborMap):
     Input:
         flows:   - An array that holds the flow Fj or flows F to calculate the metric on
         evals:  - An array, where each element (i) holds a list of all unique sets of links of size
-                  (i+1).
+                  (i+1), or a CombinationLayers generating them.  len(evals) is the number of links L
     Output:
         probability_t: - the metric, which is Sum(i from 1 to L) p_m[i]*p_x[i]
+    The combinations of a layer are shared out over the workers of pool, when given.  The
+    metric after each layer is reported to ctx.onLayer under name.  The layers the profile
+    cache knows under profile are not simulated again
     '''
-    probability_t = 0
-    params = evalsDict["parameters"]
-    tolerance = float(params["tolerance"])
-    f_r = float(params["failure_rate"])
-    time = int(params["time"])
-
     L = len(evals)
+    p_ms = knownLayers(ctx, profile)
+    known = len(p_ms)
 
-    lambda_x = L * f_r * time
-    ## total probability does not include P[F fails|0 links fail], since its always 0
-    ## however, when considering an upperbound, we need to take it into consideration.
-    probability_e = math.exp(-1*lambda_x)
-
-    for i, link_c in enumerate(evals):
-        # calculate probability f fails given i+1 links fail in time T
-        p_m = 0
-        for comb in link_c:
-            eDict = {"flows":flows,"links":comb}
-            fail = runSingleEvaluation(eDict,switches,linkState,neighborMap)
+    def layers():
+        for i, link_c in enumerate(evals):
+            ctx.layer = i+1
+            if i < len(p_ms):
+                yield p_ms[i]
+                continue
+            # calculate probability f fails given i+1 links fail in time T
+            tasks = ((flows, comb) for comb in link_c)
+            counts = countFailures(ctx, tasks, switches, linkState, neighborMap, pool)
             ## dividing by the number of flows is for neighboring switch failure metric
-            p_m += len(fail)/len(flows)
-        p_m = p_m/nCr(L,i+1)
+            p_m = sum(counts.values())/len(flows)
+            p_ms.append(p_m/nCr(L,i+1))
+            yield p_ms[i]
+
+    metric = poisson_metric(layers(), L, evalsDict, ctx, name)
+    recordLayers(ctx, profile, p_ms, known)
+    return metric
 
+def poisson_metric(p_ms, L, evalsDict, ctx=None, name=None):
+    '''
+    Combine the conditional failure probabilities p_m of the layers 1..L, given in order by
+    the iterable p_ms, with the Poisson probability that that many of the L elements fail.
+    Layers are only drawn from p_ms until the tolerance is reached.  Each layer added is
+    reported, under name, to ctx.onLayer when ctx is given
+    Output:
+        probability_t, bound: - the metric and the layer at which it was cut short, or None
+    '''
+    metric = PoissonMetric(L, evalsDict)
+    for p_m in p_ms:
+        done = metric.add(p_m)
+        if ctx is not None:
+            reportLayer(ctx, name, metric)
+        if done:
+            break
+    return metric.probability_t, metric.bound
+
+def reportLayer(ctx, name, metric):
+    '''
+    Hand the partial metric of name, after its latest layer, to ctx.onLayer
+    '''
+    if ctx.onLayer is not None:
+        ctx.onLayer(name, metric.layers, metric.probability_t, metric.tail(), metric.bound)
+
+class PoissonMetric:
+    '''
+    The running sum behind poisson_metric, for engines that compute the layers of several
+    flows side by side.  add() takes the p_m of the next layer and returns True once the
+    tolerance is reached, after which probability_t and bound hold the result
+    '''
+    def __init__(self, L, evalsDict):
+        params = evalsDict["parameters"]
+        self.tolerance = float(params["tolerance"])
+        f_r = float(params["failure_rate"])
+        time = int(params["time"])
+
+        self.lambda_x = L * f_r * time
+        ## total probability does not include P[F fails|0 links fail], since its always 0
+        ## however, when considering an upperbound, we need to take it into consideration.
+        self.probability_e = math.exp(-1*self.lambda_x)
+        self.probability_t = 0
+        self.bound = None
+        self.layers = 0
+
+    def add(self, p_m):
+        i = self.layers
+        self.layers += 1
         # calculate probability that i links fail in time T with Poisson distribution
-        p_x = (lambda_x)**(i+1) * math.exp(-1*lambda_x)/math.factorial(i+1)
+        p_x = (self.lambda_x)**(i+1) * math.exp(-1*self.lambda_x)/math.factorial(i+1)
 
-        probability_e += p_x
+        self.probability_e += p_x
         #print(i+1,"p_x",(p_x))
         #print(i+1,"p_e",(1-probability_e),"p_t",(tolerance*(probability_t+p_m*p_x)))
-        if (i > 0 and ((1- probability_e) < (tolerance * (probability_t + p_m*p_x)))):
-            bound = i+1
-            return probability_t, bound
+        if (i > 0 and ((1- self.probability_e) < (self.tolerance * (self.probability_t + p_m*p_x)))):
+            self.bound = i+1
+            return True
+        self.probability_t += p_m*p_x
+        return False
+
+    def tail(self):
+        '''
+        Poisson probability that more elements fail than the layers added so far cover,
+        which bounds what the remaining layers can still add to probability_t
+        '''
+        return max(0.0, 1 - self.probability_e)
+
+### ------- parallel scenario evaluation -----------
+###
+###   With 'workers' greater than 1 the scenarios of a layer are shared out, in chunks, over a pool of processes.
+### Each worker gets the built network (switches, linkState, neighborMap, and the SherpaContext of the run) once,
+### when it starts: inherited through fork where the platform has it, pickled otherwise.  The parent sums the
+### failure counts of the chunks, so a layer is complete before poisson_metric looks at it and the tolerance stops
+### the run exactly where the serial engines stop.   Workers keep their own verdict and next-hop caches, whose
+### statistics are not included in the results.
+###
+
+ScenarioChunk = 64
+workerNetwork = None
+
+def parallel_workers(evalsDict):
+    return max(1, int(evalsDict.get('parameters',{}).get('workers',1)))
+
+def makePool(ctx, workers, switches, linkState, neighborMap):
+    '''
+    Pool of processes set up to run scenarios on the network, or None for a single worker
+    '''
+    if workers <= 1:
+        return None
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initWorker,
+                                   initargs=(ctx, switches, linkState, neighborMap))
+    executor.workers = workers
+    return executor
+
+def initWorker(ctx, switches, linkState, neighborMap):
+    global workerNetwork
+    workerNetwork = (ctx, switches, linkState, neighborMap)
+
+def evaluateChunk(tasks):
+    ctx, switches, linkState, neighborMap = workerNetwork
+    return countFailures(ctx, tasks, switches, linkState, neighborMap)
+
+def countFailures(ctx, tasks, switches, linkState, neighborMap, pool=None):
+    '''
+    tasks are pairs of the flows to route and the links to fail.  Returns a dictionary
+    counting, for each flow, the tasks in which it failed
+    '''
+    counts = defaultdict(int)
+    if pool is None:
+        for flows, failedLinks in tasks:
+            eDict = {"flows":flows,"links":failedLinks}
+            for flowName in runSingleEvaluation(ctx,eDict,switches,linkState,neighborMap):
+                counts[flowName] += 1
+        return counts
+
+    # the workers count scenarios in their own contexts, the parent counts the chunks they finish
+    sizes = {}
+    def merge(done):
+        for future in done:
+            ctx.scenarios += sizes.pop(future)
+            for flowName, count in future.result().items():
+                counts[flowName] += count
+
+    def submit(chunk):
+        if ctx.cancelled:
+            for future in pending:
+                future.cancel()
+            raise RunCancelled()
+        future = pool.submit(evaluateChunk, chunk)
+        sizes[future] = len(chunk)
+        pending.add(future)
+
+    # keep a couple of chunks per worker in flight, so the scenarios are never all held at once
+    pending = set()
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == ScenarioChunk:
+            submit(chunk)
+            chunk = []
+            if len(pending) >= 2*pool.workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                merge(done)
+    if chunk:
+        submit(chunk)
+    merge(wait(pending)[0])
+    return counts
+
+### ------- batched engine -----------
+###
+###   calculate_metric run flow by flow re-enumerates the same combinations for every flow.  batch_metric
+### walks the combinations of the selected elements once per layer for all flows selecting the same elements,
+### and routes, per combination, only the flows with an element of their path in it that are still short of
+### their tolerance.  The failure counts of a layer are accumulated for all the flows in one array, and then
+### handed to each flow's PoissonMetric, so every flow gets the same p_m, and result, it would get on its own.
+###
+
+def batch_metric(ctx, evalsDict, switches, linkState, neighborMap, type_m="link", pool=None):
+    '''
+    calculate_metric for every flow of evalsDict['evaluations'], over the combinations
+    make_eval_link would produce for it.  Returns a dictionary mapping each flow to
+    its (probability_t, bound)
+    '''
+    order = evalsDict.get('parameters',{}).get('order',"lexicographic")
+    results = {}
+
+    # flows selecting the same elements share their combinations
+    groups = defaultdict(list)
+    for flowName, evalDict in evalsDict['evaluations'].items():
+        if type_m == "switch":
+            elements = evalDict["switches"]
+            visited = [v for v in ctx.flowsDict[flowName]["visited"] if v in elements]
         else:
-            probability_t += p_m*p_x
+            elements = evalDict["links"]
+            visited = evalDict["visited"]
+
+        # no selected element on the flow's path, 0 probability of failing
+        if not visited:
+            results[flowName] = (0, None)
+            continue
+        groups[tuple(elements)].append((flowName, visited))
+
+    for elements, members in groups.items():
+        L = len(elements)
+        if type_m == "switch":
+            masks = [switchToMask(ctx, [s], linkState) for s in elements]
+        else:
+            masks = [linkState.bit(link) for link in elements]
+
+        flowNames = [flowName for flowName, visited in members]
+        index = {flowName: idx for idx, flowName in enumerate(flowNames)}
+        onPath = []
+        for flowName, visited in members:
+            bits = 0
+            for idx, element in enumerate(elements):
+                if element in visited:
+                    bits |= 1 << idx
+            onPath.append(bits)
+        metrics = [PoissonMetric(L, evalsDict) for flowName in flowNames]
+        active = list(range(len(flowNames)))
+        profiles = [profileKey(type_m, flowName, elements) for flowName in flowNames]
+        p_ms = [knownLayers(ctx, profile) for profile in profiles]
+        known = [len(layers) for layers in p_ms]
+
+        def scenarios(m, routed):
+            for comb in orderedCombinations(range(L), m, order):
+                bits = 0
+                for idx in comb:
+                    bits |= 1 << idx
+                interested = [flowNames[f] for f in routed if onPath[f] & bits]
+                if not interested:
+                    continue
+
+                failedLinks = 0
+                for idx in comb:
+                    failedLinks |= masks[idx]
+                yield interested, failedLinks
+
+        for m in range(1, maxLayer(L, evalsDict)+1):
+            ctx.layer = m
+            # only the flows whose profile lacks this layer are routed
+            routed = [f for f in active if len(p_ms[f]) < m]
+            counts = numpy.zeros(len(flowNames))
+            if routed:
+                for flowName, count in countFailures(ctx, scenarios(m, routed), switches, linkState, neighborMap, pool).items():
+                    counts[ index[flowName] ] += count
+
+            layer = counts/nCr(L,m)
+            still = []
+            for f in active:
+                if len(p_ms[f]) < m:
+                    p_ms[f].append(float(layer[f]))
+                done = metrics[f].add(p_ms[f][m-1])
+                reportLayer(ctx, flowNames[f], metrics[f])
+                if not done:
+                    still.append(f)
+            active = still
+            if not active:
+                break
+
+        for f, flowName in enumerate(flowNames):
+            results[flowName] = (metrics[f].probability_t, metrics[f].bound)
+            recordLayers(ctx, profiles[f], p_ms[f], known[f])
+
+    return results
+
+### ------- exact engine based on minimal cut sets -----------
+###
+###   Rather than routing a flow through every combination of the selected elements (links, or switches
+### standing for all their links), find the minimal sets of elements whose failure breaks the flow.  The search
+### starts from no failures; whenever the flow still routes, a cut must contain an element behind one of the links
+### its routing consulted, so only those are added.   The number of combinations of m elements that contain a cut
+### then follows by inclusion-exclusion over the cut sets, which gives p_m exactly as the enumeration would.
+###
+###   That holds only if failing more elements never repairs a flow, i.e. every superset of a cut is a cut too.
+### Failover rules (several OUTPUT actions, fast-failover groups) need not behave so, a backup port coming into
+### use only once a further link is down.  The search checks that each cut, with any one more element failed,
+### still breaks the flow, and cutset_metric goes back to enumerating (batch_metric) for a flow that fails the
+### check.  The check does not cover larger supersets.
+###
+
+class NotMonotone(Exception):
+    pass
+
+def minimalCutSets(ctx, flowName, masks, switches, linkState, neighborMap):
+    '''
+    masks[i] is the bit-set of links failed by element i.  Returns the minimal cut sets,
+    each as a bit-set of element indices.  Raises NotMonotone if a cut with one more
+    element failed lets the flow route again
+    '''
+    def failedBy(elems):
+        failedLinks = 0
+        for idx, mask in enumerate(masks):
+            if elems >> idx & 1:
+                failedLinks |= mask
+        return failedLinks
+
+    cuts = []
+    frontier = [0]
+    seen = set(frontier)
+    ctx.layer = 0
+    while frontier:
+        ctx.layer += 1
+        following = []
+        for elems in frontier:
+            # a superset of a cut is not minimal
+            if any(cut & elems == cut for cut in cuts):
+                continue
+
+            consulted, failed, routed = flowCase(ctx, flowName, failedBy(elems), switches, linkState, neighborMap)
+            if not routed:
+                # the cut must stay one with any further element failed
+                for idx in range(len(masks)):
+                    grown = elems | 1 << idx
+                    if grown != elems and flowCase(ctx, flowName, failedBy(grown), switches, linkState, neighborMap)[2]:
+                        raise NotMonotone()
+                cuts.append(elems)
+                continue
+
+            # fail one more element among those the routing depended on
+            for idx, mask in enumerate(masks):
+                grown = elems | 1 << idx
+                if mask & consulted and grown != elems and grown not in seen:
+                    seen.add(grown)
+                    following.append(grown)
+        frontier = following
+    return cuts
+
+def cutSetTerms(cuts):
+    '''
+    Inclusion-exclusion over the cut sets, with terms of equal union merged.  Returns a dictionary
+    mapping the union of a group of cuts to its signed coefficient
+    '''
+    terms = defaultdict(int)
+    for cut in cuts:
+        for union, coef in list(terms.items()):
+            terms[union | cut] -= coef
+        terms[cut] += 1
+    return {union: coef for union, coef in terms.items() if coef}
+
+def countContaining(terms, n, m):
+    '''
+    Number of m-subsets of n elements containing at least one cut, from cutSetTerms
+    '''
+    count = 0
+    for union, coef in terms.items():
+        size = bin(union).count('1')
+        if size <= m:
+            count += coef * math.comb(n-size, m-size)
+    return count
+
+def cutset_metric(ctx, flowName, evalsDict, switches, linkState, neighborMap, type_m="link"):
+    '''
+    Same metric as calculate_metric over the combinations make_eval_link would produce
+    for flowName, computed from the flow's minimal cut sets.  This assumes failing more
+    elements never lets the flow route again; if minimalCutSets finds otherwise the
+    metric is computed by batch_metric instead
+    '''
+    evalDict = evalsDict['evaluations'][flowName]
+    if type_m == "switch":
+        elements = evalDict["switches"]
+        f_visited = ctx.flowsDict[flowName]["visited"]
+        visited = [v for v in f_visited if v in elements]
+        masks = [linkState.mask(ctx.switchDict[s]) for s in elements]
+    else:
+        elements = evalDict["links"]
+        visited = evalDict["visited"]
+        masks = [linkState.bit(link) for link in elements]
+
+    # no selected element on the flow's path, 0 probability of failing
+    if not visited:
+        return 0, None
+
+    L = len(elements)
+    profile = profileKey(type_m, flowName, elements)
+    p_ms = knownLayers(ctx, profile)
+    known = len(p_ms)
+
+    # the cut sets are only searched for if the profile cache lacks a layer the metric needs
+    counting = []
+    def counter():
+        if not counting:
+            cuts = minimalCutSets(ctx, flowName, masks, switches, linkState, neighborMap)
+
+            # the enumeration only looks at combinations with at least one element on the flow's path,
+            # so leave out those containing a cut but none of the visited elements
+            onPath = 0
+            for idx, element in enumerate(elements):
+                if element in visited:
+                    onPath |= 1 << idx
+            terms = cutSetTerms(cuts)
+            offPath = cutSetTerms([cut for cut in cuts if not cut & onPath])
+            offCount = L - bin(onPath).count('1')
+            counting.append(lambda m: countContaining(terms, L, m) - countContaining(offPath, offCount, m))
+        return counting[0]
+
+    def layers():
+        for m in range(1, maxLayer(L, evalsDict)+1):
+            if m > len(p_ms):
+                p_ms.append(counter()(m)/nCr(L,m))
+            yield p_ms[m-1]
+
+    try:
+        metric = poisson_metric(layers(), L, evalsDict, ctx, flowName)
+    except NotMonotone:
+        return batch_metric(ctx, dict(evalsDict, evaluations={flowName: evalDict}), switches, linkState, neighborMap, type_m)[flowName]
+    recordLayers(ctx, profile, p_ms, known)
+    return metric
+
+### ------- stratified Monte Carlo estimator -----------
+###
+###   For large selections the metric is estimated instead.  The population of failure scenarios is stratified by
+### the number of failing elements m, stratum m carrying the Poisson weight p_x[m] the exact engines use.  Strata
+### small enough are enumerated exactly, the others are sampled uniformly (with a fixed seed) in rounds, samples
+### being allocated to the strata in proportion to weight times estimated standard deviation.   Sampling stops when
+### the confidence interval's half-width falls within 'precision' of the estimate, or after 'max_samples' draws.
+### Strata past the point where the Poisson tail drops below 'tolerance' of the probability that anything fails at
+### all are not sampled; their weight is reported as 'tail_bound'.
+###
+
+MonteCarloDefaults = {'precision':0.05,'confidence':0.95,'seed':0,'max_samples':100000,'batch':1000}
+
+def montecarlo_params(evalsDict):
+    params = dict(MonteCarloDefaults)
+    for key in MonteCarloDefaults:
+        if key in evalsDict['parameters']:
+            params[key] = evalsDict['parameters'][key]
+    params['precision'] = float(params['precision'])
+    params['confidence'] = float(params['confidence'])
+    for key in ('seed','max_samples','batch'):
+        params[key] = int(params[key])
+    return params
+
+def stratified_estimate(strata, evaluate, mcParams):
+    '''
+    Each stratum is a dictionary with
+        weight:     the probability of the stratum
+        scale:      factor taking the stratum's mean outcome to its contribution p_m
+        size:       number of scenarios in the stratum
+        enumerate:  function returning all scenarios of the stratum
+        sample:     function (rng, n) returning n scenarios drawn uniformly
+    and evaluate(scenario) gives the outcome, between 0 and 1, of a scenario.
+    Returns the estimate, the half-width of its confidence interval and the number of samples drawn
+    '''
+    rng = numpy.random.default_rng(mcParams['seed'])
+    z = NormalDist().inv_cdf(0.5 + mcParams['confidence']/2)
+    batch = mcParams['batch']
+
+    sums  = [0.0]*len(strata)
+    drawn = [0]*len(strata)
+    exact = [False]*len(strata)
+
+    # strata no bigger than a batch are cheaper to enumerate than to sample
+    for idx, stratum in enumerate(strata):
+        if stratum['size'] <= batch:
+            outcomes = [evaluate(scenario) for scenario in stratum['enumerate']()]
+            sums[idx]  = sum(outcomes)
+            drawn[idx] = len(outcomes)
+            exact[idx] = True
+
+    def summary():
+        estimate = 0.0
+        variance = 0.0
+        for idx, stratum in enumerate(strata):
+            if not drawn[idx]:
+                continue
+            share = stratum['weight']*stratum['scale']
+            estimate += share*sums[idx]/drawn[idx]
+            if not exact[idx]:
+                # keep the variance away from 0 when no (or every) sample failed
+                p = (sums[idx]+1)/(drawn[idx]+2)
+                variance += share*share*p*(1-p)/drawn[idx]
+        return estimate, z*math.sqrt(variance)
+
+    samples = 0
+    sampled = [idx for idx in range(len(strata)) if not exact[idx]]
+    estimate, halfwidth = summary()
+    while sampled and samples < mcParams['max_samples']:
+        # allocate the round in proportion to weight times estimated deviation
+        effort = []
+        for idx in sampled:
+            p = (sums[idx]+1)/(drawn[idx]+2)
+            effort.append(strata[idx]['weight']*strata[idx]['scale']*math.sqrt(p*(1-p)))
+        total = sum(effort)
+        if total == 0:
+            # no sampled stratum can contribute (e.g. a failure rate of 0), the estimate is the exact part
+            break
+        # a round never draws more than what is left of max_samples
+        left = min(batch, mcParams['max_samples']-samples)
+        roundSize = left
+        for idx, share in zip(sampled, effort):
+            n = min(left, max(2, int(round(roundSize*share/total))))
+            if n <= 0:
+                break
+            left -= n
+            sums[idx]  += sum(evaluate(scenario) for scenario in strata[idx]['sample'](rng, n))
+            drawn[idx] += n
+            samples += n
+
+        estimate, halfwidth = summary()
+        if halfwidth <= mcParams['precision']*estimate:
+            break
+
+    return estimate, halfwidth, samples
+
+def montecarlo_result(strata, evaluate, evalsDict, L):
+    '''
+    Weight the strata by the Poisson probabilities of L elements failing, run the estimator
+    and format the result
+    '''
+    params = evalsDict["parameters"]
+    tolerance = float(params["tolerance"])
+    lambda_x = L * float(params["failure_rate"]) * int(params["time"])
+    mcParams = montecarlo_params(evalsDict)
+
+    p_any = 1 - math.exp(-1*lambda_x)
+    tail  = p_any
+    used  = []
+    for m, stratum in enumerate(strata, 1):
+        stratum['weight'] = (lambda_x)**m * math.exp(-1*lambda_x)/math.factorial(m)
+        used.append(stratum)
+        tail -= stratum['weight']
+        if tail < tolerance * p_any:
+            break
+
+    estimate, halfwidth, samples = stratified_estimate(used, evaluate, mcParams)
+    return {'probability':estimate,
+            'confidence_interval':[max(0.0, estimate-halfwidth), estimate+halfwidth],
+            'confidence':mcParams['confidence'],
+            'samples':samples,
+            'strata':len(used),
+            'tail_bound':max(0.0, tail)}
+
+def montecarlo_metric(ctx, flowName, evalsDict, switches, linkState, neighborMap, type_m="link"):
+    '''
+    Estimate of the metric calculate_metric gives for flowName, over the same link or switch selection
+    '''
+    evalDict = evalsDict['evaluations'][flowName]
+    if type_m == "switch":
+        elements = evalDict["switches"]
+        f_visited = ctx.flowsDict[flowName]["visited"]
+        visited = [v for v in f_visited if v in elements]
+        masks = [linkState.mask(ctx.switchDict[s]) for s in elements]
+    else:
+        elements = evalDict["links"]
+        visited = evalDict["visited"]
+        masks = [linkState.bit(link) for link in elements]
+
+    if not visited:
+        return {'probability':0}
+
+    L = len(elements)
+    onPath = numpy.array([element in visited for element in elements])
+
+    def evaluate(scenario):
+        # as in the enumeration, only combinations touching the flow's path can fail it
+        if scenario is None:
+            return 0
+        eDict = {"flows":[flowName],"links":scenario}
+        return len(runSingleEvaluation(ctx,eDict,switches,linkState,neighborMap))
+
+    def toScenario(indices):
+        if not onPath[list(indices)].any():
+            return None
+        mask = 0
+        for idx in indices:
+            mask |= masks[idx]
+        return mask
+
+    def stratum(m):
+        def enumerate_m():
+            return [toScenario(comb) for comb in combinations(range(L), m)]
+        def sample_m(rng, n):
+            # the m smallest of L uniform keys pick a uniform m-subset
+            keys = rng.random((n, L))
+            picks = numpy.argpartition(keys, m-1, axis=1)[:, :m]
+            hits = onPath[picks].any(axis=1)
+            return [toScenario(row) if hit else None for row, hit in zip(picks.tolist(), hits)]
+        return {'scale':1, 'size':math.comb(L, m), 'enumerate':enumerate_m, 'sample':sample_m}
+
+    return montecarlo_result([stratum(m) for m in range(1, L+1)], evaluate, evalsDict, L)
+
+def montecarlo_neigh(ctx, flows, links, evalsDict, switches, linkState, neighborMap):
+    '''
+    Estimate of the neighborhood metric, in which each link of the neighborhood is failed on its own
+    and the fractions of flows failing are summed over the links
+    '''
+    if not links or not flows:
+        return {'probability':0}
+
+    def evaluate(scenario):
+        eDict = {"flows":flows,"links":scenario}
+        return len(runSingleEvaluation(ctx,eDict,switches,linkState,neighborMap))/len(flows)
+
+    def sample(rng, n):
+        return [links[idx] for idx in rng.integers(0, len(links), n)]
+
+    stratum = {'scale':len(links), 'size':len(links), 'enumerate':lambda: links, 'sample':sample}
+    return montecarlo_result([stratum], evaluate, evalsDict, 1)
+
+### ------- lockstep engine -----------
+###
+###   failure_matrix finds which of many flows fail under each of many failure scenarios in one pass, as a
+### flows x scenarios boolean matrix, rather than routing flow by flow and scenario by scenario.
+###
+###   The routing of the representative of each header class is first compiled into a LockstepTable of states.
+### A state is a switch a flow is at, the port it came in on and its header.  What the switch does with the
+### flow depends only on the links its matching rules consult (see Switch.nextHop); for each of the 2^k
+### patterns of those k links being up or down, the table holds the next state, or that the flow arrived or
+### failed.  Then every (class, scenario) pair advances one hop at a time together, as numpy arrays: the
+### pattern of each pair is gathered from the failed links of its scenario, and its next state read from the table.
+###
+###   A class whose routing makes more than one copy of the flow inside the network, meets a rule rewriting a
+### field other rules match on, or reaches a state consulting more than LockstepMaxLinks links, is not compiled,
+### and is routed scenario by scenario through the verdict cache (flowCase) instead.   A pair still moving after
+### as many hops as there are states is going round a loop, and counts as failed.
+###
+
+### outcomes of a state in the table, other than the id of the next state
+Arrived = -1
+Dropped = -2
+
+LockstepMaxLinks = 8
+
+### most (class, scenario) pairs advanced together
+LockstepBatch = 1 << 20
+
+class LockstepTable:
+    def __init__(self, ctx, switches, linkState, neighborMap):
+        self.ctx = ctx
+        self.switches = switches
+        self.linkState = linkState
+        self.neighborMap = neighborMap
+
+        ### the id of each state by its key, and for each state the ids of the links it consults and its
+        ### outcome under each pattern of them, None if the state can't be tabulated
+        self.ids = {}
+        self.links = []
+        self.outcomes = []
+        self.pending = []
+
+        ### the start state of each representative compiled, None if it is routed scenario by scenario
+        self.starts = {}
+
+    def stateId(self, switchName, port, flow):
+        header = tuple( sorted( (attrib, repr(value)) for attrib, value in flow.vars.items() if attrib != 'in_port' ) )
+        key = ( switchName, port, header )
+        sid = self.ids.get( key )
+        if sid is None:
+            sid = len( self.links )
+            self.ids[ key ] = sid
+            self.links.append( () )
+            self.outcomes.append( None )
+            self.pending.append( (sid, switchName, port, flow) )
+        return sid
+
+    ### fill in the links and outcomes of state sid, the flow at switchName having come in on port
+    def tabulate(self, sid, switchName, port, flow):
+        switch = self.switches[ switchName ]
+        if switch.atDestination( flow ):
+            self.outcomes[ sid ] = [ Arrived ]
+            return
+
+        flow.vars['in_port'] = port
+        ports = switch.classifier.outputPorts( flow )
+        if ports is None:
+            return
+        mask = switch.portsMask( ports )
+        linkIds = [ linkId for linkId in range( mask.bit_length() ) if mask >> linkId & 1 ]
+        if len( linkIds ) > LockstepMaxLinks:
+            return
+
+        outcomes = []
+        for pattern in range( 1 << len(linkIds) ):
+            failed = 0
+            for j, linkId in enumerate( linkIds ):
+                if pattern >> j & 1:
+                    failed |= 1 << linkId
+            self.linkState.apply( failed )
+
+            ### the copies of the flow that stay within the network
+            moved = [ (nxtFlow, nxtPort) for nxtFlow, nxtPort in switch.route( port, flow.copy() ) if nxtPort in switch.nbrs ]
+            if len( moved ) > 1:
+                return
+            if not moved:
+                outcomes.append( Dropped )
+                continue
+
+            nxtFlow, nxtPort = moved[0]
+            nbrSwitchId, nbrPortId = self.neighborMap[ switchName ][ nxtPort ]
+            outcomes.append( self.stateId( nbrSwitchId, nbrPortId, nxtFlow ) )
+
+        self.links[ sid ] = tuple( linkIds )
+        self.outcomes[ sid ] = outcomes
+
+    ### the start state of flowName, the representative of a header class, compiling the states it reaches
+    def compile(self, flowName):
+        if flowName in self.starts:
+            return self.starts[ flowName ]
 
-    return probability_t, None
+        fdict = self.ctx.flowsDict[ flowName ]
+        start = self.stateId( fdict['nsrc'], fdict['ingress_port'], flowHeader( self.ctx, flowName ) )
+        while self.pending:
+            self.tabulate( *self.pending.pop() )
 
-def neighToLinks(switch,hops):
+        ### the class is compiled only if every state it can reach is tabulated
+        seen = set([ start ])
+        stack = [ start ]
+        while stack:
+            outcomes = self.outcomes[ stack.pop() ]
+            if outcomes is None:
+                start = None
+                break
+            for sid in outcomes:
+                if sid >= 0 and sid not in seen:
+                    seen.add( sid )
+                    stack.append( sid )
+
+        self.starts[ flowName ] = start
+        return start
+
+    ### the table as arrays: the links of each state, padded with pad, and the outcome of each state for each
+    ### pattern of them
+    def arrays(self, pad):
+        width = max( [ len(linkIds) for linkIds in self.links ] + [0] )
+        links = numpy.full( (len(self.links), width), pad, dtype=numpy.int64 )
+        outcomes = numpy.full( (len(self.links), 1 << width), Dropped, dtype=numpy.int64 )
+        for sid, linkIds in enumerate( self.links ):
+            links[ sid, :len(linkIds) ] = linkIds
+            if self.outcomes[ sid ] is not None:
+                outcomes[ sid, :len(self.outcomes[ sid ]) ] = self.outcomes[ sid ]
+        return links, outcomes
+
+### the failed links of each scenario as a boolean array, one row per scenario and one column per link,
+### and a last column for no link, never failed
+###
+###   Bit-sets of up to 63 links are shifted as int64, wider ones as Python integers.
+###
+def failedArray( scenarios, linkState ):
+    numLinks = len(linkState.names)
+    failed = numpy.zeros( (len(scenarios), numLinks+1), dtype=bool )
+    if numLinks <= 63:
+        masks = numpy.array( scenarios, dtype=numpy.int64 )
+        shifts = numpy.arange( numLinks, dtype=numpy.int64 )
+    else:
+        masks = numpy.array( scenarios, dtype=object )
+        shifts = numpy.arange( numLinks ).astype( object )
+    failed[ :, :-1 ] = ( masks[ :, None ] >> shifts ) & 1
+    return failed
+
+### advance flows from states starts under each scenario of failed, all in lockstep, and return which
+### arrived, one row per start and one column per scenario
+###
+def lockstep(starts, failed, links, outcomes):
+    scenarios = failed.shape[0]
+    state = numpy.repeat( starts, scenarios )
+    scenario = numpy.tile( numpy.arange( scenarios ), len(starts) )
+    weights = 1 << numpy.arange( links.shape[1], dtype=numpy.int64 )
+
+    moving = numpy.arange( len(state) )
+    for hop in range( len(links)+1 ):
+        if not len( moving ):
+            break
+        at = state[ moving ]
+        pattern = failed[ scenario[ moving ][:,None], links[ at ] ].dot( weights )
+        state[ moving ] = outcomes[ at, pattern ]
+        moving = moving[ state[ moving ] >= 0 ]
+
+    return ( state == Arrived ).reshape( len(starts), scenarios )
+
+def failureScenarios(links, depth, linkState, order="lexicographic"):
+    '''
+    The combinations of 1 to depth of links, as lists of link names, with the bit-set
+    of each in linkState
+    '''
+    scenarios = []
+    for k in range(1, depth+1):
+        scenarios.extend(list(combin) for combin in orderedCombinations(links, k, order))
+    return scenarios, [linkState.mask(combin) for combin in scenarios]
+
+def failure_matrix(ctx, flows, scenarios, switches, linkState, neighborMap, stats=None):
+    '''
+    Which of flows fail under each of scenarios, bit-sets of failed links, as a boolean
+    array with one row per flow and one column per scenario, routed through a LockstepTable.
+    stats, if given, is a dictionary to add the size of the table to
+    '''
+    if ctx.cancelled:
+        raise RunCancelled()
+
+    ## every header class among the flows is routed once
+    classes = []
+    classOf = {}
+    for flowName in flows:
+        representative = ctx.flowClasses.get(flowName, flowName)
+        if representative not in classOf:
+            classOf[representative] = len(classes)
+            classes.append(representative)
+
+    ## the link patterns tried while tabulating are not scenarios of the run, so they are kept out
+    ## of the link state and next hop cache statistics
+    counts = (linkState.scenarios, linkState.flips)
+    lookups = {switchName: (switch.cacheHits, switch.cacheMisses) for switchName, switch in switches.items()}
+    try:
+        resetLinkState(0, switches, linkState)
+        linkState.tracing = False
+        table = LockstepTable(ctx, switches, linkState, neighborMap)
+        starts = [table.compile(representative) for representative in classes]
+        linkState.apply(0)
+    finally:
+        linkState.scenarios, linkState.flips = counts
+        for switchName, switch in switches.items():
+            switch.cacheHits, switch.cacheMisses = lookups[switchName]
+
+    routed = numpy.zeros((len(classes), len(scenarios)), dtype=bool)
+    compiled = [idx for idx, start in enumerate(starts) if start is not None]
+    if compiled and scenarios:
+        links, outcomes = table.arrays(len(linkState.names))
+        failed = failedArray(scenarios, linkState)
+        starts_c = numpy.array([starts[idx] for idx in compiled], dtype=numpy.int64)
+        batch = max(1, LockstepBatch // len(compiled))
+        for first in range(0, len(scenarios), batch):
+            if ctx.cancelled:
+                raise RunCancelled()
+            routed[compiled, first:first+batch] = lockstep(starts_c, failed[first:first+batch], links, outcomes)
+
+    ## the classes that could not be compiled are routed one scenario at a time
+    for idx, start in enumerate(starts):
+        if start is not None:
+            continue
+        for column, mask in enumerate(scenarios):
+            if ctx.cancelled:
+                raise RunCancelled()
+            routed[idx, column] = flowCase(ctx, classes[idx], mask, switches, linkState, neighborMap)[2]
+    ctx.scenarios += len(scenarios)
+
+    if stats is not None:
+        stats.update({'classes':len(classes), 'compiled':len(compiled), 'states':len(table.links)})
+    return ~routed[[classOf[ctx.flowClasses.get(flowName, flowName)] for flowName in flows]]
+
+def neighToLinks(ctx,switch,hops):
     def get_neighbors(switch):
         switches = []
-        links = sherpa.switchDict[switch]
+        links = ctx.switchDict[switch]
         for link in links:
             # parse link and find the neighbor
             sw_pair = link.split('-',1)
@@ -212,7 +1261,7 @@ def neighToLinks(switch,hops):
         if switch not in visited:
             visited.add(switch)
 
-        if sherpa.switchDict[switch] == []:
+        if ctx.switchDict[switch] == []:
             return visited
 
         for neigh in get_neighbors(switch):
@@ -223,17 +1272,26 @@ def neighToLinks(switch,hops):
 
     explored = find_k_neighbors(switch,{switch},hops)
     #print(explored)
-    return switchToLinks(list(explored))
+    return switchToLinks(ctx,list(explored))
 
-def switchToLinks(switches):
+def switchToLinks(ctx,switches):
     links = set()
     for s in switches:
-        links.update(sherpa.switchDict[s])
+        links.update(ctx.switchDict[s])
     return list(links)
 
-def make_eval_neigh(evalsDict):
+def switchToMask(ctx, switches, linkState):
+    '''
+    bit-set of the links attached to any of the switches
+    '''
+    mask = 0
+    for s in switches:
+        mask |= linkState.mask(ctx.switchDict[s])
+    return mask
+
+def make_eval_neigh(ctx, evalsDict, linkState):
     # get all flows as a list
-    flows = list(sherpa.flowsDict.keys())
+    flows = list(ctx.flowsDict.keys())
     
     switch_evals = {}
 
@@ -242,72 +1300,66 @@ def make_eval_neigh(evalsDict):
 
     for switchName in eval_dict['switches']:
         # compile affected switches in number of hops and convert it to links
-        links_affected = neighToLinks(switchName,hops)
+        links_affected = neighToLinks(ctx,switchName,hops)
+        # each link of the neighborhood is failed on its own, as a one-link bit-set
+        links_affected = [linkState.bit(link) for link in links_affected]
         # create flow and link dictionary for metric calculation
         switch_evals[switchName] = {"flows":flows,"links":links_affected}
     return switch_evals
 
-def make_eval_switch(evalsDict):
+def make_eval_switch(ctx, evalsDict, linkState):
     '''
     This takes in the evaluation dictionary and finds all unique
     combinations of links from sets of 1 to sets of number of total links selected
     and each set has at least one link that the flow goes through
 
     The output flow_evals is a dictionary that maps the user selected flow to 
-    a list of evaluations, each element in the list is a list of combination of links
-    all with the length index of the evaluation.
+    its evaluations, a CombinationLayers whose element (i) generates the combinations of
+    switches of length i+1.  A combination of switches is given as the bit-set of their links
+    in linkState.  The optional 'order' parameter picks the order of combinations within a
+    length, see orderedCombinations.
     '''
-    # uses global variables flowDict and switchDict
+    # uses the run's ctx.flowsDict and ctx.switchDict
+    order = evalsDict.get('parameters',{}).get('order',"lexicographic")
+    toMask = lambda combin: switchToMask(ctx, combin, linkState)
     flow_evals = {}
     for flowName, evalDict in evalsDict['evaluations'].items():
-        evaluations = []
-        f_visited = sherpa.flowsDict[flowName]["visited"]
+        f_visited = ctx.flowsDict[flowName]["visited"]
         visited = [v for v in f_visited if v in evalDict["switches"]]
         # if the switches that will be failing don't include switches that the flow uses
         # there's no point in running evaluation
         if not visited:
             # evaluations corresponding to this flow is empty, signifying 0 probability of failing
             continue
-        else:
-            switches = evalDict["switches"]
-            for i in range(1,len(switches)+1):
-                # link_comb is list of all unique combinations of flows of length i
-                sw_comb = []
-                sw_set = set(switches)
-                # find all combinations of unique link pairs with at least one visited link
-                for v in visited:
-                    # take out the node from visited
-                    sw_set.remove(v)
-                    # out of L-h Choose i - 1, for h in V, i-1, since v will be added in
-                    unique = combinations(sw_set,i-1)
-                    for su in list(unique):
-                        combin = list(su)
-                        # add in the visited link back into the unique combination
-                        combin.append(v)
-                        # here is where the switches are converted to links (not in this function)
-                        combin = switchToLinks(combin)
-                        sw_comb.append(combin)
-                evaluations.append(sw_comb)
-        flow_evals[flowName] = evaluations
+        switches = evalDict["switches"]
+        flow_evals[flowName] = CombinationLayers(switches, visited, toMask, order,
+                                                 maxLayer(len(switches), evalsDict))
     return flow_evals
 
-def make_eval_link(evalsDict, type_m="link"):
+def make_eval_link(ctx, evalsDict, linkState, type_m="link"):
     '''
     This takes in the evaluation dictionary and finds all unique
     combinations of links from sets of 1 to sets of number of total links selected
     and each set has at least one link that the flow goes through
 
     The output flow_evals is a dictionary that maps the user selected flow to 
-    a list of evaluations, each element in the list is a list of combination of links
-    all with the length index of the evaluation.
+    its evaluations, a CombinationLayers whose element (i) generates the combinations of
+    links of length i+1.  A combination of links is given as the bit-set of the links in
+    linkState.  The optional 'order' parameter picks the order of combinations within a
+    length, see orderedCombinations.
     '''
-    # uses global variables flowDict and switchDict
+    # uses the run's ctx.flowsDict and ctx.switchDict
+    order = evalsDict.get('parameters',{}).get('order',"lexicographic")
+    # here is where the switches are converted to links
+    if type_m == "switch":
+        toMask = lambda combin: switchToMask(ctx, combin, linkState)
+    else:
+        toMask = linkState.mask
     flow_evals = {}
     for flowName, evalDict in evalsDict['evaluations'].items():
-        evaluations = []
         # pull links/switches to fail during the test that the flow visits 
         if type_m == "switch":
-            f_visited = sherpa.flowsDict[flowName]["visited"]
+            f_visited = ctx.flowsDict[flowName]["visited"]
             visited = [v for v in f_visited if v in evalDict["switches"]]
         else:
             visited = evalDict["visited"]
@@ -316,31 +1368,13 @@ def make_eval_link(evalsDict, type_m="link"):
         # there's no point in running evaluation
         if not visited:
             # evaluations corresponding to this flow is empty, signifying 0 probability of failing
-            pass
+            flow_evals[flowName] = []
+            continue
+
+        if type_m == "switch":
+            links = evalDict["switches"]
         else:
-            if type_m == "switch":
-                links = evalDict["switches"]
-            else:
-                links = evalDict["links"]
-
-            for i in range(1,len(links)+1):
-                # link_comb is list of all unique combinations of flows of length i
-                link_comb = []
-                lk_set = set(links)
-                # find all combinations of unique link pairs with at least one visited link
-                for v in visited:
-                    # take out the node from visited
-                    lk_set.remove(v)
-                    # out of L-h Choose i - 1, for h in V, i-1, since v will be added in
-                    unique = combinations(lk_set,i-1)
-                    for lu in list(unique):
-                        combin = list(lu)
-                        # add in the visited link back into the unique combination
-                        combin.append(v)
-                        # here is where the switches are converted to links
-                        if type_m == "switch":
-                            combin = switchToLinks(combin)
-                        link_comb.append(combin)
-                evaluations.append(link_comb)
-        flow_evals[flowName] = evaluations
+            links = evalDict["links"]
+        flow_evals[flowName] = CombinationLayers(links, visited, toMask, order,
+                                                 maxLayer(len(links), evalsDict))
     return flow_evals
@@ -0,0 +1,189 @@
+###     classifier.py
+###
+###     The Classifier class is a compiled view of a switch's rule table, used by Switch.route in place
+###     of walking every rule in the table and calling matchAndAction on each.
+###
+###     Every rule is identified by its position in the table (the table is kept in priority order by
+###     the Switch), and sets of rules are held as Python integers used as bit-sets, bit i standing for
+###     the rule at position i.   For each of the exact-match attributes (dl_type, ip_dscp, in_port) the
+###     classifier keeps a hash table mapping an attribute value to the set of rules requiring that value,
+###     and the set of rules that don't constrain the attribute at all.   For nw_dst the CIDR blocks of all rules
+###     cut the address space into elementary intervals; for each interval the classifier records the set of
+###     rules whose block covers it, so the rules matching an address are found with one binary search.
+###
+###     Rules whose match dictionary uses an attribute the classifier does not index are kept in a
+###     'residual' set, always offered as candidates and checked with Rule.matches.
+###
+###     candidates(flow) yields the rules matching the flow in table order, which is exactly the order
+###     in which the linear scan would have found them.
+###
+###     fingerprint(flow) and outputPorts(flow) support the Switch's next-hop cache: the first reduces a flow header
+###     to the fields this table's rules can tell apart, the second lists the ports whose state the matching rules
+###     may consult, or None when a matching rule rewrites a matched-on field and the outcome can't be cached.
+###
+from bisect import bisect_right
+
+import pdb
+
+ExactAttributes = ('dl_type','ip_dscp','in_port')
+RangeAttributes = ('nw_dst',)
+
+class Classifier:
+    def __init__(self, rules):
+        self.rules = rules
+        self.allRules = (1 << len(rules)) - 1
+
+        ### exact[ attrib ] maps a value to the set of rules requiring it,
+        ### constrained[ attrib ] is the set of rules that look at attrib at all
+        self.exact = {}
+        self.constrained = {}
+        for attrib in ExactAttributes + RangeAttributes:
+            self.exact[ attrib ] = {}
+            self.constrained[ attrib ] = 0
+
+        ### rules that need the full Rule.matches check, and rules whose SET_FIELD actions
+        ### rewrite an attribute some rule of this table matches on
+        self.residual = 0
+        self.rewrites = 0
+
+        ranges = []
+        for idx, rule in enumerate(rules):
+            bit = 1 << idx
+
+            for attrib, value in rule.match.items():
+                if attrib in ExactAttributes and value == '*':
+                    ### a wildcard still requires the flow to carry the attribute
+                    self.residual |= bit
+
+                elif attrib in ExactAttributes:
+                    self.exact[ attrib ].setdefault( value, 0 )
+                    self.exact[ attrib ][ value ] |= bit
+                    self.constrained[ attrib ] |= bit
+
+                elif attrib in RangeAttributes:
+                    self.constrained[ attrib ] |= bit
+                    span = rule.compiled[ attrib ]
+                    if span is not None:
+                        ranges.append( (span, bit) )
+
+                else:
+                    self.residual |= bit
+
+        matchedAttribs = set()
+        for rule in rules:
+            matchedAttribs.update( rule.match.keys() )
+
+        for idx, rule in enumerate(rules):
+            if rule.setFields() & matchedAttribs:
+                self.rewrites |= 1 << idx
+
+        ### header fields the fingerprint is made of.  nw_dst is represented by the flow's integer range,
+        ### and nw_ttl is always included as it decides whether a routed flow survives
+        self.matchedAttribs = tuple( sorted( matchedAttribs - set(['nw_dst','nw_ttl']) ) )
+        self.matchesDst = 'nw_dst' in matchedAttribs
+
+        self.buildIntervals( ranges )
+
+    ### cut the address space at every CIDR boundary.  self.bounds[i] is the lowest address of
+    ### elementary interval i, and self.covers[i] the set of rules whose nw_dst block includes it
+    ###
+    def buildIntervals(self, ranges):
+        cuts = set([0])
+        for (low, high), bit in ranges:
+            cuts.add( low )
+            cuts.add( high+1 )
+
+        self.bounds = sorted( cuts )
+        self.covers = [0]*len(self.bounds)
+
+        for (low, high), bit in ranges:
+            first = bisect_right( self.bounds, low ) - 1
+            last  = bisect_right( self.bounds, high ) - 1
+            for idx in range(first, last+1):
+                self.covers[ idx ] |= bit
+
+    ### set of rules whose nw_dst block contains the address range [low, high]
+    ###
+    def covering(self, low, high):
+        first = bisect_right( self.bounds, low ) - 1
+        last  = bisect_right( self.bounds, high ) - 1
+        mask  = self.covers[ first ]
+        for idx in range(first+1, last+1):
+            mask &= self.covers[ idx ]
+        return mask
+
+    ### set of rules that agree with the flow header on every indexed attribute
+    ###
+    def matching(self, flow):
+        mask = self.allRules
+        fvars = flow.vars
+
+        for attrib in ExactAttributes:
+            constrained = self.constrained[ attrib ]
+            if not constrained:
+                continue
+
+            if attrib not in fvars:
+                mask &= ~constrained
+                continue
+
+            value = fvars[ attrib ]
+            if value == '*':
+                continue
+
+            mask &= ( ~constrained | self.exact[ attrib ].get( value, 0 ) )
+
+        constrained = self.constrained['nw_dst']
+        if constrained:
+            span = flow.dstRange if 'nw_dst' in fvars else None
+            if span is not None:
+                mask &= ( ~constrained | self.covering( *span ) )
+            else:
+                mask &= ~constrained
+
+        return mask & self.allRules
+
+    ### yield the rules matching the flow, in table order.  The caller applies each rule's actions
+    ### before asking for the next, so if a rule rewrites a matched-on header field the remaining
+    ### candidates are recomputed against the rewritten header
+    ###
+    def candidates(self, flow):
+        mask = self.matching( flow )
+        while mask:
+            low  = mask & -mask
+            idx  = low.bit_length() - 1
+            mask ^= low
+
+            rule = self.rules[ idx ]
+            if low & self.residual and not rule.matches( flow ):
+                continue
+
+            yield rule
+
+            if low & self.rewrites:
+                mask = self.matching( flow ) & ~( (low << 1) - 1 )
+
+    ### the parts of a flow header that can make a difference to this table
+    ###
+    def fingerprint(self, flow):
+        fvars = flow.vars
+        fields = tuple( (attrib in fvars, fvars.get(attrib)) for attrib in self.matchedAttribs )
+        dst = ( 'nw_dst' in fvars, flow.dstRange ) if self.matchesDst else None
+        return ( fields, dst, fvars.get('nw_ttl') )
+
+    ### the ports named by OUTPUT actions of the rules matching the flow, in table order
+    ###
+    def outputPorts(self, flow):
+        mask = self.matching( flow )
+        if mask & self.rewrites:
+            return None
+
+        ports = []
+        while mask:
+            low  = mask & -mask
+            mask ^= low
+            for actionAttribute, actionField in self.rules[ low.bit_length()-1 ].program:
+                if actionAttribute == 'OUTPUT' and actionField not in ports:
+                    ports.append( actionField )
+
+        return tuple( ports )
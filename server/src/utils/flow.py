@@ -9,8 +9,13 @@
 ###     SDN processing, but in makeFlows.py when we are looking for flows that complete we do look for
 ###     flow headers that get trapped in loops, and these flows are not considered to be viable.
 ###
+###     The header is carried in numeric form as well: dstRange is the (low, high) integer range of nw_dst,
+###     computed once when the flow is built and kept current by setField, so switches and rules compare
+###     integers while routing.   copy() duplicates a flow without re-reading its header.
+###
 
 import pdb
+from .ipn import IPRange
 
 keepAttributes  = ('dl_type','ip_dscp','nw_dst','nw_proto','nw_src', 'nsrc','ndst', 'ingress_port','visited')
 
@@ -25,6 +30,24 @@ class Flow:
         self.vars.update( stateDict )
         self.visited = []
         self.tagged = False
+        self.dstRange = IPRange( self.vars.get('nw_dst') )
+
+    ### change a header field, keeping the numeric form of the header in step
+    def setField(self, field, value):
+        self.vars[ field ] = value
+        if field == 'nw_dst':
+            self.dstRange = IPRange( value )
+
+    def copy(self):
+        global flow_id
+        newFlow = Flow.__new__( Flow )
+        newFlow.vars = dict( self.vars )
+        newFlow.fid = flow_id
+        flow_id += 1
+        newFlow.visited = list( self.visited )
+        newFlow.tagged = self.tagged
+        newFlow.dstRange = self.dstRange
+        return newFlow
 
 def cleanUp(flow):
     theseAttribs = list( flow.keys() )
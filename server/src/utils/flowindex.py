@@ -0,0 +1,167 @@
+###     flowindex.py
+###
+###     Indexes over the flows of a session, built once, for selecting flows by source or destination switch,
+###     by a switch or link they traverse, by hop count and by ip_dscp without looking at every flow.   A flow is
+###     known by its id, its position in the flows file; each index maps a key to the sorted array of the ids of
+###     the flows having it, so a selection is an intersection of sorted arrays, and a page of it starts at the
+###     first id at or past a cursor.
+###
+###     The flows may be a dictionary read from flows.json or a FlowStore; the indexes of a FlowStore are built
+###     from its columns, without building the flow dictionaries.
+###
+import numpy
+from .flowstore import FlowStore
+
+### ids of the flows of each key, as sorted arrays, given parallel arrays of keys and ids
+###
+def groupIds( keys, ids ):
+    groups = {}
+    if not len( keys ):
+        return groups
+    order = numpy.lexsort( ( ids, keys ) )
+    keys = keys[ order ]
+    ids = ids[ order ]
+    bounds = numpy.flatnonzero( keys[1:] != keys[:-1] ) + 1
+    for start, end in zip( numpy.concatenate( ([0], bounds) ), numpy.concatenate( (bounds, [len(keys)]) ) ):
+        groups[ int( keys[start] ) ] = numpy.unique( ids[ start:end ] )
+    return groups
+
+class FlowIndex:
+    def __init__(self, flowsDict):
+        self.flows = flowsDict
+
+        if isinstance( flowsDict, FlowStore ):
+            self.names = None
+            nodes = flowsDict.nodes
+            src = self.nodeColumn( flowsDict, 'nsrc' )
+            dst = self.nodeColumn( flowsDict, 'ndst' )
+            dscp, hasDscp = self.intColumn( flowsDict, 'ip_dscp' )
+            offsets = numpy.asarray( flowsDict.visitOffsets, dtype=numpy.int64 )
+            visited = numpy.asarray( flowsDict.visitedNodes, dtype=numpy.int64 )
+        else:
+            self.names = list( flowsDict )
+            nodes = []
+            nodeIds = {}
+            def nodeId( node ):
+                if node not in nodeIds:
+                    nodeIds[ node ] = len( nodes )
+                    nodes.append( node )
+                return nodeIds[ node ]
+
+            count = len( self.names )
+            src = numpy.full( count, -1, dtype=numpy.int64 )
+            dst = numpy.full( count, -1, dtype=numpy.int64 )
+            dscp = numpy.zeros( count, dtype=numpy.int64 )
+            hasDscp = numpy.zeros( count, dtype=bool )
+            offsets = numpy.zeros( count+1, dtype=numpy.int64 )
+            path = []
+            for idx, name in enumerate( self.names ):
+                fdict = flowsDict[ name ]
+                if 'nsrc' in fdict:
+                    src[ idx ] = nodeId( fdict['nsrc'] )
+                if 'ndst' in fdict:
+                    dst[ idx ] = nodeId( fdict['ndst'] )
+                if type( fdict.get('ip_dscp') ) is int:
+                    dscp[ idx ] = fdict['ip_dscp']
+                    hasDscp[ idx ] = True
+                path.extend( nodeId( node ) for node in fdict.get('visited', []) )
+                offsets[ idx+1 ] = len( path )
+            visited = numpy.array( path, dtype=numpy.int64 )
+
+        self.count = len( offsets ) - 1
+        self.nodeIds = { node:idx for idx, node in enumerate( nodes ) }
+        ids = numpy.arange( self.count, dtype=numpy.int64 )
+
+        self.hops = numpy.maximum( numpy.diff( offsets ) - 1, 0 )
+        self.bySrc = groupIds( src[ src >= 0 ], ids[ src >= 0 ] )
+        self.byDst = groupIds( dst[ dst >= 0 ], ids[ dst >= 0 ] )
+        self.byDscp = groupIds( dscp[ hasDscp ], ids[ hasDscp ] )
+
+        ### the flow of every visited node, and of every link between nodes visited one after the other,
+        ### a link being keyed by its two node ids, the smaller first
+        owner = numpy.repeat( ids, numpy.diff( offsets ) )
+        self.bySwitch = groupIds( visited, owner )
+        step = owner[1:] == owner[:-1]
+        first = numpy.minimum( visited[:-1], visited[1:] )[ step ]
+        second = numpy.maximum( visited[:-1], visited[1:] )[ step ]
+        self.byLink = groupIds( first * len( nodes ) + second, owner[1:][ step ] )
+        self.nodeCount = len( nodes )
+
+    @staticmethod
+    def nodeColumn( store, attrib ):
+        if attrib not in store.columnData or store.columnData[ attrib ][0] != 'node':
+            return numpy.full( store.count, -1, dtype=numpy.int64 )
+        column = numpy.asarray( store.columnData[ attrib ][1], dtype=numpy.int64 )
+        return numpy.where( column == 0xFFFFFFFF, -1, column )
+
+    @staticmethod
+    def intColumn( store, attrib ):
+        if attrib not in store.columnData or store.columnData[ attrib ][0] != 'int':
+            return numpy.zeros( store.count, dtype=numpy.int64 ), numpy.zeros( store.count, dtype=bool )
+        _, column, present = store.columnData[ attrib ]
+        return numpy.asarray( column, dtype=numpy.int64 ), numpy.asarray( present, dtype=bool )
+
+    def name(self, idx):
+        return self.flows.name( idx ) if self.names is None else self.names[ idx ]
+
+    def flow(self, idx):
+        return self.flows.flowAt( idx ) if self.names is None else self.flows[ self.names[ idx ] ]
+
+    ### the key of link linkName ('n1-n4', in either order), or None if it does not join two known nodes
+    def linkKey(self, linkName):
+        for cut in [ i for i, c in enumerate( linkName ) if c == '-' ]:
+            first = self.nodeIds.get( linkName[:cut] )
+            second = self.nodeIds.get( linkName[cut+1:] )
+            if first is not None and second is not None:
+                return min( first, second ) * self.nodeCount + max( first, second )
+        return None
+
+    ### ids of the flows having any of keys in index
+    @staticmethod
+    def anyOf( index, keys ):
+        found = [ index[ key ] for key in keys if key in index ]
+        if not found:
+            return numpy.zeros( 0, dtype=numpy.int64 )
+        return numpy.unique( numpy.concatenate( found ) )
+
+    ### ids, in order, of the flows that meet every criterion given.   src, dst, switch and link are lists of
+    ### which a flow must match one; min_hops the fewest links it crosses; ip_dscp a list of values
+    ###
+    def select(self, src=None, dst=None, switch=None, link=None, min_hops=None, ip_dscp=None):
+        selected = numpy.arange( self.count, dtype=numpy.int64 )
+
+        nodeKeys = lambda names: [ self.nodeIds[ n ] for n in names if n in self.nodeIds ]
+        criteria = []
+        if src is not None:
+            criteria.append( self.anyOf( self.bySrc, nodeKeys( src ) ) )
+        if dst is not None:
+            criteria.append( self.anyOf( self.byDst, nodeKeys( dst ) ) )
+        if switch is not None:
+            criteria.append( self.anyOf( self.bySwitch, nodeKeys( switch ) ) )
+        if link is not None:
+            criteria.append( self.anyOf( self.byLink, [ self.linkKey( l ) for l in link ] ) )
+        if ip_dscp is not None:
+            criteria.append( self.anyOf( self.byDscp, ip_dscp ) )
+
+        for ids in sorted( criteria, key=len ):
+            selected = numpy.intersect1d( selected, ids, assume_unique=True )
+        if min_hops is not None:
+            selected = selected[ self.hops[ selected ] >= min_hops ]
+        return selected
+
+    ### the flows of selected, from the first with id at or past cursor, at most limit of them, as a
+    ### dictionary of flow dictionaries holding only fields (all, if None) and leaving out exclude, with
+    ### the cursor of the next page, None if there is none
+    ###
+    def page(self, selected, cursor=0, limit=None, fields=None, exclude=()):
+        start = int( numpy.searchsorted( selected, cursor ) )
+        end = len( selected ) if limit is None else min( len( selected ), start+limit )
+
+        flows = {}
+        for idx in selected[ start:end ].tolist():
+            fdict = self.flow( idx )
+            flows[ self.name( idx ) ] = { attrib:value for attrib, value in fdict.items() \
+                if ( fields is None or attrib in fields ) and attrib not in exclude }
+
+        nextCursor = int( selected[ end-1 ] ) + 1 if end < len( selected ) else None
+        return flows, nextCursor
@@ -0,0 +1,329 @@
+###     flowstore.py
+###
+###     A flows file in columns, written next to flows.json at upload and read through a memory map, so a session's
+###     flows are neither parsed whole nor held as nested dictionaries.   Node names, link names and text values
+###     are interned into tables, and each flow refers to them by index:
+###
+###         names                 the flow names, in the order of the flows file, and a permutation of them in
+###                                 sorted order for lookup by name
+###         nodes, links          the node and link names
+###         visited               the nodes each flow visits, all flows end to end, with the offset of each flow's
+###                                 first node
+###         hops                  the same for the link between each pair of nodes a flow visits one after the
+###                                 other, named as in switch.json
+###         one column per attribute of the flows, typed
+###                               'node'  an index into nodes              (nsrc, ndst)
+###                               'int'   a 64 bit integer, with a column marking which flows have one
+###                               'str'   an index into values, the text itself
+###                               'json'  an index into values, the text being the value in json
+###
+###     A table of strings is a uint8 array of their utf-8 bytes, end to end, with a uint64 array of the offset of
+###     each, and one more for the end.   The file starts with 8 bytes of magic, the length of a json header as a
+###     little endian uint64, and the header, which gives the offset, length and type of every array; the arrays
+###     follow, each 8 byte aligned.
+###
+###     A FlowStore is a read-only Mapping from flow name to the flow's dictionary, built on demand, so it stands
+###     in for the dictionary read from flows.json.   It pickles as its path.
+###
+import os
+import json
+from collections.abc import Mapping
+import numpy
+
+Magic = b'SHERPAFS'
+StoreFormat = 1
+
+### index of an absent value in a 'node', 'str' or 'json' column
+Absent = 0xFFFFFFFF
+
+def storePath( flows_file ):
+    return os.path.splitext( flows_file )[0] + '.store'
+
+def fileStamp( fileName ):
+    st = os.stat( fileName )
+    return [ st.st_mtime_ns, st.st_size ]
+
+def align( n ):
+    return ( n + 7 ) & ~7
+
+### ------- writing -----------
+
+### intern strings, in the order they are first seen
+###
+class Interner:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def id(self, string):
+        sid = self.ids.get( string )
+        if sid is None:
+            sid = len( self.strings )
+            self.ids[ string ] = sid
+            self.strings.append( string )
+        return sid
+
+### the offsets and bytes arrays of a table of strings
+###
+def stringTable( strings ):
+    encoded = [ s.encode('utf-8') for s in strings ]
+    offsets = numpy.zeros( len(encoded)+1, dtype='<u8' )
+    if encoded:
+        numpy.cumsum( [ len(e) for e in encoded ], out=offsets[1:] )
+    data = numpy.frombuffer( b''.join( encoded ), dtype='u1' )
+    return offsets, data
+
+### the kind of column that holds the values of one attribute
+###
+def columnKind( attrib, values ):
+    if attrib in ('nsrc','ndst') and all( isinstance(v, str) for v in values ):
+        return 'node'
+    if all( type(v) is int and -2**63 <= v < 2**63 for v in values ):
+        return 'int'
+    if all( isinstance(v, str) for v in values ):
+        return 'str'
+    return 'json'
+
+### write flowsDict, read from flows_file, as a flow store to store_file.   switchDict, as written
+### to switch.json, names the links between the nodes a flow visits
+###
+def writeFlowStore( store_file, flowsDict, switchDict, flows_file ):
+    names = list( flowsDict )
+    nodes = Interner()
+    links = Interner()
+    values = Interner()
+
+    attribs = []
+    for fdict in flowsDict.values():
+        for attrib in fdict:
+            if attrib != 'visited' and attrib not in attribs:
+                attribs.append( attrib )
+
+    sections = []
+    columns = []
+
+    ### the nodes visited, and the links between them
+    visitOffsets = numpy.zeros( len(names)+1, dtype='<u8' )
+    hopOffsets = numpy.zeros( len(names)+1, dtype='<u8' )
+    visited = []
+    hops = []
+    for idx, name in enumerate( names ):
+        path = flowsDict[ name ].get('visited', [])
+        visited.extend( nodes.id( node ) for node in path )
+        for cur, nxt in zip( path, path[1:] ):
+            link = cur+'-'+nxt
+            if link not in switchDict.get( cur, [] ):
+                link = nxt+'-'+cur
+            hops.append( links.id( link ) )
+        visitOffsets[ idx+1 ] = len( visited )
+        hopOffsets[ idx+1 ] = len( hops )
+
+    sections.append( ('visited.offsets', visitOffsets) )
+    sections.append( ('visited', numpy.array( visited, dtype='<u4' )) )
+    sections.append( ('hops.offsets', hopOffsets) )
+    sections.append( ('hops', numpy.array( hops, dtype='<u4' )) )
+
+    for attrib in attribs:
+        present = [ fdict[attrib] for fdict in flowsDict.values() if attrib in fdict ]
+        kind = columnKind( attrib, present )
+        columns.append( [ attrib, kind ] )
+
+        if kind == 'int':
+            column = numpy.zeros( len(names), dtype='<i8' )
+            mask = numpy.zeros( len(names), dtype='u1' )
+            for idx, fdict in enumerate( flowsDict.values() ):
+                if attrib in fdict:
+                    column[ idx ] = fdict[ attrib ]
+                    mask[ idx ] = 1
+            sections.append( ('column.'+attrib, column) )
+            sections.append( ('present.'+attrib, mask) )
+            continue
+
+        column = numpy.full( len(names), Absent, dtype='<u4' )
+        for idx, fdict in enumerate( flowsDict.values() ):
+            if attrib not in fdict:
+                continue
+            value = fdict[ attrib ]
+            if kind == 'node':
+                column[ idx ] = nodes.id( value )
+            elif kind == 'str':
+                column[ idx ] = values.id( value )
+            else:
+                column[ idx ] = values.id( json.dumps( value ) )
+        sections.append( ('column.'+attrib, column) )
+
+    ### the string tables, and the flow names in sorted order
+    for table, strings in (('names', names), ('nodes', nodes.strings), ('links', links.strings), ('values', values.strings)):
+        offsets, data = stringTable( strings )
+        sections.append( (table+'.offsets', offsets) )
+        sections.append( (table+'.data', data) )
+    order = sorted( range(len(names)), key=lambda idx: names[idx] )
+    sections.append( ('names.sorted', numpy.array( order, dtype='<u4' )) )
+
+    header = {'format':StoreFormat, 'flows':len(names), 'source':fileStamp( flows_file ),
+              'columns':columns, 'sections':{}}
+    offset = 0
+    for name, array in sections:
+        header['sections'][ name ] = [ offset, len(array), array.dtype.str ]
+        offset = align( offset + array.nbytes )
+    headerBytes = json.dumps( header ).encode('utf-8')
+
+    ### write to a temporary file first so a reader never sees a partial file
+    tmp_file = store_file + '.tmp'
+    with open(tmp_file,'wb') as sf:
+        sf.write( Magic )
+        sf.write( numpy.array( [len(headerBytes)], dtype='<u8' ).tobytes() )
+        sf.write( headerBytes )
+        sf.write( bytes( align( 16+len(headerBytes) ) - 16 - len(headerBytes) ) )
+        for name, array in sections:
+            sf.write( array.tobytes() )
+            sf.write( bytes( align( array.nbytes ) - array.nbytes ) )
+    os.replace( tmp_file, store_file )
+
+### ------- reading -----------
+
+class FlowStore( Mapping ):
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.raw = numpy.memmap( store_file, dtype='u1', mode='r' )
+        if bytes( self.raw[:8] ) != Magic:
+            raise ValueError('not a flow store: '+store_file)
+
+        length = int( self.raw[8:16].view('<u8')[0] )
+        self.header = json.loads( bytes( self.raw[16:16+length] ).decode('utf-8') )
+        self.base = align( 16+length )
+        self.count = self.header['flows']
+        self.columns = self.header['columns']
+
+        self.names = self.table('names')
+        self.sortedNames = self.section('names.sorted')
+        self.visitOffsets = self.section('visited.offsets')
+        self.visitedNodes = self.section('visited')
+        self.hopOffsets = self.section('hops.offsets')
+        self.hopLinks = self.section('hops')
+        self.values = self.table('values')
+
+        ### there are few nodes and links, so their names are decoded once
+        self.nodes = self.strings('nodes')
+        self.links = self.strings('links')
+
+        self.columnData = {}
+        for attrib, kind in self.columns:
+            self.columnData[ attrib ] = ( kind, self.section('column.'+attrib),
+                self.section('present.'+attrib) if kind == 'int' else None )
+
+    def __reduce__(self):
+        return ( FlowStore, ( self.store_file, ) )
+
+    def section(self, name):
+        offset, length, dtype = self.header['sections'][ name ]
+        dtype = numpy.dtype( dtype )
+        start = self.base + offset
+        return self.raw[ start:start + length*dtype.itemsize ].view( dtype )
+
+    def table(self, name):
+        return ( self.section(name+'.offsets'), self.section(name+'.data') )
+
+    def string(self, table, idx):
+        offsets, data = table
+        return bytes( data[ int(offsets[idx]):int(offsets[idx+1]) ] ).decode('utf-8')
+
+    def strings(self, name):
+        table = self.table( name )
+        return [ self.string( table, idx ) for idx in range( len(table[0])-1 ) ]
+
+    ### the flow id, the position in the flows file, of the flow named flowName; KeyError if there is none
+    def index(self, flowName):
+        key = flowName.encode('utf-8') if isinstance( flowName, str ) else None
+        if key is None:
+            raise KeyError( flowName )
+
+        offsets, data = self.names
+        low, high = 0, self.count
+        while low < high:
+            mid = ( low + high ) // 2
+            idx = int( self.sortedNames[ mid ] )
+            probe = bytes( data[ int(offsets[idx]):int(offsets[idx+1]) ] )
+            if probe < key:
+                low = mid + 1
+            elif probe > key:
+                high = mid
+            else:
+                return idx
+        raise KeyError( flowName )
+
+    def name(self, idx):
+        return self.string( self.names, idx )
+
+    ### the nodes the flow with id idx visits
+    def visitedAt(self, idx):
+        start, end = int( self.visitOffsets[idx] ), int( self.visitOffsets[idx+1] )
+        return [ self.nodes[ n ] for n in self.visitedNodes[ start:end ].tolist() ]
+
+    ### the links between the nodes the flow with id idx visits, as named in switch.json
+    def hopsAt(self, idx):
+        start, end = int( self.hopOffsets[idx] ), int( self.hopOffsets[idx+1] )
+        return [ self.links[ l ] for l in self.hopLinks[ start:end ].tolist() ]
+
+    def visited(self, flowName):
+        return self.visitedAt( self.index( flowName ) )
+
+    def hops(self, flowName):
+        return self.hopsAt( self.index( flowName ) )
+
+    ### the dictionary of the flow with id idx, as in flows.json
+    def flowAt(self, idx):
+        fdict = {}
+        for attrib, kind in self.columns:
+            _, column, present = self.columnData[ attrib ]
+            if kind == 'int':
+                if present[ idx ]:
+                    fdict[ attrib ] = int( column[ idx ] )
+                continue
+
+            vid = int( column[ idx ] )
+            if vid == Absent:
+                continue
+            if kind == 'node':
+                fdict[ attrib ] = self.nodes[ vid ]
+            elif kind == 'str':
+                fdict[ attrib ] = self.string( self.values, vid )
+            else:
+                fdict[ attrib ] = json.loads( self.string( self.values, vid ) )
+
+        fdict['visited'] = self.visitedAt( idx )
+        return fdict
+
+    def __getitem__(self, flowName):
+        return self.flowAt( self.index( flowName ) )
+
+    def __contains__(self, flowName):
+        try:
+            self.index( flowName )
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for idx in range( self.count ):
+            yield self.name( idx )
+
+    def __len__(self):
+        return self.count
+
+    ### the whole store as the dictionary read from flows.json
+    def asDict(self):
+        return { self.name( idx ):self.flowAt( idx ) for idx in range( self.count ) }
+
+### the flow store at store_file, or None if there is none, or if flows_file has changed since it was written
+###
+def openFlowStore( store_file, flows_file ):
+    if not store_file or not os.path.isfile( store_file ):
+        return None
+    try:
+        store = FlowStore( store_file )
+        if store.header['format'] != StoreFormat or store.header['source'] != fileStamp( flows_file ):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return store
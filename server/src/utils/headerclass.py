@@ -0,0 +1,55 @@
+###     headerclass.py
+###
+###     Flows whose headers no rule can tell apart follow the same forwarding decisions under every failure
+###     scenario, so only one of them needs to be routed.   headerClasses divides the flows of a session into
+###     such classes, and names a representative for each.
+###
+###     Rules and switches only look at nw_dst through whether it lies within a CIDR block: the nw_dst block of
+###     a rule's match, or one of the blocks a switch takes for its own (Switch.atDestination).   These blocks cut
+###     the address space into elementary intervals, as in classifier.py; a flow's nw_dst range is contained in a
+###     block exactly when the intervals holding its lowest and highest addresses are, so that pair of intervals
+###     stands for nw_dst.   Every other header field, and the switch and port the flow enters at, is compared as is.
+###
+from bisect import bisect_right
+from .ipn import IPRange
+
+### flow attributes that play no part in routing: where the flow is expected to arrive, the path it was found
+### on, and the TTL every routed flow starts over with
+IgnoredAttributes = ('nw_dst','ndst','visited','ttl')
+
+### map each flow of flowsDict to the representative of its class, the first of its members in sorted order
+###
+def headerClasses( switches, flowsDict ):
+    cuts = set([0])
+    for switch in switches.values():
+        for table in switch.tables:
+            for rule in table:
+                span = rule.compiled.get('nw_dst')
+                if span is not None:
+                    cuts.add( span[0] )
+                    cuts.add( span[1]+1 )
+
+        for low, high in switch.cidr:
+            cuts.add( low )
+            cuts.add( high+1 )
+
+    bounds = sorted( cuts )
+
+    representatives = {}
+    classes = {}
+    for flowName in sorted( flowsDict ):
+        fdict = flowsDict[ flowName ]
+
+        span = IPRange( fdict['nw_dst'] ) if 'nw_dst' in fdict else None
+        if span is not None:
+            dst = ( bisect_right( bounds, span[0] ), bisect_right( bounds, span[1] ) )
+        else:
+            dst = ( 'nw_dst' in fdict, None )
+
+        fields = tuple( sorted( (attrib, repr(value)) for attrib, value in fdict.items() \
+            if attrib not in IgnoredAttributes ) )
+
+        key = ( dst, fields )
+        classes[ flowName ] = representatives.setdefault( key, flowName )
+
+    return classes
@@ -7,6 +7,9 @@
 ###      IPValues(ip) :  the argument ip may be a single IP, or may be a CIDR block.
 ###         The routine converts the argument into an integer-based range.
 ###
+###      IPRange(ip) :  like IPValues, but always returns a (low, high) pair of integers, or None if the
+###         argument can't be read as an IP address or CIDR block.  Used to compile addresses ahead of routing.
+###
 ###      inIPFormat(ipstr) : determines whether the argument string ipstr is in IP address
 ###         format or in IP CIDR format
 ###
@@ -42,6 +45,16 @@ def IPValues(ip):
     upperV = v + (1<<32-dim)-1
     return v, upperV
 
+def IPRange(ip):
+    if ip is None:
+        return None
+    if isinstance(ip,int):
+        return ip, ip
+    span = IPValues(ip)
+    if span is None:
+        return None
+    return span
+
 # return True or False depending on whether the input string is in IP format
 #
 def inIPFormat(adrs):
@@ -7,17 +7,77 @@
 ### support for constructing and saving (to switches) the linkState array
 ### separated into utils because both makeFlows.py and sherpa.py use these functions
 ###
+###   Links are interned when the linkState is built: every link name ('n1-n4', the lower node id first)
+### gets a dense integer id, and a set of links is an integer used as a bit-set, bit i standing for link i.
+### The state of the network is then just the bit-set of failed links, so applying a failure scenario is a
+### single assignment and a switch checks a port with one AND.  Link names are only needed where link sets
+### come in from, or go out to, the user.
+###
+###   While 'tracing' is set, switches OR the bits of the links whose state they consult into 'trace'.
+###
+###   apply() moves the network from one failure scenario to the next, flipping only the links whose state
+### differs between the two; 'scenarios' and 'flips' count how many scenarios were applied and how many link
+### state changes that took.
+###
+
+class LinkState:
+    def __init__(self):
+        self.ids     = {}
+        self.names   = []
+        self.failed  = 0
+        self.trace   = 0
+        self.tracing = False
+        self.scenarios = 0
+        self.flips     = 0
+
+    ### return the id of a link, giving it the next free one if it is new
+    ###
+    def intern(self, linkName):
+        if linkName not in self.ids:
+            self.ids[ linkName ] = len(self.names)
+            self.names.append( linkName )
+        return self.ids[ linkName ]
+
+    def bit(self, linkName):
+        return 1 << self.ids[ linkName ] if linkName in self.ids else 0
+
+    ### bit-set of a collection of link names.  A bit-set passes through unchanged, a single name is
+    ### accepted for a one-link set, and names of links not in the network are ignored
+    ###
+    def mask(self, links):
+        if isinstance(links, int):
+            return links
+        if isinstance(links, str):
+            links = [ links ]
+
+        mask = 0
+        for linkName in links:
+            mask |= self.bit( linkName )
+        return mask
+
+    ### make failed the bit-set of failed links
+    ###
+    def apply(self, failed):
+        changed = self.failed ^ failed
+        self.scenarios += 1
+        self.flips += bin( changed ).count('1')
+        self.failed ^= changed
+
+    def linkNames(self, mask):
+        return [ linkName for linkId, linkName in enumerate(self.names) if mask >> linkId & 1 ]
+
+    def isUp(self, linkName):
+        return not self.failed & self.bit( linkName )
+
+def linkName( n1, n2 ):
+    return n1+'-'+n2 if n1 < n2 else n2+'-'+n1
 
 def buildLinkState( switches, linkState ):
-    for switchName in switches:
+    for switchName in sorted( switches ):
         for port in switches[ switchName ].nbrs:
             nbr = switches[ switchName ].nbrs[port]
-            key = switchName+'-'+nbr if switchName < nbr else nbr+'-'+switchName
-            linkState[ key ] = True
+            linkState.intern( linkName( switchName, nbr ) )
 
 def saveLinkState( switches, linkState ):
     for switchId, switch in switches.items():
         switch.saveLinkState( linkState )
-
-
-
@@ -44,11 +44,13 @@ def nbrThruPort( topoDict ):
 ### nodeIPs is a dictionary, indexed by node id, each mapped to a list of CIDR expressions of
 ###     IP ranges associated with the node
 ###
+### newlySeen is a NewlySeen (see rule.py) collecting rule attributes the code doesn't know about
+###
 ### buildNetwork calls the constructors for Switches, passing each its name, dictionary mapping
 ### ports to the neighboring nodes reached through the port,  list of
 ###     rules for table[0], and list of associated CIDR blocks
 ###
-def buildNetwork( topoDict, rulesDict, nodeIPs ):
+def buildNetwork( topoDict, rulesDict, nodeIPs, newlySeen ):
     switches = {}
 
     ### nbr[ nId ] gives a list of nodes connected to node nId by ports
@@ -69,7 +71,7 @@ def buildNetwork( topoDict, rulesDict, nodeIPs ):
         ### create the switch, passing the name, a dictionary indicating which neighbor is reached passing through
         ### a specific port, and a list of CIDR blocks associated with the switch
         ###
-        switches[nodeName] = Switch( nodeName, ntp[nodeName], rdict[nodeName], cidrMatch )
+        switches[nodeName] = Switch( nodeName, ntp[nodeName], rdict[nodeName], cidrMatch, newlySeen )
 
     return switches
 
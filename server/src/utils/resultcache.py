@@ -0,0 +1,188 @@
+###     resultcache.py
+###
+###     A cache, kept on disk in the cache folder of each session, of what evaluations computed, so that running the
+###     same evaluation again, or the same metric with different Poisson parameters, does not simulate anything.
+###
+###         results/<key>.json      the output of a run, under a key hashing the session, the type of evaluation,
+###                                   its parameters and its evaluations, with lists sorted
+###         pm/<digest>-<type>.json the conditional failure fractions p_m of each layer computed so far for the
+###                                   metrics of a session, by flow (or switch) and the elements failed.   They
+###                                   do not depend on failure_rate, time or tolerance, which only decide how
+###                                   many layers a metric needs
+###
+###     A session is known by a digest of the contents of the files its network is compiled from, so a session
+###     uploaded again with other files never sees the results of the old one.   Files not used for max_age
+###     seconds are removed, and then the least recently used ones while the folder holds more than max_bytes.
+###
+import os
+import json
+import time
+import hashlib
+import threading
+
+CacheFormat = 1
+
+### parameters that change how a run goes but not what it computes
+IgnoredParameters = ('workers',)
+
+def fileStamp( fileName ):
+    st = os.stat( fileName )
+    return ( st.st_mtime_ns, st.st_size )
+
+### value with every list of strings or numbers in it sorted, so that the order a selection is made in
+### does not make a different key
+###
+def normalized( value ):
+    if isinstance( value, dict ):
+        return { str(key):normalized( item ) for key, item in value.items() }
+    if isinstance( value, list ):
+        items = [ normalized( item ) for item in value ]
+        if all( isinstance( item, (str, int, float) ) and not isinstance( item, bool ) for item in items ):
+            return sorted( items, key=lambda item: ( isinstance( item, str ), item ) )
+        return items
+    return value
+
+def digestOf( value ):
+    return hashlib.sha256( json.dumps( value, sort_keys=True ).encode('utf-8') ).hexdigest()
+
+### write value as json to path, through a temporary file so a reader never sees part of it
+###
+def writeJson( path, value ):
+    os.makedirs( os.path.dirname( path ), exist_ok=True )
+    tmp_path = path + '.%d.tmp' % threading.get_ident()
+    with open(tmp_path,'w') as cf:
+        json.dump( value, cf, separators=(',',':') )
+    os.replace( tmp_path, path )
+
+def readJson( path ):
+    try:
+        with open(path,'r') as cf:
+            value = json.load( cf )
+    except (OSError, ValueError):
+        return None
+    ### a file used is kept longer
+    try:
+        os.utime( path )
+    except OSError:
+        pass
+    return value
+
+### the p_m of the layers of each metric of one session and type of evaluation, as read from its file
+### at the start of a run.   A run asks for them with get, and hands back what it computed with put
+###
+class Profiles:
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self.profiles = readJson( path ) or {}
+        self.grown = {}
+
+    def get(self, key):
+        return list( self.grown.get( key, self.profiles.get( key, [] ) ) )
+
+    def put(self, key, p_ms):
+        if len( p_ms ) > len( self.get( key ) ):
+            self.grown[ key ] = list( p_ms )
+
+    ### merge what was computed into the file, with what other runs may have written since
+    def save(self):
+        if not self.grown:
+            return
+        with self.cache.lock:
+            profiles = readJson( self.path ) or {}
+            for key, p_ms in self.grown.items():
+                if len( p_ms ) > len( profiles.get( key, [] ) ):
+                    profiles[ key ] = p_ms
+            writeJson( self.path, profiles )
+        self.cache.evict( os.path.dirname( os.path.dirname( self.path ) ) )
+
+class ResultCache:
+    def __init__(self, max_age, max_bytes):
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    ### the cache folder of the session of sessionDict, the session block of an evaluations file
+    @staticmethod
+    def cacheDir( sessionDict ):
+        anchor = sessionDict.get('session_file') or sessionDict['flows_file']
+        return os.path.join( os.path.dirname( anchor ), 'cache' )
+
+    ### digest of the contents of the files named by paths, computed again only if one of them changes
+    def sessionDigest(self, paths):
+        stamps = tuple( ( path, fileStamp( path ) ) for path in paths )
+        with self.lock:
+            digest = self.digests.get( stamps )
+        if digest is not None:
+            return digest
+
+        h = hashlib.sha256( ( 'format %d\n' % CacheFormat ).encode('utf-8') )
+        for path in paths:
+            with open(path,'rb') as sf:
+                for chunk in iter( lambda: sf.read(1<<20), b'' ):
+                    h.update( chunk )
+            h.update( b'\0' )
+        digest = h.hexdigest()
+        with self.lock:
+            self.digests[ stamps ] = digest
+        return digest
+
+    ### key of the output of evaluating evalsDict, of type type_m, in the session of digest
+    @staticmethod
+    def resultKey( digest, evalsDict, type_m ):
+        parameters = { key:value for key, value in evalsDict.get('parameters', {}).items() \
+            if key not in IgnoredParameters }
+        return digestOf( [ digest, type_m, normalized( parameters ), normalized( evalsDict.get('evaluations', {}) ) ] )
+
+    def loadResult(self, sessionDict, key):
+        result = readJson( os.path.join( self.cacheDir( sessionDict ), 'results', key+'.json' ) )
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def saveResult(self, sessionDict, key, evalsDict):
+        cache_dir = self.cacheDir( sessionDict )
+        writeJson( os.path.join( cache_dir, 'results', key+'.json' ), evalsDict )
+        self.evict( cache_dir )
+
+    def profiles(self, sessionDict, digest, type_m):
+        return Profiles( self, os.path.join( self.cacheDir( sessionDict ), 'pm', digest+'-'+str(type_m)+'.json' ) )
+
+    ### remove files unused for max_age seconds, then the least recently used while there are more than max_bytes
+    def evict(self, cache_dir):
+        with self.lock:
+            entries = []
+            for sub in ('results','pm'):
+                folder = os.path.join( cache_dir, sub )
+                if not os.path.isdir( folder ):
+                    continue
+                for name in os.listdir( folder ):
+                    path = os.path.join( folder, name )
+                    try:
+                        st = os.stat( path )
+                    except OSError:
+                        continue
+                    entries.append( ( st.st_mtime, st.st_size, path ) )
+
+            now = time.time()
+            total = sum( size for mtime, size, path in entries )
+            for mtime, size, path in sorted( entries ):
+                if now - mtime <= self.max_age and total <= self.max_bytes:
+                    break
+                try:
+                    os.remove( path )
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions}
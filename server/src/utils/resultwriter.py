@@ -0,0 +1,113 @@
+###     resultwriter.py
+###
+###     Writes the output file of a run as its evaluations finish, rather than building the whole file as one
+###     string at the end.   The output is the evaluations dictionary of the run: the keys that come before
+###     'evaluations' (the header: session, parameters), the evaluations one by one, then the keys after it (the
+###     trailer: the cache and link state statistics).   It is written in one of three forms
+###
+###         'pretty'    json indented by 4, the same bytes json.dumps( output, indent=4 ) gives
+###         'compact'   json without whitespace
+###         'ndjson'    one json object per line: {"header":...}, then {"name":...,"evaluation":...} for each
+###                       evaluation, then {"trailer":...}
+###
+###     and gzip compressed if asked.   The file is written under a temporary name and renamed when complete, so
+###     a reader never sees part of it, and nothing is left behind by a run that fails.
+###
+import os
+import gzip
+import json
+
+Forms = ('pretty','compact','ndjson')
+
+### 'auto' is 'pretty' for outputs of at most PrettyLimit evaluations, and 'compact' for larger ones
+PrettyLimit = 1000
+
+def chooseForm( form, evaluations ):
+    if form == 'auto':
+        return 'pretty' if evaluations <= PrettyLimit else 'compact'
+    return form
+
+### the text of a dictionary key, as json writes it
+def keyText( key ):
+    return json.dumps( key if isinstance( key, str ) else str( key ) )
+
+class ResultWriter:
+    def __init__(self, path, form='pretty', compress=False):
+        if form not in Forms:
+            raise ValueError('unknown output form '+str(form))
+        self.path = path
+        self.form = form
+        self.tmp_path = path + '.tmp'
+        if compress:
+            self.of = gzip.open( self.tmp_path, 'wt' )
+        else:
+            self.of = open( self.tmp_path, 'w' )
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is not None:
+            self.abort()
+        return False
+
+    def text(self, value, depth=0):
+        if self.form == 'pretty':
+            return json.dumps( value, indent=4 ).replace( '\n', '\n' + ' '*4*depth )
+        return json.dumps( value, separators=(',',':') )
+
+    ### the entries of a dictionary at the top level, with the separator due before the first
+    def members(self, entries, first):
+        for key, value in entries.items():
+            sep = ( '' if first else ',' )
+            first = False
+            if self.form == 'pretty':
+                self.of.write( sep + '\n    ' + keyText( key ) + ': ' + self.text( value, 1 ) )
+            else:
+                self.of.write( sep + keyText( key ) + ':' + self.text( value ) )
+        return first
+
+    ### start the output with header, the entries that come before the evaluations
+    def begin(self, header):
+        if self.form == 'ndjson':
+            self.of.write( self.text( {'header':header} ) + '\n' )
+            return
+
+        self.of.write( '{' )
+        first = self.members( header, True )
+        sep = '' if first else ','
+        if self.form == 'pretty':
+            self.of.write( sep + '\n    "evaluations": {' )
+        else:
+            self.of.write( sep + '"evaluations":{' )
+
+    ### write the evaluation name, with its results
+    def add(self, name, evaluation):
+        if self.form == 'ndjson':
+            self.of.write( self.text( {'name':name, 'evaluation':evaluation} ) + '\n' )
+        elif self.form == 'pretty':
+            self.of.write( ( ',' if self.count else '' ) + '\n        ' + keyText( name ) + ': ' + self.text( evaluation, 2 ) )
+        else:
+            self.of.write( ( ',' if self.count else '' ) + keyText( name ) + ':' + self.text( evaluation ) )
+        self.count += 1
+
+    ### end the output with trailer, the entries that come after the evaluations, and put it in place
+    def end(self, trailer):
+        if self.form == 'ndjson':
+            self.of.write( self.text( {'trailer':trailer} ) + '\n' )
+        else:
+            if self.form == 'pretty' and self.count:
+                self.of.write( '\n    }' )
+            else:
+                self.of.write( '}' )
+            self.members( trailer, False )
+            self.of.write( '\n}' if self.form == 'pretty' else '}' )
+
+        self.of.close()
+        os.replace( self.tmp_path, self.path )
+
+    def abort(self):
+        self.of.close()
+        if os.path.exists( self.tmp_path ):
+            os.remove( self.tmp_path )
@@ -18,9 +18,14 @@
 ###     to the action verb.  In the case of 'OUTPUT' the argument is a port number.  Like the rule match functions, the actions
 ###     are customized, selected by the attribute of the rule's 'action' dictionary. 
 ###
+###     So that nothing is parsed while routing, the constructor also compiles the rule: 'compiled' holds the match
+###     values with nw_dst turned into an integer (low, high) range, and 'program' holds the actions as pre-decoded
+###     tuples, ('OUTPUT', port number), ('SET_FIELD', (field, value)) and ('DEC_NW_TTL', None).
+###
 from collections import defaultdict
-from .ipn  import inIPFormat, IPValues
+from .ipn  import inIPFormat, IPValues, IPRange
 import pdb
+import sys
 
 RuleAttributes = ('actions','idle_timeout','packet_count','hard_timeout','byte_count',
     'duration_sec','duration_nsec','priority','length','flags','table_id','match','cookie')
@@ -39,10 +44,12 @@ def equal(v1,v2):
 ### 'contains' determines whether an IP address from the flow header is contained within a CIDR
 ### block in the rule's match dictionary
 
-### ip1 is the value from the rule, ip2 is the value from the flow
+### ip1 is the compiled (low, high) range from the rule, ip2 is the range carried by the flow
 def contains(ip1,ip2):
-    ipv1Low, ipv1High = IPValues(ip1)
-    ipv2Low, ipv2High = IPValues(ip1)
+    if ip1 is None or ip2 is None:
+        return False
+    ipv1Low, ipv1High = ip1
+    ipv2Low, ipv2High = ip2
     return ipv1Low <= ipv2Low and ipv2High <= ipv1High
 
 
@@ -50,40 +57,58 @@ def contains(ip1,ip2):
 ###
 ### set_field used to implement SET_FIELD action
 
-def set_field(**kwargs):
-    flow = kwargs['hdr'] 
-    flow.vars[ kwargs['field'] ] = kwargs['value']
-    return
+def set_field(flow, field, value):
+    flow.setField( field, value )
 
 ### portIsLive used to determine whether a give OUTPUT action should be applied,
 ### returning a Boolean indicating whether the port the OUTPUT would use is alive
 ###
-def portIsLive(**kwargs):
+def portIsLive(switch, portId):
 
     ### look up the state of the link between this switch and
     ### the switch pointed to by the action code. 
-    switch   = kwargs['switch']
-    portId   = int(kwargs['portId'])
-    linkUp   = switch.checkLinkState( portId ) 
-    return   linkUp
+    return switch.checkLinkState( portId ) 
 
 ### decrement the flow header's TTL value
 ###
-def decTTL(**kwargs):
-    flow = kwargs['hdr']
+def decTTL(flow):
     flow.vars['nw_ttl'] -= 1
 
 
 cmpFunc = {'dl_type':equal, 'ip_dscp':equal,'in_port':equal,'nw_dst':contains}
-actionFunc = {'SET_FIELD':set_field,'OUTPUT':portIsLive,'DEC_NW_TTL':decTTL }
 
-RuleNewlySeen   = set()
-MatchNewlySeen  = set()
-ActionNewlySeen = set()
+### the rule, match and action attributes met while parsing a configuration that the code doesn't know
+### about.  Each parse collects them in its own NewlySeen, and its caller reports them
+###
+class NewlySeen:
+    def __init__(self):
+        self.rules   = set()
+        self.matches = set()
+        self.actions = set()
+
+    ### print the unknown attributes, if any, returning True when there were some
+    ###
+    def report(self):
+        newAttributes = False
+        if self.rules:
+            print('unknown rule attributes seen in configuration, report to developer', repr(self.rules),\
+                file = sys.stderr)
+            newAttributes = True
+
+        if self.matches:
+            print('unknown match attributes seen in configuration, report to developer', repr(self.matches),\
+                file = sys.stderr)
+            newAttributes = True
+
+        if self.actions:
+            print('unknown action attributes seen in configuration, report to developer', repr(self.actions),\
+                file = sys.stderr )
+            newAttributes = True
+
+        return newAttributes
 
 class Rule:
-    def __init__(self,switch,rdict):
-        global RuleNewlySeen, MatchNewlySeen, ActionNewlySeen
+    def __init__(self,switch,rdict,newlySeen):
 
         ### remember which switch this rule is on
         ###
@@ -110,7 +135,7 @@ class Rule:
 
             ### if we don't see it, remember the attribute name, reported once
             if seen not in RuleAttributes:
-                RuleNewlySeen.add(seen)
+                newlySeen.rules.add(seen)
 
             ### 'actions' and 'match' are special, not state variables, remember the value 
             elif seen not in ('actions','match'):
@@ -126,7 +151,7 @@ class Rule:
                 self.match[seen] = int( matchField ) \
                     if isinstance(matchField,int) or matchField.isdigit() else matchField
             else:
-                MatchNewlySeen.add(seen)
+                newlySeen.matches.add(seen)
 
         ### action list gives the list of actions to take upon a match.
         ### check that we've seen them all
@@ -143,52 +168,82 @@ class Rule:
                 post = None
 
             if pre not in ActionAttributes:
-                ActionNewlySeen.add(pre)                
+                newlySeen.actions.add(pre)                
             if post is not None:
                 self.action.append((pre,post))
             else:
                 self.action.append((pre,None))
 
+        ### compile the match values and the actions so that routing does no string handling
+        self.compiled = {}
+        for matchAttribute, matchField in self.match.items():
+            if matchAttribute == 'nw_dst':
+                self.compiled[ matchAttribute ] = IPRange( matchField )
+            else:
+                self.compiled[ matchAttribute ] = matchField
+
+        self.program = []
+        for actionAttribute, actionField in self.action:
+            if actionAttribute == 'OUTPUT':
+                ### a port that isn't a number (e.g. CONTROLLER) never leads to a neighbor
+                portId = int(actionField) if actionField is not None and actionField.isdigit() else actionField
+                self.program.append( ('OUTPUT', portId) )
+
+            elif actionAttribute == 'DEC_NW_TTL':
+                self.program.append( ('DEC_NW_TTL', None) )
+
+            elif actionAttribute == 'SET_FIELD' and actionField is not None and actionField.find(':') > -1:
+                actionField = actionField.replace('{','')
+                actionField = actionField.replace('}','')
+                here = actionField.find(':')
+                self.program.append( ('SET_FIELD', (actionField[:here], actionField[here+1:])) )
+
 
     ### if offered flow matches the rule apply the actions.  If those actions
     ### include routing to (potentially multiple) nodes, return the list of node identifiers
     ### 
     def matchAndAction(self, flow):
-        ### check for match
-        for matchAttribute, matchField in self.match.items():
+        if not self.matches(flow):
+            return None
+
+        return self.applyActions(flow)
+
+    ### check whether every attribute of the rule's match dictionary agrees with the flow header
+    ###
+    def matches(self, flow):
+        for matchAttribute, matchField in self.compiled.items():
             ### if matchAttribute not an attribute of the flow, there's no match
             if matchAttribute not in flow.vars:
-                return None
+                return False
+
+            ### the flow carries nw_dst already converted to an integer range
+            flowField = flow.dstRange if matchAttribute == 'nw_dst' else flow.vars[ matchAttribute ]
 
             ### look up the function to use to compare the field from the rule with the field from the flow
             cmpF = cmpFunc[matchAttribute]
-            if not cmpF( matchField, flow.vars[ matchAttribute ] ):
-                return None
+            if not cmpF( matchField, flowField ):
+                return False
 
-        ### survived all the match tests, now apply the actions
-        ###
+        return True
+
+    ### apply the rule's actions to a flow already known to match.  Returns the list of ports to
+    ### route through, or None if no OUTPUT port is live or the flow's TTL has expired
+    ###
+    def applyActions(self, flow):
         toRoute = []
-        for actionAttribute, actionField in self.action:
-            actionF = actionFunc[ actionAttribute ]
+        for actionAttribute, actionField in self.program:
 
             ### if this rule has multiple OUTPUT statements only the first one routing to a live link is used
-            if actionAttribute == 'OUTPUT' and len(toRoute) == 0:
-
-                # ability to route dependent on state of link, to be tested inside of actionF
-                routed = actionF( switch=self.switch, portId=actionField )
-                if routed:
+            if actionAttribute == 'OUTPUT':
+                if not toRoute and portIsLive( self.switch, actionField ):
                     ### remember the port out of which the flow is to pass
-                    toRoute.append( int(actionField) )
+                    toRoute.append( actionField )
             
             elif actionAttribute == 'DEC_NW_TTL':
-                actionF(hdr=flow)
+                decTTL( flow )
      
-            elif actionAttribute == 'SET_FIELD': 
-                if actionField.find(':') > -1:
-                    actionField = actionField.replace('{','')
-                    actionField = actionField.replace('}','')
-                    here = actionField.find(':')
-                    actionF(hdr=flow, field=actionField[:here], value=actionField[here+1:])
+            else:
+                set_field( flow, *actionField )
 
         ### if toRoute is not empty and the flow's TTL is non-zero pass along toRoute
         ###
@@ -197,6 +252,12 @@ class Rule:
         else:
             return None
 
+    ### names of the header fields this rule's SET_FIELD actions write.  The classifier in
+    ### utils/classifier.py uses this to know when a non-routing match may change which rules match next
+    ###
+    def setFields(self):
+        return set( actionField[0] for actionAttribute, actionField in self.program if actionAttribute == 'SET_FIELD' )
+
     def isComplex(self):
         if len(self.match) > 1:
             return True
@@ -13,22 +13,40 @@
 ###       is contained within one of the switches IP ranges.
 ###
 ###     Switch has method 'route' which accepts a flow header and returns a list of local ports through which the
-###         packet is to be pushed.  In concept there might be more than one if an OUTPUT action specifies a broadcast
+###         packet is to be pushed.  Rules are found through a Classifier compiled from table[0], rather than by
+###         walking the whole table.  In concept there might be more than one if an OUTPUT action specifies a broadcast
 ###         multi-cast.  We have not seen such, but have written the code to be prepared for the possiblity.  If the list
 ###         is empty, the flow does not route.
 ###
+###     route keeps a next-hop cache.  What route does to a flow depends only on the header fields the switch's rules
+###       look at and on the state of the ports named by the OUTPUT actions of the rules the header matches, so the
+###       outcome (ports to route through and the changes made to the header) is remembered under the header's
+###       fingerprint together with the failed links among those behind them.   A link changing state therefore only affects entries
+###       of the switches at its ends that consult the port it is attached to; nothing needs to be flushed.   The cache
+###       is emptied when a different linkState structure is saved to the switch, or when it reaches NextHopCacheSize
+###       entries.   cacheHits and cacheMisses count lookups.
+###
 ###     Switch has method 'discoverFlows' which is used to find viable flows.  It is like route, except that it looks
-###      for loops in the paths and rejects evolving paths that encounter them
+###      for loops in the paths and rejects evolving paths that encounter them.   The search keeps its own stack rather
+###      than recursing, and memoizes the outcome of the search from a state, (switch, in_port, header), as the paths
+###      found from there.  That outcome depends on the switches already on the path only through the loops it ran into;
+###      these 'blockers' are recorded with it, and it is reused wherever they are all upstream again, dropping the paths
+###      that would loop back into the new upstream switches.   Templates and sources that lead into the same state
+###      share its search, so discovery costs in proportion to the distinct states rather than to the paths.
 ###
 from collections import defaultdict
 from .rule import Rule
+from .classifier import Classifier
+from .linkstate import linkName
 from .ipn import IPValues, Int2IP
 
-import copy
+import sys
 import pdb
 
+NextHopCacheSize = 1 << 16
+
 class Switch:
-    def __init__(self,name,nbrs,rules, nodeIPs):
+    def __init__(self,name,nbrs,rules, nodeIPs, newlySeen):
         self.name   = name
         self.nbrs   = nbrs
         self.tables = []
@@ -46,7 +64,7 @@ class Switch:
         rlist = rules[ self.code ]
 
         for rdict in rlist:
-            rule = Rule( self, rdict )
+            rule = Rule( self, rdict, newlySeen )
 
             ### make sure there is a table list
             table_id = rule.table_id         
@@ -56,27 +74,71 @@ class Switch:
             ### append the rule to the end of the proper table
             self.tables[ table_id ].append(rule)
 
+        ### a switch applies the highest priority matching rule first.  The sort is stable, so rules of
+        ### equal priority keep the order in which they were listed
+        for table in self.tables:
+            table.sort( key=lambda rule: -rule.state['priority'] )
+
+        self.classifier = Classifier( self.tables[0] if self.tables else [] )
+
+        ### portBits maps a port to the bit of the link behind it in the linkState's bit-sets,
+        ### filled in when the linkState is saved
+        self.linkState   = None
+        self.portBits    = {}
+
+        ### next-hop cache, see above.  consulted maps a header fingerprint to the bit-set of links whose
+        ### state decides the outcome for that header
+        self.consulted   = {}
+        self.nextHops    = {}
+        self.cacheHits   = 0
+        self.cacheMisses = 0
+
     def saveLinkState(self, linkState):
+        if linkState is not self.linkState:
+            self.clearCache()
+            self.portBits = {}
+            for portId, nbr in self.nbrs.items():
+                self.portBits[ portId ] = linkState.bit( linkName( self.name, nbr ) )
         self.linkState = linkState
 
+    def clearCache(self):
+        self.consulted = {}
+        self.nextHops  = {}
+
     ### see if the link between self and nbr accessable through portId is up
     ###
     def checkLinkState(self, portId ):
 
         ### we've see the action to route through a non-existent port. Nope.
-        if portId not in self.nbrs:
+        if portId not in self.portBits:
             return False
 
-        nbr = self.nbrs[ portId ]
-        linkName = self.name+'-'+nbr if self.name < nbr else nbr+'-'+self.name
-        return self.linkState[ linkName ]
+        bit = self.portBits[ portId ]
+        linkState = self.linkState
+
+        ### remember the link was looked at, the outcome of routing depends on it
+        if linkState.tracing:
+            linkState.trace |= bit
+
+        return not linkState.failed & bit
+
+    ### bit-set of the links behind a collection of ports
+    ###
+    def portsMask(self, ports):
+        mask = 0
+        for portId in ports:
+            mask |= self.portBits.get( portId, 0 )
+        return mask
 
     ### the flow is considered to have arrived if the destination is contained in any of the 
     ### CIDR addresses associated with the switch
     ###
     def atDestination(self, flow):
         
-        flowLow, flowHigh = IPValues( flow.vars['nw_dst'] )
+        if flow.dstRange is None:
+            return False
+
+        flowLow, flowHigh = flow.dstRange
         for low, high in self.cidr:
             if low <= flowLow and flowHigh <= high:
                return True
@@ -89,16 +151,8 @@ class Switch:
     def route(self, in_port, flow ):
         flow.vars['in_port'] = in_port
 
-        ### go through list of rules in table[0] and look for routing actions
-        ###
-        for rule in self.tables[0]:
-
-            nbrs = rule.matchAndAction(flow)
-
-            ### if nbrs is not None we found a match
-            if nbrs:
-                break
-
+        nbrs = self.nextHop( flow )
+ 
         ### either went through the loop without a match (or expired TTL), or found a port to go through
         ### 
         moveIt = []
@@ -108,68 +162,206 @@ class Switch:
             moveIt.append( (flow, nbrs[0]) )
  
             for idx in range(1,len(nbrs)):
-                newFlow = copy.deepcopy( flow )
+                newFlow = flow.copy()
                 moveIt.append( (newFlow, nbrs[idx]) )
 
         return moveIt 
 
-    def discoverFlows(self, flow, port, switches, neighborMap):
-
-        discoveries = []
-
-        flow.visited.append( self.name )
-
-        if self.atDestination( flow ):
-            flow.vars['ndst'] = self.name 
-            return [flow]
+    ### look up the outcome of routing the flow in the next-hop cache, or compute and remember it
+    ###
+    def nextHop(self, flow):
+        fingerprint = self.classifier.fingerprint( flow )
+
+        if fingerprint in self.consulted:
+            links = self.consulted[ fingerprint ]
+        else:
+            ports = self.classifier.outputPorts( flow )
+            links = self.portsMask( ports ) if ports is not None else None
+            self.consulted[ fingerprint ] = links
+
+        ### a matching rule rewrites a field other rules match on, route without the cache
+        if links is None:
+            return self.matchRules( flow )
+
+        ### the outcome depends on the state of these links whether or not it is found in the cache
+        linkState = self.linkState
+        if linkState.tracing:
+            linkState.trace |= links
+
+        key = ( fingerprint, linkState.failed & links )
+        if key in self.nextHops:
+            self.cacheHits += 1
+            nbrs, updates = self.nextHops[ key ]
+            for field, value in updates:
+                flow.setField( field, value )
+            return nbrs
+
+        self.cacheMisses += 1
+        before = dict( flow.vars )
+        nbrs   = self.matchRules( flow )
+        updates = tuple( (field, value) for field, value in flow.vars.items() \
+            if field not in before or before[ field ] != value )
+
+        if len(self.nextHops) >= NextHopCacheSize:
+            self.clearCache()
+            self.consulted[ fingerprint ] = links
+
+        self.nextHops[ key ] = ( nbrs, updates )
+        return nbrs
+
+    ### go through the rules of table[0] matching the flow, in priority order, and look for routing actions
+    ###
+    def matchRules(self, flow):
+        nbrs = None
+        for rule in self.classifier.candidates( flow ):
 
+            nbrs = rule.applyActions(flow)
 
-        toRoute = self.route( port, flow )
+            ### if nbrs is not None we found a match
+            if nbrs:
+                break
 
-        if not toRoute:
-            return []
+        return nbrs
 
-        failures = 0
-        for (flow, portId) in toRoute:
-            if portId not in neighborMap[ self.name ]:
-                failures += 1
-                continue
-            ### find the port number of the next switches connection to self
-            ###
-            (nbrId, nbrPort) = neighborMap[ self.name ][ portId ]
-
-            ### if we've already visited nbrId don't circle back
-            ###
-            if nbrId in flow.visited:
-                failures += 1
+    ### discover the flows that reach a destination from this switch, for a flow entering on port.  Returns the Flow
+    ### of every path found, with visited set to its switches and the header as it arrives at the destination.
+    ### memo, a DiscoveryMemo, carries the outcomes of earlier searches over the same switches
+    ###
+    def discoverFlows(self, flow, port, switches, neighborMap, memo=None):
+        if memo is None:
+            memo = DiscoveryMemo( switches )
+
+        ### switches of the frames on the stack, in order and as a set
+        path   = []
+        onPath = set()
+        stack  = []
+
+        ### the outcome of the search from a state is (paths, blockers, reach, expired).  A path is a tuple (switches,
+        ### their set, Flow at the destination, TTL consumed on the way); blockers, reach and expired are described
+        ### with DiscoveryMemo
+        def enter(switch, flow, port):
+            ttl = flow.vars.get('nw_ttl')
+            key = ( switch.name, port, memo.header( flow ) )
+            for paths, blockers, recordedTTL, reach, expired in memo.outcomes.get( key, () ):
+                if not blockers <= onPath:
+                    continue
+                if ttl != recordedTTL and ( expired or ttl is None or recordedTTL is None or ttl <= reach ):
+                    continue
+
+                ### drop the paths looping back into the switches upstream
+                kept = []
+                for found in paths:
+                    if found[1] & onPath:
+                        blockers = blockers | ( found[1] & onPath )
+                    else:
+                        kept.append( found )
+                memo.hits += 1
+                return kept, blockers, reach, expired
+
+            if switch.atDestination( flow ):
+                flow.vars['ndst'] = switch.name
+                return [ ( (switch.name,), frozenset([switch.name]), flow, 0 ) ], frozenset(), 0, False
+
+            memo.searches += 1
+            path.append( switch.name )
+            onPath.add( switch.name )
+
+            toRoute = switch.route( port, flow )
+            after = flow.vars.get('nw_ttl')
+            used  = ttl - after if ttl is not None and after is not None else 0
+            frame = { 'key':key, 'name':switch.name, 'ttl':ttl, 'used':used, 'paths':[], 'blockers':set(),
+                      'reach':used, 'expired':not toRoute and after is not None and after <= 0 }
+            stack.append( frame )
+
+            nbrs = neighborMap[ switch.name ]
+            children = []
+            for (nextFlow, portId) in toRoute:
+                ### portId might not map to a neighbor so it is routed off to no-where
+                if portId not in nbrs:
+                    continue
+
+                ### find the port number of the next switches connection to self
+                (nbrId, nbrPort) = nbrs[ portId ]
+
+                ### if we've already visited nbrId don't circle back
+                if nbrId in onPath:
+                    if nbrId != switch.name:
+                        frame['blockers'].add( nbrId )
+                    continue
+
+                children.append( (switches[ nbrId ], nextFlow, nbrPort) )
+
+            if toRoute and not children and nextFlow.tagged:
+                print('\t', repr(path),'dropped because all routes exit network or loop back',\
+                    file = sys.stdout )
+
+            frame['children'] = iter( children )
+            return None
+
+        launchTTL = flow.vars.get('nw_ttl')
+        outcome = enter( self, flow, port )
+        while stack:
+            frame = stack[-1]
+            if outcome is not None:
+                paths, blockers, reach, expired = outcome
+                name, used = frame['name'], frame['used']
+                for switchNames, switchSet, dflow, consumed in paths:
+                    frame['paths'].append( ( (name,)+switchNames, switchSet | {name}, dflow, used+consumed ) )
+                frame['blockers'] |= blockers - {name}
+                frame['reach'] = max( frame['reach'], used+reach )
+                frame['expired'] = frame['expired'] or expired
+
+            child = next( frame['children'], None )
+            if child is not None:
+                outcome = enter( *child )
                 continue
 
-        if failures == len(toRoute) and flow.tagged:
-            print('\t', repr(flow.visited),'dropped because all routes exit network or loop back',\
-                file = sys.stdout )
-            return []
-
-        for (flow, portId) in toRoute:
-           
-            ### portId might not map to a neighbor so it is routed off to no-where
-            ###
-            if portId not in neighborMap[ self.name ]:
-                continue
- 
-            ### find the port number of the next switches connection to self
-            ###
-            (nbrId, nbrPort) = neighborMap[ self.name ][ portId ]
-
-            ### if we've already visited nbrId don't circle back
-            ###
-            if nbrId in flow.visited:
-                #print('warning...loop detected')
-                continue
+            stack.pop()
+            path.pop()
+            onPath.discard( frame['name'] )
+            outcome = ( frame['paths'], frozenset( frame['blockers'] ), frame['reach'], frame['expired'] )
+            memo.outcomes.setdefault( frame['key'], [] ).append( \
+                ( outcome[0], outcome[1], frame['ttl'], outcome[2], outcome[3] ) )
 
-            nbr              = switches[ nbrId ]
-            routed           = nbr.discoverFlows( flow, nbrPort, switches,  neighborMap )
-            if routed:
-                discoveries.extend( routed )
+        discoveries = []
+        for switchNames, switchSet, dflow, consumed in outcome[0]:
+            found = dflow.copy()
+            found.visited = list( switchNames )
+            for attrib in LaunchAttributes:
+                if attrib in flow.vars:
+                    found.vars[ attrib ] = flow.vars[ attrib ]
+            if launchTTL is not None:
+                found.setField( 'nw_ttl', launchTTL-consumed )
+            discoveries.append( found )
 
         return discoveries
- 
+
+### header fields that only record where a flow was launched from, and play no part in where it goes
+###
+LaunchAttributes = ('nsrc','ingress_port')
+
+### outcomes of the searches of Switch.discoverFlows, to be shared by all the searches over a network.  outcomes maps
+### a state, (switch, in_port, header), to the outcomes recorded for it, as (paths, blockers, TTL at entry, reach, expired):
+###     - blockers are the switches upstream of the state that the search ran into and turned back from.  The outcome
+###       holds wherever they are upstream again, less the paths through switches that are upstream as well
+###     - unless a rule matches on nw_ttl or sets it, the search depends on the TTL only through it running out, so nw_ttl
+###       is left out of the state.  reach is the most TTL consumed before any routing decision of the search, and
+###       expired tells whether the TTL ran out.  An outcome in which it did not holds for any TTL above reach
+### hits counts the outcomes reused, searches the states searched
+###
+class DiscoveryMemo:
+    def __init__(self, switches):
+        self.outcomes = {}
+        self.hits     = 0
+        self.searches = 0
+        self.relativeTTL = True
+        for switch in switches.values():
+            for table in switch.tables:
+                for rule in table:
+                    if 'nw_ttl' in rule.match or 'nw_ttl' in rule.setFields():
+                        self.relativeTTL = False
+
+    def header(self, flow):
+        skip = ('ndst','in_port','nw_ttl') if self.relativeTTL else ('ndst','in_port')
+        return tuple( (attrib, value) for attrib, value in flow.vars.items() \
+            if attrib not in LaunchAttributes and attrib not in skip )